@@ -174,6 +174,14 @@ LOGGING = {
             "backupCount": 5,  # Maximum number of backup files to keep
             "formatter": "apscheduler",
         },
+        "storage_drift_file": {
+            "level": "INFO",
+            "class": "logging.handlers.TimedRotatingFileHandler",
+            "filename": os.path.join(LOGS_DIR, "storage_drift.log"),
+            "when": "W0",  # Rotate every week on Sunday
+            "backupCount": 5,  # Maximum number of backup files to keep
+            "formatter": "verbose",
+        },
     },
     "loggers": {
         "": {
@@ -186,6 +194,11 @@ LOGGING = {
             "level": "INFO",
             "propagate": False,
         },
+        "storage_drift": {  # reports from reconcile_storage (backups/quota.py)
+            "handlers": ["storage_drift_file"],
+            "level": "INFO",
+            "propagate": False,
+        },
     },
 }
 
@@ -232,10 +245,95 @@ CRISPY_TEMPLATE_PACK = 'bootstrap4'
 
 DATA_UPLOAD_MAX_MEMORY_SIZE = 1024 * 1024 * 10  # 10MB
 
-EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+# how long (in seconds) an idle upload session is kept so the client can resume it
+UPLOAD_SESSION_MAX_AGE = 60 * 60 * 24  # 24 hours
+# advertised to upload clients, chunks can be sent in any order over several connections at once
+UPLOAD_RECOMMENDED_CHUNK_SIZE = 1024 * 1024 * 8  # 8MB
+UPLOAD_MAX_PARALLEL_CHUNKS = 4
+# background jobs (backups/jobs.py), run by the scheduler in each process or by 'manage.py run_jobs'
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_DELAY = 30  # seconds before the first retry, doubled after every failed attempt
+JOB_LOCK_TIMEOUT = 60 * 30  # a running job whose lock isn't refreshed for this long has died with its worker
+JOB_HEARTBEAT_INTERVAL = 60  # how often a running job's lock is refreshed
+JOB_RETENTION_DAYS = 30  # done jobs are deleted after this many days
+# kinds of jobs the web processes leave to dedicated `manage.py run_jobs` workers: splitting backups into chunks is a
+# pure Python loop that would hold up requests for minutes. Empty it to run everything in the web processes
+WORKER_ONLY_JOBS = ['index_backup', 'index_new_backups']
+# None to send backup downloads from Django, or hand them to the front-end server with 'x-sendfile' (the file's path)
+# or 'x-accel-redirect' (nginx, BACKUP_DOWNLOAD_ACCEL_PREFIX has to be an internal location aliased to MEDIA_ROOT)
+BACKUP_DOWNLOAD_OFFLOAD = None
+BACKUP_DOWNLOAD_ACCEL_PREFIX = '/protected-media/'
+DELTA_CACHE_MAX_AGE = 60 * 60 * 24 * 7  # cached backup deltas (media/deltas) unused for a week are deleted
+# empty folders left in MEDIA_ROOT/backups are swept in the background (with the other cleanup, every 2 hours),
+# EMPTY_FOLDER_SWEEP_BATCH folders at a time with EMPTY_FOLDER_SWEEP_PAUSE seconds after each folder and
+# EMPTY_FOLDER_SWEEP_DELAY seconds between batches. Deleting a backup removes its own folder straight away if it's empty
+EMPTY_FOLDER_SWEEP_BATCH = 1000
+EMPTY_FOLDER_SWEEP_PAUSE = 0.005
+EMPTY_FOLDER_SWEEP_DELAY = 30
+# retention policies (backups/retention.py) are applied daily at RETENTION_HOUR, deleting RETENTION_BATCH_SIZE backups
+# per transaction
+RETENTION_HOUR = 2
+RETENTION_BATCH_SIZE = 50
+# archive tier (backups/archive.py): backups older than their company's ArchivePolicy (or ARCHIVE_AFTER_DAYS, None for
+# never) are moved to BACKUP_ARCHIVE_ROOT daily at ARCHIVE_HOUR. This can be a slower, bigger volume
+BACKUP_ARCHIVE_ROOT = os.path.join(BASE_DIR, 'archive')
+ARCHIVE_AFTER_DAYS = None
+ARCHIVE_COMPRESSION = True  # gzip archived backups that compress well
+ARCHIVE_RECALL_KEEP_DAYS = 7  # a recalled backup stays on the hot tier at least this long
+ARCHIVE_HOUR = 3
+
+# integrity scrubber (backups/scrub.py): from SCRUB_HOUR every day, backups not verified in SCRUB_INTERVAL_DAYS are read
+# back and checked, on SCRUB_WORKERS threads reading at most SCRUB_RATE_LIMIT bytes a second between them (None for no
+# limit), in jobs of about SCRUB_JOB_SECONDS reading at most SCRUB_BATCH_BYTES between checks of the time. Archived
+# backups in an S3 store are only checked with SCRUB_REMOTE_ARCHIVE
+SCRUB_HOUR = 4
+SCRUB_INTERVAL_DAYS = 30
+SCRUB_WORKERS = 2
+SCRUB_RATE_LIMIT = 1024 * 1024 * 50
+SCRUB_JOB_SECONDS = 60 * 10
+SCRUB_BATCH_BYTES = 1024 * 1024 * 1024 * 4
+SCRUB_REMOTE_ARCHIVE = False
+
+# the S3 compatible bucket (AWS, MinIO) an object store with the s3 backend uses, needs boto3
+S3_OPTIONS = {
+    'bucket': env('S3_BUCKET', default='softrite-backups'),
+    'prefix': env('S3_PREFIX', default=''),
+    'endpoint_url': env('S3_ENDPOINT_URL', default=None),  # e.g. http://localhost:9000 for MinIO
+    'region_name': env('S3_REGION', default=None),
+    'access_key': env('S3_ACCESS_KEY', default=None),
+    'secret_key': env('S3_SECRET_KEY', default=None),
+}
+# where backups' own files (the hot tier, Backup.file) are kept (backups/objectstore.py). The default is MEDIA_ROOT
+# on this server; set BACKUP_HOT_STORE_BACKEND=s3 to keep them in the S3 bucket instead (under backups/, next to the
+# archive's objects if it's the same bucket)
+BACKUP_HOT_STORE = {
+    'BACKEND': env('BACKUP_HOT_STORE_BACKEND', default='local'),
+    'OPTIONS': {} if env('BACKUP_HOT_STORE_BACKEND', default='local') == 'local' else S3_OPTIONS,
+}
+# where archived backups are kept. The default is a directory on this server, BACKUP_OBJECT_STORE_BACKEND=s3 archives
+# to the S3 bucket
+BACKUP_OBJECT_STORE = {
+    'BACKEND': env('BACKUP_OBJECT_STORE_BACKEND', default='local'),
+    'OPTIONS': {'root': BACKUP_ARCHIVE_ROOT} if env('BACKUP_OBJECT_STORE_BACKEND', default='local') == 'local' else
+    S3_OPTIONS,
+}
+# with an S3 hot store, chunked uploads are assembled in the bucket as multipart uploads (no local staging copy) and
+# their backups are hot files in the bucket like any other
+UPLOAD_MULTIPART_PASSTHROUGH = True
+# checksum used for uploads that don't ask for one (md5, sha256 or blake2b)
+BACKUP_CHECKSUM_ALGORITHM = 'md5'
+
+# send_mail() only queues emails in the outbox, the outbox sender delivers them in batches (users/mail.py)
+EMAIL_BACKEND = 'users.mail.OutboxEmailBackend'
+OUTBOX_EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'  # the backend that actually sends them
+OUTBOX_BATCH_SIZE = 50  # emails sent per connection
+OUTBOX_RATE_LIMIT = 30  # most emails sent per minute, across all processes
+OUTBOX_MAX_ATTEMPTS = 5
+OUTBOX_RETENTION_DAYS = 7  # sent and failed emails (without their bodies) are deleted after this many days
+BACKUP_DIGEST_HOUR = 7  # when the daily backup digest goes out, for users that chose it
 EMAIL_HOST = env('SMTP_HOST')
 EMAIL_PORT = env('SMTP_PORT')
-EMAIL_USE_SSL = True
+EMAIL_USE_SSL = env.bool('SMTP_USE_SSL', default=True)  # set SMTP_USE_SSL=False for a local test SMTP server
 EMAIL_HOST_USER = env('SMTP_USERNAME')
 EMAIL_HOST_PASSWORD = env('SMTP_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
@@ -4,3 +4,9 @@ from .models import *
 # Register your models here.
 admin.site.register(Backup)
 admin.site.register(Comment)
+admin.site.register(UploadSession)
+admin.site.register(Chunk)
+admin.site.register(BackupManifest)
+admin.site.register(Job)
+admin.site.register(RetentionPolicy)
+admin.site.register(ArchivePolicy)
@@ -1,22 +1,24 @@
 from django.apps import AppConfig
 from apscheduler.schedulers.background import BackgroundScheduler
 from django.conf import settings
+from django.db.models.signals import post_migrate
 import pytz  # to make the datetime.now() timezone aware and get rid of the warning message from 'PytzUsageWarning'
-import os
 import logging
 from datetime import datetime
-from SoftriteAPI.settings import MEDIA_ROOT
-from backups.utils import cleanup_incomplete_uploads, remove_empty_folders
+from backups.utils import cleanup_incomplete_uploads
 
 
 logger = logging.getLogger(__name__)
 
 def clean_function():
     """container function to run one or more functions from the utils"""
+    from backups.delta import cleanup_deltas
+    from backups.jobs import purge_finished_jobs
+    from backups.tasks import enqueue_sweep_empty_folders
     cleanup_incomplete_uploads()
-    backups_path = os.path.join(MEDIA_ROOT, 'backups')
-    remove_empty_folders(backups_path, False)
-    # make sure to set remove root to false. It would suck to delete the backups dir by mistake!
+    cleanup_deltas(settings.DELTA_CACHE_MAX_AGE)
+    purge_finished_jobs()
+    enqueue_sweep_empty_folders()  # runs in the background, a slice of the tree at a time
 
 
 class BackupsConfig(AppConfig):
@@ -24,12 +26,43 @@ class BackupsConfig(AppConfig):
     name = 'backups'
 
     def ready(self):
+        import backups.signals
+        import backups.tasks  # registers the job handlers
+        from backups.jobs import run_pending_jobs
+        from backups.tasks import enqueue_apply_retention, enqueue_archive_cold_backups, enqueue_backup_digests, \
+            enqueue_index_new_backups, enqueue_reconcile_storage, enqueue_scrub_backups
         from users.models import Profile
 
+        # migrations that rebuild backups_backup or backups_comment drop the search index's triggers
+        post_migrate.connect(backups.signals.repair_search_triggers, sender=self)
+
         scheduler = BackgroundScheduler(timezone=settings.TIME_ZONE)
         tz = pytz.timezone(settings.TIME_ZONE)
         # run every 2 hours
         scheduler.add_job(clean_function, 'interval', hours=2, id='clean_storage',
                           misfire_grace_time=60,  # if the job is missed within a 60-second window, it will still run
                           next_run_time=tz.localize(datetime.now()))
+        # work queued by requests (see backups/tasks.py), except what only dedicated workers run.
+        # max_instances=1 so a slow job doesn't pile up runs
+        scheduler.add_job(run_pending_jobs, 'interval', seconds=10, id='run_jobs', max_instances=1,
+                          misfire_grace_time=60, kwargs={'exclude_kinds': settings.WORKER_ONLY_JOBS})
+        # daily backup digest emails
+        scheduler.add_job(enqueue_backup_digests, 'cron', hour=settings.BACKUP_DIGEST_HOUR, id='backup_digests',
+                          misfire_grace_time=60 * 60)
+        # check the companies' storage counters against their backups (once an hour across all processes)
+        scheduler.add_job(enqueue_reconcile_storage, 'cron', minute=15, id='reconcile_storage',
+                          misfire_grace_time=60 * 10)
+        # delete the backups companies' retention policies don't keep
+        scheduler.add_job(enqueue_apply_retention, 'cron', hour=settings.RETENTION_HOUR, id='apply_retention',
+                          misfire_grace_time=60 * 60)
+        # move backups past their company's archive policy to the archive tier
+        scheduler.add_job(enqueue_archive_cold_backups, 'cron', hour=settings.ARCHIVE_HOUR, id='archive_cold_backups',
+                          misfire_grace_time=60 * 60)
+        # read stored backups back and check them against their checksums
+        scheduler.add_job(enqueue_scrub_backups, 'cron', hour=settings.SCRUB_HOUR, id='scrub_backups',
+                          misfire_grace_time=60 * 60)
+        # split newly stored backups into content-defined chunks for the chunk index (catches anything the
+        # queued jobs missed, e.g. backups from before the queue existed). Run by the dedicated job workers
+        scheduler.add_job(enqueue_index_new_backups, 'interval', minutes=10, id='index_backup_chunks',
+                          misfire_grace_time=60)
         scheduler.start()
@@ -0,0 +1,202 @@
+import os
+import gzip
+import zlib
+import shutil
+import logging
+import tempfile
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from backups.models import ARCHIVE_TIER, CHUNK_TIER, HOT_TIER, ArchivePolicy, Backup, BackupManifest
+from backups.chunkstore import CONTENT_ALGORITHM, content_digest, open_chunked, record_missing_checksum, \
+    release_chunks, remove_hot_file, store_chunks
+from backups.objectstore import get_hot_store, get_object_store
+from users.models import Company
+
+logger = logging.getLogger(__name__)
+
+COPY_SIZE = 1024 * 1024
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024 * 4
+MIN_COMPRESSION_SAVING = 0.1  # only gzip backups that shrink by at least 10%, most zips are compressed already
+
+
+def archive_after_days(company: Company) -> int | None:
+    """
+    How many days the company's backups stay out of the archive, None if they're never archived.
+    """
+    try:
+        policy = company.archive_policy
+    except ArchivePolicy.DoesNotExist:
+        return settings.ARCHIVE_AFTER_DAYS
+    return policy.archive_after_days if policy.enabled else None
+
+
+def worth_compressing(file) -> bool:
+    sample = file.read(COMPRESSION_SAMPLE_SIZE)
+    if not sample:
+        return False
+    return len(zlib.compress(sample, 1)) < len(sample) * (1 - MIN_COMPRESSION_SAVING)
+
+
+def put_archive_object(source_file, key: str, compress: bool):
+    """
+    Copy a binary file into the object store under key, gzipped if compress. Archive objects are named after their
+    content, so one that's already there is left alone.
+    """
+    store = get_object_store()
+    if store.exists(key):
+        return
+
+    if not compress:
+        store.put_file(source_file, key)
+        return
+
+    # compressed into a temporary file first, an S3 store wants to know how big an object is before it's sent
+    with tempfile.NamedTemporaryFile(suffix='.gz', dir=settings.FILE_UPLOAD_TEMP_DIR, delete=False) as tmp_file:
+        tmp_path = tmp_file.name
+        try:
+            with gzip.GzipFile(fileobj=tmp_file, mode='wb', compresslevel=6, mtime=0) as gzip_file:
+                shutil.copyfileobj(source_file, gzip_file, COPY_SIZE)
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_path)
+            raise
+    try:
+        with open(tmp_path, 'rb') as gzipped_file:
+            store.put_file(gzipped_file, key)
+    finally:
+        os.remove(tmp_path)
+
+
+def open_archive_object(key: str, compressed: bool):
+    """
+    A readable binary file of the original bytes of an archived backup.
+    """
+    archive_file = get_object_store().open(key)
+    if compressed:
+        return gzip.GzipFile(fileobj=archive_file, mode='rb')
+    return archive_file
+
+
+def delete_archive_object(key: str):
+    get_object_store().delete(key)
+
+
+def backup_opener(backup: Backup):
+    """
+    A function that opens the backup's bytes as a readable binary file that can be seeked around in: its own file in
+    the hot store, its chunks in the chunk store, or its archive object if that's an uncompressed file in a local store.
+    None if it has to be recalled first.
+    """
+    if backup.storage_tier == HOT_TIER:
+        store, name = get_hot_store(), backup.file.name
+        return lambda: store.open_seekable(name)
+    if backup.is_chunked:
+        try:
+            chunks = backup.manifest.chunks
+        except BackupManifest.DoesNotExist:
+            return None
+        return lambda: open_chunked(chunks)
+    path = get_object_store().local_path(backup.archive_key)
+    if not backup.archive_compressed and path and os.path.isfile(path):
+        return lambda: open(path, 'rb')
+    return None
+
+
+def archive_backup(backup: Backup) -> bool:
+    """
+    Move a backup from the hot tier or the chunk store to the archive tier. Its row keeps pointing at it through
+    archive_key, and its manifest stays so a recall can put it back into the chunk store the same way. Returns False if
+    it was archived already (or went in the meantime).
+    """
+    from_tier = backup.storage_tier
+    if from_tier == ARCHIVE_TIER:
+        return False
+
+    if backup.archive_key and get_object_store().exists(backup.archive_key):
+        # recalled earlier, its copy there is still good
+        key, compress = backup.archive_key, backup.archive_compressed
+    else:
+        # backups with the same content share an archive object, named after the sha256 of their bytes
+        with backup_opener(backup)() as file:
+            digest = content_digest(backup, file)
+            record_missing_checksum(backup, digest)
+            file.seek(0)
+            compress = settings.ARCHIVE_COMPRESSION and worth_compressing(file)
+            file.seek(0)
+            key = f"{CONTENT_ALGORITHM}/{digest[:2]}/{digest}{'.gz' if compress else ''}"
+            put_archive_object(file, key, compress)
+
+    with transaction.atomic():
+        if not Backup.objects.filter(pk=backup.pk, storage_tier=from_tier).update(
+                storage_tier=ARCHIVE_TIER, archive_key=key, archive_compressed=compress, archived_at=timezone.now()):
+            return False
+        if from_tier == CHUNK_TIER:
+            release_chunks(backup)
+    backup.storage_tier = ARCHIVE_TIER
+
+    if from_tier == HOT_TIER:
+        remove_hot_file(backup)
+
+    logger.info(f"Archived backup '{backup.basename}'{' (compressed)' if compress else ''}.")
+    return True
+
+
+def recall_backup(backup: Backup) -> bool:
+    """
+    Bring an archived backup back: into the chunk store, split the way its manifest says, if it was there before it was
+    archived, otherwise to its own file in the hot store, from where it goes into the chunk store like a new upload. The
+    archive copy stays, so archiving it again later is free.
+    """
+    if not backup.is_archived:
+        return False
+
+    chunks = BackupManifest.objects.filter(backup=backup).values_list('chunks', flat=True).first()
+    if chunks:
+        if store_chunks(backup, lambda: open_archive_object(backup.archive_key, backup.archive_compressed),
+                        chunks, from_tier=ARCHIVE_TIER, recalled_at=timezone.now()) is None:
+            return False
+        logger.info(f"Recalled backup '{backup.basename}' from the archive into the chunk store.")
+        return True
+
+    with open_archive_object(backup.archive_key, backup.archive_compressed) as archive_file:
+        get_hot_store().put_file(archive_file, backup.file.name)
+
+    if not Backup.objects.filter(pk=backup.pk, storage_tier=ARCHIVE_TIER).update(storage_tier=HOT_TIER,
+                                                                                  recalled_at=timezone.now()):
+        return False
+    backup.storage_tier = HOT_TIER
+
+    from backups.tasks import enqueue_backup_index
+    enqueue_backup_index(backup)
+
+    logger.info(f"Recalled backup '{backup.basename}' from the archive.")
+    return True
+
+
+def archive_cold_backups() -> int:
+    """
+    Archive every backup that isn't archived yet and is older than its company's archive policy. Backups recalled in the last
+    ARCHIVE_RECALL_KEEP_DAYS days are left where they are. Returns how many were archived.
+    """
+    now = timezone.now()
+    recall_cutoff = now - timedelta(days=settings.ARCHIVE_RECALL_KEEP_DAYS)
+    archived = 0
+
+    for company in Company.objects.select_related('archive_policy'):
+        days = archive_after_days(company)
+        if days is None:
+            continue
+
+        backups = Backup.objects.filter(company=company, storage_tier__in=[HOT_TIER, CHUNK_TIER],
+                                        date_uploaded__lt=now - timedelta(days=days)).filter(
+            Q(recalled_at__isnull=True) | Q(recalled_at__lt=recall_cutoff))
+        for backup in list(backups):
+            try:
+                archived += archive_backup(backup)
+            except OSError as e:
+                logger.error(f"Could not archive backup '{backup.basename}'. Error: {e}")
+
+    return archived
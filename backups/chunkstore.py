@@ -0,0 +1,439 @@
+import io
+import os
+import json
+import uuid
+import bisect
+import hashlib
+import logging
+from itertools import accumulate
+from django.db import transaction
+from django.db.models import F
+from backups.models import CHUNK_TIER, HOT_TIER, Backup, BackupManifest, Chunk, CompanyChunk, UploadSession, \
+    chunk_path
+from backups.objectstore import get_hot_store, local_backups_root
+from backups.utils import remove_empty_parents
+
+logger = logging.getLogger(__name__)
+
+# Content-defined chunking parameters. Clients that want to send only the chunks the server doesn't have yet must
+# split their files exactly the same way, so these are advertised with the rest of the upload capabilities.
+MIN_CHUNK_SIZE = 16 * 1024
+AVG_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 256 * 1024
+WINDOW_SIZE = 64  # the top 16 bits of the gear hash depend on the last 64 bytes
+CUT_MASK = 0xFFFF << 48  # 16 bits -> a cut on average every 64KB
+HASH_MASK = (1 << 64) - 1
+READ_SIZE = 1024 * 1024
+BATCH_SIZE = 500  # stay under the database's limit on query parameters
+
+# what BackupManifest.sha256 and archive objects are keyed on
+CONTENT_ALGORITHM = 'sha256'
+
+
+def _gear_table() -> list[int]:
+    # 256 fixed pseudo-random 64 bit values; derived from sha256 so any client can rebuild the same table
+    return [int.from_bytes(hashlib.sha256(b'softrite-cdc-%d' % i).digest()[:8], 'big') for i in range(256)]
+
+
+GEAR = _gear_table()
+
+
+def cdc_parameters() -> dict:
+    return {
+        'algorithm': 'gear',
+        'gear_seed': 'softrite-cdc-<byte>',  # GEAR[b] = first 8 bytes (big endian) of sha256(seed)
+        'min_size': MIN_CHUNK_SIZE,
+        'avg_size': AVG_CHUNK_SIZE,
+        'max_size': MAX_CHUNK_SIZE,
+        'cut_mask': hex(CUT_MASK),
+        'digest': 'sha256',
+    }
+
+
+def parse_manifest(value) -> list:
+    """
+    Validate a list of [sha256, size] chunks sent by a client (a JSON string or already decoded). Raises ValueError.
+    """
+    try:
+        manifest = json.loads(value) if isinstance(value, str) else value
+        manifest = [[str(digest).lower(), int(size)] for digest, size in manifest]
+    except (ValueError, TypeError):
+        raise ValueError("must be a list of [sha256, size] pairs")
+    if any(len(digest) != 64 or size < 1 for digest, size in manifest):
+        raise ValueError("must be a list of [sha256, size] pairs")
+    return manifest
+
+
+def cut_point(buffer: bytearray) -> int:
+    """
+    Length of the chunk at the start of buffer. The gear rolling hash is updated for every byte after the minimum
+    chunk size and the chunk ends where its top bits are all zero, so boundaries only depend on the bytes around
+    them: an insert early in a file only changes the chunks it touches, everything after it lines up again.
+    """
+    length = len(buffer)
+    if length <= MIN_CHUNK_SIZE:
+        return length
+
+    limit = min(length, MAX_CHUNK_SIZE)
+    gear = GEAR
+    h = 0
+    for i in range(MIN_CHUNK_SIZE - WINDOW_SIZE, limit):
+        h = ((h << 1) + gear[buffer[i]]) & HASH_MASK
+        if i >= MIN_CHUNK_SIZE - 1 and not h & CUT_MASK:
+            return i + 1
+    return limit
+
+
+def iter_chunks(file):
+    """
+    Split a binary file object into content-defined chunks. Yields bytes.
+    """
+    buffer = bytearray()
+    eof = False
+    while True:
+        while not eof and len(buffer) < MAX_CHUNK_SIZE:
+            data = file.read(READ_SIZE)
+            if not data:
+                eof = True
+            buffer += data
+
+        if not buffer:
+            return
+
+        size = cut_point(buffer)
+        yield bytes(buffer[:size])
+        del buffer[:size]
+
+
+
+
+def iter_manifest_chunks(file, chunks: list):
+    """
+    Split a binary file object the way a manifest says it's split. Yields bytes, short at the end if the file is.
+    """
+    for digest, size in chunks:
+        data = file.read(size)
+        if not data:
+            return
+        yield data
+
+
+def batches(items: list):
+    for i in range(0, len(items), BATCH_SIZE):
+        yield items[i:i + BATCH_SIZE]
+
+
+class ChunkStoreError(Exception):
+    """
+    A backup's bytes don't match the chunks they're supposed to be made of.
+    """
+
+
+def put_chunk(digest: str, data: bytes) -> bool:
+    """
+    Write a chunk's bytes into the store, unless they're there already. Returns whether they were written.
+    """
+    path = chunk_path(digest)
+    if os.path.isfile(path):
+        return False
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp_path, 'wb') as chunk_file:
+            chunk_file.write(data)
+            chunk_file.flush()
+            os.fsync(chunk_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return True
+
+
+def read_chunk(chunk: Chunk) -> bytes:
+    with open(chunk.path, 'rb') as chunk_file:
+        return chunk_file.read()
+
+
+class ChunkedFile(io.RawIOBase):
+    """
+    The bytes of a backup in the chunk store as one seekable file: its manifest's chunks joined back together, each
+    read from the store when it's needed. Wrapped in a buffered reader by open_chunked.
+    """
+
+    def __init__(self, chunks: list):
+        super().__init__()
+        self.chunks = chunks
+        self.offsets = list(accumulate((size for digest, size in chunks), initial=0))  # where each chunk starts
+        self.position = 0
+        self.current = None, b''  # the chunk that was read last (index, bytes), reads are mostly sequential
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.offsets[-1]}[whence]
+        if start + offset < 0:
+            raise ValueError(f"Negative seek position {start + offset}.")
+        self.position = start + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.offsets[-1]:
+            return 0
+        index = bisect.bisect_right(self.offsets, self.position) - 1
+        data = self.chunk(index)
+        start = self.position - self.offsets[index]
+        length = min(len(buffer), len(data) - start)
+        buffer[:length] = data[start:start + length]
+        self.position += length
+        return length
+
+    def chunk(self, index: int) -> memoryview:
+        if self.current[0] != index:
+            digest, size = self.chunks[index]
+            with open(chunk_path(digest), 'rb') as chunk_file:
+                data = chunk_file.read()
+            if len(data) != size:
+                raise OSError(f"Chunk {digest} is {len(data)} bytes, expected {size}.")
+            self.current = index, memoryview(data)
+        return self.current[1]
+
+
+def open_chunked(chunks: list):
+    """
+    A readable, seekable binary file of the bytes a manifest's chunks make up.
+    """
+    return io.BufferedReader(ChunkedFile(chunks), buffer_size=MAX_CHUNK_SIZE)
+
+
+def content_digest(backup: Backup, file) -> str:
+    """
+    The sha256 of a backup's bytes (read from file if it has to be), as worked out by the server. Archive objects are
+    shared by every backup with the same content, whichever company it belongs to, so they're keyed on this and never
+    on the checksum the upload was verified with: that's md5 unless the client asked for something else, and two files
+    made to have the same md5 would otherwise let one company's backup turn into another company's bytes.
+    """
+    sha256 = BackupManifest.objects.filter(backup=backup).values_list('sha256', flat=True).first()
+    if sha256:  # worked out when it went into the chunk store
+        return sha256
+    if backup.checksum_algorithm == CONTENT_ALGORITHM and backup.checksum:  # computed while it was uploaded
+        return backup.checksum.lower()
+    hasher = hashlib.new(CONTENT_ALGORITHM)
+    while data := file.read(READ_SIZE):
+        hasher.update(data)
+    return hasher.hexdigest()
+
+
+def record_missing_checksum(backup: Backup, digest: str):
+    """
+    Backups uploaded before checksums were kept get their content digest as their checksum.
+    """
+    if not backup.checksum:
+        backup.checksum, backup.checksum_algorithm = digest, CONTENT_ALGORITHM
+        Backup.objects.filter(pk=backup.pk, checksum='').update(checksum=digest, checksum_algorithm=CONTENT_ALGORITHM)
+
+
+def store_chunks(backup: Backup, open_file, chunks: list = None, from_tier: str = HOT_TIER,
+                 **fields) -> BackupManifest | None:
+    """
+    Put a backup's bytes into the chunk store and make it a CHUNK_TIER backup, its manifest is all there is of it from
+    then on. open_file() opens the bytes for reading. They're split the way chunks says if that's known already (a
+    manifest upload, or a backup that was in the store before it was archived), otherwise with content-defined
+    chunking: a pure Python loop over every byte (a few MB a second), which is why the index_backup jobs are only run
+    by dedicated `manage.py run_jobs` workers (settings.WORKER_ONLY_JOBS), never by the web processes.
+
+    A chunk the store already has, from any backup of any company, isn't written again, only its refcount goes up.
+    fields are saved on the backup along with its new tier. Returns None if it wasn't on from_tier (anymore).
+    """
+    manifest = []
+    written = []
+    hasher = hashlib.new(CONTENT_ALGORITHM)
+    try:
+        with open_file() as file:
+            for data in iter_manifest_chunks(file, chunks) if chunks else iter_chunks(file):
+                digest = hashlib.sha256(data).hexdigest()
+                if chunks and digest != chunks[len(manifest)][0]:
+                    raise ChunkStoreError(f"Chunk {len(manifest)} of backup '{backup.basename}' doesn't match its "
+                                          f"manifest.")
+                if put_chunk(digest, data):
+                    written.append(digest)
+                hasher.update(data)
+                manifest.append([digest, len(data)])
+        size = sum(size for digest, size in manifest)
+        if size != backup.filesize or (chunks and len(manifest) != len(chunks)):
+            raise ChunkStoreError(f"Backup '{backup.basename}' is {size} bytes, expected {backup.filesize}.")
+
+        sizes = dict(manifest)  # each chunk once, however many times it's in the backup
+        with transaction.atomic():
+            backup_manifest = None
+            if Backup.objects.filter(pk=backup.pk, storage_tier=from_tier).update(storage_tier=CHUNK_TIER, **fields):
+                Chunk.objects.bulk_create([Chunk(digest=digest, size=size) for digest, size in sizes.items()],
+                                          ignore_conflicts=True, batch_size=BATCH_SIZE)
+                chunk_ids = []
+                for batch in batches(list(sizes)):
+                    Chunk.objects.filter(digest__in=batch).update(refcount=F('refcount') + 1)
+                    chunk_ids += Chunk.objects.filter(digest__in=batch).values_list('id', flat=True)
+                if backup.company_id:
+                    CompanyChunk.objects.bulk_create(
+                        [CompanyChunk(company_id=backup.company_id, chunk_id=chunk_id) for chunk_id in chunk_ids],
+                        ignore_conflicts=True, batch_size=BATCH_SIZE)
+                    for batch in batches(chunk_ids):
+                        CompanyChunk.objects.filter(company_id=backup.company_id, chunk_id__in=batch).update(
+                            refcount=F('refcount') + 1)
+                backup_manifest, _ = BackupManifest.objects.update_or_create(
+                    backup=backup, defaults={'chunks': manifest, 'sha256': hasher.hexdigest()})
+    except BaseException:
+        remove_unused_chunks(written)  # nothing else has them yet
+        raise
+    if backup_manifest is None:  # deleted, or moved to another tier, while it was being read
+        remove_unused_chunks(written)
+        return None
+
+    backup.storage_tier, backup.manifest = CHUNK_TIER, backup_manifest
+    for field, value in fields.items():
+        setattr(backup, field, value)
+    record_missing_checksum(backup, backup_manifest.sha256)
+
+    # a chunk that was seen here but let go of by the last backup that had it before this one took hold of it is gone
+    # again: write it back
+    missing = {digest for digest in sizes if not os.path.isfile(chunk_path(digest))}
+    if missing:
+        with open_file() as file:
+            for data in iter_manifest_chunks(file, manifest):
+                digest = hashlib.sha256(data).hexdigest()
+                if digest in missing:
+                    put_chunk(digest, data)
+
+    new_bytes = sum(sizes[digest] for digest in written)
+    logger.info(f"Stored backup '{backup.basename}' as {len(manifest)} chunks, {new_bytes} new bytes "
+                f"({backup.filesize - new_bytes} bytes already in the store).")
+    return backup_manifest
+
+
+def remove_hot_file(backup: Backup):
+    """
+    Remove a backup's own file from the hot store once its bytes are somewhere else (the chunk store or the archive),
+    and its folder if that left it empty.
+    """
+    store = get_hot_store()
+    try:
+        store.delete(backup.file.name)
+        path = store.local_path(backup.file.name)
+        if path is not None:
+            remove_empty_parents(os.path.dirname(path), local_backups_root())
+    except Exception as e:  # e.g. still open for a download on Windows, or the bucket can't be reached
+        logger.warning(f"Could not remove the file of backup '{backup.basename}' after moving it. Error: {e}")
+
+
+def store_backup_chunks(backup: Backup, chunks: list = None) -> BackupManifest | None:
+    """
+    Move a hot backup's file into the chunk store (see store_chunks). chunks defaults to its manifest if it has one
+    already, e.g. from a manifest upload.
+    """
+    if chunks is None:
+        chunks = BackupManifest.objects.filter(backup=backup).values_list('chunks', flat=True).first()
+    store, name = get_hot_store(), backup.file.name
+    backup_manifest = store_chunks(backup, lambda: store.open_seekable(name), chunks)
+    if backup_manifest is not None:
+        remove_hot_file(backup)
+    return backup_manifest
+
+
+def index_new_backups(limit: int = 20):
+    """
+    Move hot backups into the chunk store that haven't been yet (run as a job, see store_chunks), e.g. because their
+    index_backup job gave up.
+    """
+    for backup in Backup.objects.filter(storage_tier=HOT_TIER).order_by('date_uploaded')[:limit]:
+        try:
+            store_backup_chunks(backup)
+        except (OSError, ChunkStoreError) as e:
+            logger.error(f"Could not move backup '{backup.basename}' into the chunk store. Error: {e}")
+
+
+def release_chunks(backup: Backup):
+    """
+    Let go of the chunks a backup in the chunk store is made of, because it's being deleted or archived. Chunks that
+    no backup has anymore are deleted, their files once the transaction is committed.
+    """
+    chunks = BackupManifest.objects.filter(backup=backup).values_list('chunks', flat=True).first() or []
+    unused = []
+    with transaction.atomic():
+        for batch in batches(list({digest for digest, size in chunks})):
+            chunk_ids = list(Chunk.objects.filter(digest__in=batch).values_list('id', flat=True))
+            Chunk.objects.filter(id__in=chunk_ids).update(refcount=F('refcount') - 1)
+            if backup.company_id:
+                company_chunks = CompanyChunk.objects.filter(company_id=backup.company_id, chunk_id__in=chunk_ids)
+                company_chunks.update(refcount=F('refcount') - 1)
+                company_chunks.filter(refcount__lte=0).delete()
+            unused_chunks = Chunk.objects.filter(id__in=chunk_ids, refcount__lte=0)
+            unused += unused_chunks.values_list('digest', flat=True)
+            unused_chunks.delete()
+        if unused:
+            transaction.on_commit(lambda: remove_unused_chunks(unused))
+
+
+def remove_unused_chunks(digests: list):
+    """
+    Delete the files of the chunks out of digests that have no row (anymore), checked again right before: a backup
+    stored in the meantime may have taken one of them back.
+    """
+    used = set()
+    for batch in batches(list(digests)):
+        used.update(Chunk.objects.filter(digest__in=batch).values_list('digest', flat=True))
+    removed = 0
+    for digest in digests:
+        if digest not in used:
+            try:
+                os.remove(chunk_path(digest))
+                removed += 1
+            except FileNotFoundError:
+                pass
+    if removed:
+        logger.info(f"Removed {removed} unreferenced chunk(s) from the chunk store.")
+
+
+def known_chunks(company, digests) -> dict:
+    """
+    The chunks out of digests that the company already has, as {digest: Chunk}.
+    """
+    known = {}
+    for batch in batches(list(set(digests))):
+        for chunk in Chunk.objects.filter(companychunk__company=company, digest__in=batch):
+            known[chunk.digest] = chunk
+    return known
+
+
+def fill_known_chunks(session: UploadSession, staging_path: str) -> list[int]:
+    """
+    Copy the chunks of an upload that the server said it would fill in (session.filling) into the staging file,
+    straight from the chunk store. Returns the indexes that were filled in so they can be marked as received; any that
+    couldn't be (e.g. the company's last backup with them went in the meantime) are left for the client to send.
+    """
+    filling = set(session.filling)
+    known = known_chunks(session.company, [session.manifest[index][0] for index in filling])
+    filled = []
+    offset = 0
+    with open(staging_path, 'r+b') as staging_file:
+        for index, (digest, size) in enumerate(session.manifest):
+            chunk = known.get(digest)
+            if index in filling and chunk is not None and chunk.size == size:
+                try:
+                    data = read_chunk(chunk)
+                except OSError:
+                    data = b''
+                if len(data) == size and hashlib.sha256(data).hexdigest() == digest:
+                    staging_file.seek(offset)
+                    staging_file.write(data)
+                    filled.append(index)
+            offset += size
+    return filled
@@ -0,0 +1,138 @@
+"""
+Binary deltas between backups, so a client that already has one version of a backup only downloads what changed.
+
+Both sides are described by their content-defined chunks (backups/chunkstore.py): the server has a manifest for every
+indexed backup, a client describes the file it holds by sending its own [[sha256, size], ...] signature, split with
+the parameters from cdc_parameters(). Chunks that line up are copied from the client's file, the rest are sent.
+
+Delta file format (all integers unsigned 64 bit big endian):
+
+    b'SRDELTA1'
+    b'C' offset length      copy length bytes from the file the client has, starting at offset
+    b'L' length <bytes>     length bytes of new data
+    ...
+    b'E' size <sha256>      end: the rebuilt file is size bytes long and has this sha256 digest
+"""
+import os
+import json
+import time
+import uuid
+import struct
+import hashlib
+import logging
+from SoftriteAPI.settings import MEDIA_ROOT
+from backups.models import Backup
+
+logger = logging.getLogger(__name__)
+
+DELTAS_DIR = os.path.join(MEDIA_ROOT, 'deltas')
+DELTA_MAGIC = b'SRDELTA1'
+COPY = b'C'
+LITERAL = b'L'
+END = b'E'
+U64 = struct.Struct('>Q')
+READ_SIZE = 1024 * 1024
+
+
+def plan_delta(base_chunks: list, target_chunks: list) -> list[tuple]:
+    """
+    Work out how to build the target out of the base: a list of (COPY, base_offset, length) and
+    (LITERAL, target_offset, length) operations, with neighbouring operations merged.
+    """
+    base_offsets = {}
+    offset = 0
+    for digest, size in base_chunks:
+        base_offsets.setdefault((digest, size), offset)
+        offset += size
+
+    ops = []
+    target_offset = 0
+    for digest, size in target_chunks:
+        base_offset = base_offsets.get((digest, size))
+        if base_offset is not None:
+            if ops and ops[-1][0] == COPY and ops[-1][1] + ops[-1][2] == base_offset:
+                ops[-1] = (COPY, ops[-1][1], ops[-1][2] + size)
+            else:
+                ops.append((COPY, base_offset, size))
+        elif ops and ops[-1][0] == LITERAL:
+            ops[-1] = (LITERAL, ops[-1][1], ops[-1][2] + size)
+        else:
+            ops.append((LITERAL, target_offset, size))
+        target_offset += size
+    return ops
+
+
+def literal_bytes(ops: list[tuple]) -> int:
+    return sum(length for op, offset, length in ops if op == LITERAL)
+
+
+def write_delta(ops: list[tuple], open_target, target_size: int, target_sha256: str, delta_path: str):
+    tmp_path = f"{delta_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'wb') as delta_file, open_target() as target_file:
+        delta_file.write(DELTA_MAGIC)
+        for op, offset, length in ops:
+            if op == COPY:
+                delta_file.write(COPY + U64.pack(offset) + U64.pack(length))
+                continue
+            delta_file.write(LITERAL + U64.pack(length))
+            target_file.seek(offset)
+            remaining = length
+            while remaining > 0:
+                data = target_file.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise OSError("The target is shorter than its manifest.")
+                delta_file.write(data)
+                remaining -= len(data)
+        delta_file.write(END + U64.pack(target_size) + bytes.fromhex(target_sha256))
+    os.replace(tmp_path, delta_path)
+
+
+def target_sha256(target: Backup, open_target) -> str:
+    """
+    The sha256 of the whole target, for the client to check the file it rebuilt. Worked out from the chunks already
+    hashed in its manifest would be wrong (that's a hash of hashes), so it's the one recorded when the target went into
+    the chunk store, or the file is read, but only once per cached delta.
+    """
+    if target.manifest.sha256:
+        return target.manifest.sha256
+    if target.checksum_algorithm == 'sha256' and target.checksum:
+        return target.checksum
+    hasher = hashlib.sha256()
+    with open_target() as target_file:
+        while data := target_file.read(READ_SIZE):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def cached_delta(base_chunks: list, target: Backup, open_target) -> tuple[str, list[tuple]]:
+    """
+    Path of the delta from base_chunks to target, made if it isn't in the cache yet, and its operations. Deltas are
+    cached by the content of both sides, so every client restoring the same pair of versions shares one. open_target()
+    opens the target's bytes (see backup_opener).
+    """
+    target_chunks = target.manifest.chunks
+    key = hashlib.sha256(json.dumps([base_chunks, target_chunks]).encode()).hexdigest()
+    delta_path = os.path.join(DELTAS_DIR, f"{key}.delta")
+    ops = plan_delta(base_chunks, target_chunks)
+
+    if os.path.isfile(delta_path):
+        os.utime(delta_path)  # keep it in the cache while it's being used
+        return delta_path, ops
+
+    os.makedirs(DELTAS_DIR, exist_ok=True)
+    write_delta(ops, open_target, target.filesize, target_sha256(target, open_target), delta_path)
+    logger.info(f"Made a delta for backup '{target.basename}': {literal_bytes(ops)} of {target.filesize} bytes "
+                f"are new.")
+    return delta_path, ops
+
+
+def cleanup_deltas(max_age: int):
+    """
+    Delete cached deltas that haven't been used in max_age seconds.
+    """
+    if not os.path.isdir(DELTAS_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(DELTAS_DIR):
+        if entry.is_file() and entry.stat().st_mtime < cutoff:
+            os.remove(entry.path)
@@ -0,0 +1,250 @@
+import os
+import re
+import uuid
+import mimetypes
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, \
+    StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe, parse_etags
+from backups.models import Backup, BackupManifest
+from backups.archive import open_archive_object
+from backups.chunkstore import open_chunked
+from backups.objectstore import get_hot_store, get_object_store
+
+READ_SIZE = 1024 * 1024  # stream ranges 1MB at a time
+MAX_RANGES = 20  # more ranges than this in one request is abuse, not a restore client
+
+RANGE_RE = re.compile(r'^\s*(\d*)\s*-\s*(\d*)\s*$')
+
+
+def parse_range_header(header: str, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parse a 'Range: bytes=...' header into a list of (start, end) byte positions, end included. Returns None if the
+    header should be ignored (the whole file is sent) and an empty list if no range can be satisfied.
+    """
+    units, _, ranges_spec = header.partition('=')
+    if units.strip().lower() != 'bytes' or not ranges_spec:
+        return None
+
+    ranges = []
+    for spec in ranges_spec.split(','):
+        match = RANGE_RE.match(spec)
+        if not match or match.groups() == ('', ''):
+            return None  # malformed, RFC 9110 says to ignore the header
+        first, last = match.groups()
+        if first == '':  # suffix range, the last N bytes
+            length = int(last)
+            if length == 0:
+                continue
+            ranges.append((max(size - length, 0), size - 1))
+            continue
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, end))
+
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def backup_etag(backup: Backup, stat: os.stat_result | None) -> str:
+    """
+    Strong ETag from the digest recorded when the backup was uploaded, or a weak one from its size and modification
+    time for older backups that don't have one. Backups off the hot tier always have a digest, so no stat for them.
+    """
+    if backup.checksum:
+        return f'"{backup.checksum_algorithm or "md5"}-{backup.checksum}"'
+    return f'W/"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+
+
+def if_range_matches(request, etag: str, last_modified: int) -> bool:
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith('"'):  # strong comparison, weak ETags never match
+        return not etag.startswith('W/') and if_range == etag
+    if_range_date = parse_http_date_safe(if_range)
+    return if_range_date is not None and if_range_date >= last_modified
+
+
+def not_modified(request, etag: str) -> bool:
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    # If-None-Match uses weak comparison
+    return '*' in etags or etag.removeprefix('W/') in [tag.removeprefix('W/') for tag in etags]
+
+
+def content_disposition(filename: str) -> str:
+    try:
+        filename.encode('ascii')
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=utf-8''{quote(filename)}"
+
+
+def read_range(open_file, start: int, end: int):
+    with open_file() as file:
+        file.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            data = file.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def offload_response(path: str) -> HttpResponse:
+    """
+    Let the front-end server send the file. It handles Range requests itself, this process only checked who's asking.
+    'x-sendfile' (Apache mod_xsendfile, lighttpd, IIS modules) gets the file's path, 'x-accel-redirect' (nginx) gets
+    the URL of an internal location that maps onto the hot store's root (MEDIA_ROOT by default).
+    """
+    response = HttpResponse()
+    if settings.BACKUP_DOWNLOAD_OFFLOAD == 'x-accel-redirect':
+        relative_path = os.path.relpath(path, get_hot_store().root).replace(os.sep, '/')
+        response['X-Accel-Redirect'] = quote(settings.BACKUP_DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + relative_path)
+    else:
+        response['X-Sendfile'] = path
+    del response['Content-Type']  # let the front-end server set it from the file
+    return response
+
+
+def serve_hot_backup(request, backup: Backup) -> HttpResponse:
+    """
+    Send a backup's own file: from this server (see serve_backup_file) if the hot store is local, otherwise by
+    redirecting to a short lived link to it in the bucket, which handles ranges itself.
+    """
+    store = get_hot_store()
+    path = store.local_path(backup.file.name)
+    if path is not None:
+        return serve_backup_file(request, backup, path)
+    if not store.exists(backup.file.name):
+        raise FileNotFoundError(backup.file.name)
+    return HttpResponseRedirect(store.url(backup.file.name, backup.basename))
+
+
+def serve_backup_file(request, backup: Backup, path: str, offload: bool = True) -> HttpResponse:
+    """
+    Send a backup file with support for conditional requests (If-None-Match, If-Range) and byte ranges, so a broken
+    download can be resumed and a large file fetched in parallel pieces.
+    """
+    stat = os.stat(path)
+    offload_path = path if settings.BACKUP_DOWNLOAD_OFFLOAD and offload else None
+    return ranged_response(request, backup.basename, lambda: open(path, 'rb'), stat.st_size, backup_etag(backup, stat),
+                           int(stat.st_mtime), offload_path)
+
+
+def serve_chunked_backup(request, backup: Backup) -> HttpResponse:
+    """
+    Send a backup in the chunk store, its bytes put back together from its chunks as they're sent. Ranges work the
+    same as for a file, only the chunks they cover are read.
+    """
+    chunks = BackupManifest.objects.filter(backup=backup).values_list('chunks', flat=True).first()
+    if chunks is None:
+        raise FileNotFoundError(f"Backup '{backup.basename}' has no manifest.")
+    return ranged_response(request, backup.basename, lambda: open_chunked(chunks), backup.filesize,
+                           backup_etag(backup, None), int(backup.date_uploaded.timestamp()))
+
+
+def ranged_response(request, filename: str, open_file, size: int, etag: str, last_modified: int,
+                    offload_path: str = None) -> HttpResponse:
+    """
+    Answer a download of size bytes that open_file() opens for reading (seekable), see serve_backup_file. With
+    offload_path the front-end server sends the file at that path instead.
+    """
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+    if not_modified(request, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    ranges = None
+    if request.headers.get('Range') and if_range_matches(request, etag, last_modified):
+        ranges = parse_range_header(request.headers['Range'], size)
+
+    if offload_path:
+        response = offload_response(offload_path)
+    elif ranges == []:
+        response = HttpResponse(status=416)  # Range Not Satisfiable
+        response['Content-Range'] = f"bytes */{size}"
+    elif ranges and len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(read_range(open_file, start, end), status=206, content_type=content_type)
+        response['Content-Range'] = f"bytes {start}-{end}/{size}"
+        response['Content-Length'] = str(end - start + 1)
+    elif ranges:
+        response = multipart_range_response(open_file, ranges, size, content_type)
+    else:
+        response = FileResponse(open_file(), content_type=content_type)
+        response['Content-Length'] = str(size)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    response['Content-Disposition'] = content_disposition(filename)
+    return response
+
+
+def multipart_range_response(open_file, ranges: list[tuple[int, int]], size: int,
+                             content_type: str) -> StreamingHttpResponse:
+    boundary = uuid.uuid4().hex
+    headers = [(f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode() for start, end in ranges]
+    closing = f"\r\n--{boundary}--\r\n".encode()
+
+    def parts():
+        for i, (start, end) in enumerate(ranges):
+            yield (b"\r\n" if i else b"") + headers[i]
+            yield from read_range(open_file, start, end)
+        yield closing
+
+    length = sum(len(header) for header in headers) + 2 * (len(ranges) - 1) + len(closing) + \
+        sum(end - start + 1 for start, end in ranges)
+    response = StreamingHttpResponse(parts(), status=206, content_type=f"multipart/byteranges; boundary={boundary}")
+    response['Content-Length'] = str(length)
+    return response
+
+
+def read_archive_object(backup: Backup):
+    with open_archive_object(backup.archive_key, backup.archive_compressed) as archive_file:
+        while data := archive_file.read(READ_SIZE):
+            yield data
+
+
+def serve_archived_backup(request, backup: Backup) -> HttpResponse:
+    """
+    Send a backup straight from the archive tier. An uncompressed archive object is served like a hot file (ranges
+    and all, but never offloaded to nginx, it's outside the hot store) or, in an S3 store, by redirecting to a short
+    lived link to it. A compressed one is decompressed on the fly and can only be sent whole.
+    """
+    path = get_object_store().local_path(backup.archive_key)
+    if not backup.archive_compressed and path and os.path.isfile(path):
+        return serve_backup_file(request, backup, path,
+                                 offload=settings.BACKUP_DOWNLOAD_OFFLOAD != 'x-accel-redirect')
+
+    store = get_object_store()
+    if not backup.archive_compressed and store.remote:
+        return HttpResponseRedirect(store.url(backup.archive_key, backup.basename))
+
+    etag = backup_etag(backup, None)
+    if not_modified(request, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    filename = backup.basename
+    response = StreamingHttpResponse(read_archive_object(backup),
+                                     content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response['Content-Length'] = str(backup.filesize)
+    response['Accept-Ranges'] = 'none'
+    response['ETag'] = etag
+    response['Content-Disposition'] = content_disposition(filename)
+    return response
@@ -0,0 +1,169 @@
+import uuid
+import logging
+import threading
+from datetime import timedelta
+from django.conf import settings
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from backups.models import Job
+
+logger = logging.getLogger(__name__)
+
+JOB_HANDLERS = {}
+
+
+def job(kind: str):
+    """
+    Register a function as the handler for a kind of job. Handlers get the job's payload as keyword arguments and
+    should be safe to run more than once, a job is retried if its worker dies half way through.
+    """
+    def decorator(func):
+        JOB_HANDLERS[kind] = func
+        return func
+    return decorator
+
+
+def enqueue(kind: str, idempotency_key: str = None, delay: int = 0, **payload) -> Job:
+    """
+    Queue a job. If idempotency_key is given and a job with that key already exists, that job is returned instead.
+    """
+    run_after = timezone.now() + timedelta(seconds=delay)
+    if idempotency_key is None:
+        return Job.objects.create(kind=kind, payload=payload, run_after=run_after)
+
+    try:
+        with transaction.atomic():
+            return Job.objects.create(kind=kind, payload=payload, run_after=run_after,
+                                      idempotency_key=idempotency_key)
+    except IntegrityError:
+        return Job.objects.get(idempotency_key=idempotency_key)
+
+
+def claim_next_job(exclude_kinds=()) -> Job | None:
+    """
+    Take the next job that's due, other than the kinds in exclude_kinds. The status change is a conditional update,
+    so two workers can never claim the same job. The claim is marked with a token of its own (locked_by), anything
+    written about the job later is only written as long as the claim still holds.
+    """
+    now = timezone.now()
+    due = Job.objects.filter(status=Job.PENDING, run_after__lte=now).exclude(kind__in=exclude_kinds).values_list(
+        'id', flat=True)[:10]
+    for job_id in due:
+        token = uuid.uuid4().hex
+        if Job.objects.filter(id=job_id, status=Job.PENDING).update(status=Job.RUNNING, locked_at=now,
+                                                                    locked_by=token, attempts=F('attempts') + 1):
+            return Job.objects.get(id=job_id)
+    return None
+
+
+def retry_delay(attempts: int) -> int:
+    return settings.JOB_RETRY_DELAY * pow(2, attempts - 1)
+
+
+class Heartbeat(threading.Thread):
+    """
+    Refreshes a running job's locked_at every JOB_HEARTBEAT_INTERVAL seconds while its handler runs, so only jobs
+    whose worker is really gone look stale to requeue_stale_jobs, however long they take.
+    """
+
+    def __init__(self, queued_job: Job):
+        super().__init__(name=f"job-heartbeat-{queued_job.id}", daemon=True)
+        self.job_id = queued_job.id
+        self.token = queued_job.locked_by
+        self.stopped = threading.Event()
+
+    def beat(self) -> bool:
+        """
+        Returns False once the job isn't ours anymore.
+        """
+        return bool(Job.objects.filter(id=self.job_id, status=Job.RUNNING, locked_by=self.token).update(
+            locked_at=timezone.now()))
+
+    def run(self):
+        try:
+            while not self.stopped.wait(settings.JOB_HEARTBEAT_INTERVAL):
+                try:
+                    if not self.beat():
+                        return
+                except DatabaseError as e:  # e.g. SQLite busy, the next beat may get through
+                    logger.warning(f"Could not refresh the lock on job #{self.job_id}. Error: {e}")
+        finally:
+            connections.close_all()  # this thread's own connections
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_job(queued_job: Job):
+    handler = JOB_HANDLERS.get(queued_job.kind)
+
+    heartbeat = Heartbeat(queued_job)
+    heartbeat.start()
+    try:
+        if handler is None:
+            raise LookupError(f"No handler registered for '{queued_job.kind}' jobs.")
+        handler(**queued_job.payload)
+    except Exception as e:
+        queued_job.last_error = f"{type(e).__name__}: {e}"
+        if queued_job.attempts >= settings.JOB_MAX_ATTEMPTS:
+            queued_job.status = Job.FAILED
+            queued_job.finished = timezone.now()
+            logger.error(f"Job {queued_job} failed for good after {queued_job.attempts} attempts. "
+                         f"Error: {queued_job.last_error}")
+        else:
+            queued_job.status = Job.PENDING
+            queued_job.run_after = timezone.now() + timedelta(seconds=retry_delay(queued_job.attempts))
+            logger.warning(f"Job {queued_job} failed (attempt {queued_job.attempts}), retrying after "
+                           f"{queued_job.run_after}. Error: {queued_job.last_error}")
+    else:
+        queued_job.status = Job.DONE
+        queued_job.finished = timezone.now()
+    finally:
+        heartbeat.stop()
+
+    # only if the claim still holds: a job that was taken back (e.g. its heartbeats couldn't get through) may be
+    # running on another worker now, that one gets to say how it went
+    if not Job.objects.filter(id=queued_job.id, locked_by=queued_job.locked_by).update(
+            status=queued_job.status, run_after=queued_job.run_after, locked_at=None, locked_by='',
+            last_error=queued_job.last_error, finished=queued_job.finished):
+        logger.warning(f"Job {queued_job} was re-queued while it ran, not recording how this run went.")
+
+
+def requeue_stale_jobs():
+    """
+    Put jobs whose worker died while running them back in the queue.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_LOCK_TIMEOUT)
+    count = Job.objects.filter(status=Job.RUNNING, locked_at__lt=cutoff).update(status=Job.PENDING, locked_at=None,
+                                                                                locked_by='')
+    if count:
+        logger.warning(f"Re-queued {count} job(s) that were stuck running.")
+
+
+def purge_finished_jobs() -> int:
+    """
+    Delete jobs that were done more than JOB_RETENTION_DAYS ago, failed ones are kept to look into. Their idempotency
+    keys can be queued again after that, which handlers have to cope with anyway (see job()).
+    """
+    cutoff = timezone.now() - timedelta(days=settings.JOB_RETENTION_DAYS)
+    deleted, _ = Job.objects.filter(status=Job.DONE, finished__lt=cutoff).delete()
+    if deleted:
+        logger.info(f"Deleted {deleted} finished job(s).")
+    return deleted
+
+
+def run_pending_jobs(limit: int = 50, exclude_kinds=()) -> int:
+    """
+    Run up to `limit` due jobs, leaving the kinds in exclude_kinds for other workers. Returns how many were run.
+    """
+    requeue_stale_jobs()
+    count = 0
+    while count < limit:
+        queued_job = claim_next_job(exclude_kinds)
+        if queued_job is None:
+            break
+        run_job(queued_job)
+        count += 1
+    return count
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+from backups.models import HOT_TIER, Backup, Chunk
+from backups.chunkstore import ChunkStoreError, store_backup_chunks
+from backups.utils import convert_size
+
+
+def chunk_store_size() -> int:
+    return Chunk.objects.aggregate(size=Sum('size'))['size'] or 0
+
+
+class Command(BaseCommand):
+    help = "Move hot backups into the content-addressed chunk store now instead of waiting for the index_backup " \
+           "jobs, so the chunks they share with other backups only take up disk space once."
+
+    def handle(self, *args, **options):
+        stored = 0
+        stored_bytes = 0
+        store_size = chunk_store_size()
+
+        for backup in Backup.objects.filter(storage_tier=HOT_TIER).iterator():
+            if not backup.file.storage.exists(backup.file.name):
+                self.stderr.write(f"Skipping '{backup.basename}', its file is missing.")
+                continue
+
+            try:
+                manifest = store_backup_chunks(backup)
+            except (OSError, ChunkStoreError) as e:
+                self.stderr.write(f"Could not store '{backup.basename}'. Error: {e}")
+                continue
+
+            if manifest is not None:
+                stored += 1
+                stored_bytes += backup.filesize
+
+        saved = stored_bytes - (chunk_store_size() - store_size)
+        self.stdout.write(self.style.SUCCESS(f"Stored {stored} backup(s), saved {convert_size(saved)}."))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from backups.models import Backup, BackupDirectory, backup_company_code, backup_directory, parent_directory
+
+
+class Command(BaseCommand):
+    help = "Rebuild the folder index the file browser lists from (Backup.directory and BackupDirectory), e.g. after " \
+           "backup files were moved around on disk."
+
+    def handle(self, *args, **options):
+        paths = set()
+        moved = 0
+
+        for backup in Backup.objects.only('id', 'file', 'directory', 'company_code').iterator():
+            directory = backup_directory(backup.file.name)
+            if directory != backup.directory:
+                Backup.objects.filter(pk=backup.pk).update(
+                    directory=directory, company_code=backup_company_code(directory, backup.basename))
+                moved += 1
+            while directory:
+                paths.add(directory)
+                directory = parent_directory(directory)
+
+        with transaction.atomic():
+            known = set(BackupDirectory.objects.values_list('path', flat=True))
+            stale = list(known - paths)
+            for i in range(0, len(stale), 500):  # stay under the database's limit on query parameters
+                BackupDirectory.objects.filter(path__in=stale[i:i + 500]).delete()
+            BackupDirectory.objects.bulk_create([BackupDirectory(path=path, parent=parent_directory(path),
+                                                                 name=path.rpartition('/')[2])
+                                                 for path in paths - known], batch_size=500)
+
+        self.stdout.write(self.style.SUCCESS(f"{len(paths)} folder(s) indexed ({len(paths - known)} new, "
+                                             f"{len(stale)} removed), {moved} backup(s) had moved."))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from backups.retention import apply_retention
+from backups.utils import convert_size
+
+
+class Command(BaseCommand):
+    help = "Delete the backups that companies' retention policies don't keep. Runs daily on its own, use --dry-run " \
+           "to see what a policy would delete before turning it on."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help="Only report what would be deleted.")
+        parser.add_argument('--company', type=int, default=None, help="Only this company (id).")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        report = apply_retention(dry_run=dry_run, company_id=options['company'])
+
+        for company in report:
+            verb = "Would delete" if dry_run else "Deleted"
+            self.stdout.write(f"{company['company']}: {verb} {len(company['expired'])} backup(s), "
+                              f"{convert_size(company['freed'])}")
+            if dry_run:
+                for backup in company['expired']:
+                    uploaded = timezone.localtime(backup['date_uploaded']).strftime('%Y-%m-%d %H:%M')
+                    self.stdout.write(f"    {uploaded}  {convert_size(backup['filesize']):>10}  {backup['name']}")
+
+        total = sum(company['freed'] for company in report)
+        self.stdout.write(self.style.SUCCESS(f"{'Would free' if dry_run else 'Freed'} {convert_size(total)} across "
+                                             f"{len(report)} company(ies)."))
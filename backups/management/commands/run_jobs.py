@@ -0,0 +1,23 @@
+import time
+from django.core.management.base import BaseCommand
+from backups.jobs import run_pending_jobs
+
+
+class Command(BaseCommand):
+    help = "Run queued background jobs (deduplicating and indexing uploads, emails). The web processes run them on a " \
+           "schedule already, except the kinds in WORKER_ONLY_JOBS (chunk indexing), which need a dedicated worker " \
+           "running this. Also for draining the queue by hand."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run the jobs that are due and exit.")
+        parser.add_argument('--sleep', type=float, default=5, help="Seconds to wait when the queue is empty.")
+
+    def handle(self, *args, **options):
+        if options['once']:
+            count = run_pending_jobs(limit=10 ** 9)
+            self.stdout.write(self.style.SUCCESS(f"Ran {count} job(s)."))
+            return
+
+        while True:
+            if not run_pending_jobs():
+                time.sleep(options['sleep'])
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from backups.scrub import scrub_backups, scrub_report
+
+
+class Command(BaseCommand):
+    help = "Report the backups that failed their last integrity check, per company. The checks run daily on their " \
+           "own, use --run to check the backups that are due now."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--run', type=int, default=None, metavar='SECONDS',
+                            help="Verify due backups for up to this many seconds before reporting.")
+        parser.add_argument('--company', type=int, default=None, help="Only report on this company (id).")
+
+    def handle(self, *args, **options):
+        if options['run']:
+            verified, more = scrub_backups(options['run'])
+            self.stdout.write(f"Verified {verified} backup(s){', more are still due' if more else ''}.")
+
+        failures = 0
+        for company in scrub_report(options['company']):
+            self.stdout.write(f"{company['company']}: {company['verified']} of {company['total']} backup(s) verified, "
+                              f"{len(company['failed'])} failed")
+            for backup in company['failed']:
+                verified_at = timezone.localtime(backup['verified_at']).strftime('%Y-%m-%d %H:%M')
+                self.stdout.write(f"    {verified_at}  {backup['verify_status']:<8}  {backup['file']}: "
+                                  f"{backup['verify_error']}")
+            failures += len(company['failed'])
+
+        style = self.style.ERROR if failures else self.style.SUCCESS
+        self.stdout.write(style(f"{failures} backup(s) failed their last integrity check."))
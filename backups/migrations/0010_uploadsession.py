@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:58
+
+import backups.models
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0009_alter_comment_options'),
+        ('users', '0007_remove_profile_firstname_remove_profile_lastname_and_more'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('save_dir', models.CharField(blank=True, max_length=255)),
+                ('filesize', models.BigIntegerField()),
+                ('total_chunks', models.PositiveIntegerField()),
+                ('received', models.BinaryField(default=bytes)),
+                ('checksum', models.CharField(blank=True, max_length=128)),
+                ('comment', models.TextField(blank=True)),
+                ('status', models.CharField(choices=[('uploading', 'Uploading'), ('complete', 'Complete')], default='uploading', max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('expires', models.DateTimeField(default=backups.models.default_session_expiry)),
+                ('backup', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='backups.backup')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.company')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created'],
+            },
+        ),
+    ]
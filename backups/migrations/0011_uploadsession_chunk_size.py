@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0010_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='chunk_size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:00
+
+import backups.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0011_uploadsession_chunk_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='checksum',
+            field=models.CharField(blank=True, max_length=128),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='checksum_algorithm',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='checksum_algorithm',
+            field=models.CharField(choices=[('md5', 'MD5'), ('sha256', 'SHA-256'), ('blake2b', 'BLAKE2b')], default=backups.models.default_checksum_algorithm, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='chunk_checksums',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='hashed_offset',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0014_blob'),
+        ('users', '0007_remove_profile_firstname_remove_profile_lastname_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='manifest',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='BackupManifest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('chunks', models.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('backup', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='manifest', to='backups.backup')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Chunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64)),
+                ('size', models.IntegerField()),
+                ('offset', models.BigIntegerField()),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backups.blob')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.company')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('company', 'digest'), name='unique_company_chunk')],
+            },
+        ),
+    ]
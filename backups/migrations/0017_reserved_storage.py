@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0016_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='reserved_storage',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='backup',
+            name='filesize',
+            field=models.BigIntegerField(),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0017_reserved_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='zip_indexed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ZipMember',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=1024)),
+                ('file_size', models.BigIntegerField()),
+                ('compress_size', models.BigIntegerField()),
+                ('crc', models.BigIntegerField()),
+                ('header_offset', models.BigIntegerField()),
+                ('compress_type', models.PositiveSmallIntegerField()),
+                ('flag_bits', models.PositiveIntegerField(default=0)),
+                ('date_time', models.DateTimeField(blank=True, null=True)),
+                ('backup', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='zip_members', to='backups.backup')),
+            ],
+            options={
+                'ordering': ['name'],
+                'indexes': [models.Index(fields=['backup', 'name'], name='zipmember_backup_name_idx')],
+            },
+        ),
+    ]
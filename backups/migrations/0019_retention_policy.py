@@ -0,0 +1,40 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0018_zip_index'),
+        ('users', '0009_company_reserved_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionPolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enabled', models.BooleanField(default=True)),
+                ('keep_daily', models.PositiveIntegerField(default=7)),
+                ('keep_weekly', models.PositiveIntegerField(default=4)),
+                ('keep_monthly', models.PositiveIntegerField(default=12)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'retention policies',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['company', '-date_uploaded'], name='backup_company_date_idx'),
+        ),
+        migrations.AddField(
+            model_name='retentionpolicy',
+            name='company',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='retention_policy', to='users.company'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0019_retention_policy'),
+        ('users', '0009_company_reserved_storage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='archive_compressed',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='archive_key',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='recalled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='storage_tier',
+            field=models.CharField(choices=[('hot', 'Hot'), ('archive', 'Archive')], default='hot', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='ArchivePolicy',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('enabled', models.BooleanField(default=True)),
+                ('archive_after_days', models.PositiveIntegerField(default=90)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('company', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='archive_policy', to='users.company')),
+            ],
+            options={
+                'verbose_name_plural': 'archive policies',
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0020_archive_tier'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_key',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_upload_id',
+            field=models.CharField(blank=True, max_length=1024),
+        ),
+    ]
@@ -0,0 +1,72 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:26
+
+import os
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+# frozen copies of backups.models.backup_directory and parent_directory as they were when this migration was written,
+# so later changes to those don't change what it does
+def backup_directory(file_path: str) -> str:
+    backups_root = os.path.join(settings.MEDIA_ROOT, 'backups')
+    directory = os.path.relpath(os.path.dirname(os.path.abspath(file_path)), backups_root)
+    if directory == '.' or directory.startswith('..'):  # not under MEDIA_ROOT/backups
+        return ''
+    return directory.replace(os.sep, '/')
+
+
+def parent_directory(path: str) -> str:
+    return path.rpartition('/')[0]
+
+
+def index_directories(apps, schema_editor):
+    Backup = apps.get_model('backups', 'Backup')
+    BackupDirectory = apps.get_model('backups', 'BackupDirectory')
+
+    paths = set()
+    changed = []
+    for backup in Backup.objects.only('id', 'file').iterator(chunk_size=BATCH_SIZE):
+        backup.directory = directory = backup_directory(backup.file.path)
+        changed.append(backup)
+        if len(changed) == BATCH_SIZE:
+            Backup.objects.bulk_update(changed, ['directory'])
+            changed = []
+        while directory:
+            paths.add(directory)
+            directory = parent_directory(directory)
+    Backup.objects.bulk_update(changed, ['directory'])
+
+    BackupDirectory.objects.bulk_create([BackupDirectory(path=path, parent=parent_directory(path),
+                                                         name=path.rpartition('/')[2]) for path in paths],
+                                        batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0021_multipart_upload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupDirectory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=1024, unique=True)),
+                ('parent', models.CharField(db_index=True, max_length=1024)),
+                ('name', models.CharField(max_length=255)),
+            ],
+            options={
+                'verbose_name_plural': 'backup directories',
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='directory',
+            field=models.CharField(blank=True, db_index=True, max_length=1024),
+        ),
+        migrations.RunPython(index_directories, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:27
+
+from django.conf import settings
+import os
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+# a frozen copy of backups.models.backup_company_code as it was when this migration was written, so later changes to
+# it don't change what it does
+def backup_company_code(directory: str, basename: str) -> str:
+    segments = directory.split('/')
+    if len(segments) < 2:
+        return ''
+    code = segments[1].lower()
+    return code if code in basename.lower() else ''
+
+
+def fill_company_codes(apps, schema_editor):
+    Backup = apps.get_model('backups', 'Backup')
+    changed = []
+    for backup in Backup.objects.only('id', 'directory', 'file').iterator(chunk_size=BATCH_SIZE):
+        backup.company_code = backup_company_code(backup.directory, os.path.basename(backup.file.name))
+        if backup.company_code:
+            changed.append(backup)
+        if len(changed) == BATCH_SIZE:
+            Backup.objects.bulk_update(changed, ['company_code'])
+            changed = []
+    Backup.objects.bulk_update(changed, ['company_code'])
+
+
+def analyze(apps, schema_editor):
+    # without table statistics SQLite walks the (company, date) index for code lookups instead of the new one
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('ANALYZE backups_backup')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0022_backup_directories'),
+        ('users', '0009_company_reserved_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='company_code',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['company', 'company_code', '-date_uploaded'], name='backup_company_code_idx'),
+        ),
+        migrations.RunPython(fill_company_codes, migrations.RunPython.noop),
+        migrations.RunPython(analyze, migrations.RunPython.noop),
+    ]
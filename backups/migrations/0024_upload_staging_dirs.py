@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:35
+
+import os
+import backups.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+def move_staging_files(apps, schema_editor):
+    """
+    Staging files used to sit side by side in MEDIA_ROOT/uploads as <session id>.upload. Move the ones of sessions
+    that can still be resumed into their session's directory, the rest were only waiting to be swept.
+    """
+    UploadSession = apps.get_model('backups', 'UploadSession')
+    uploads_dir = os.path.join(settings.MEDIA_ROOT, 'uploads')
+    if not os.path.isdir(uploads_dir):
+        return
+
+    sessions = {str(session_id) for session_id in UploadSession.objects.values_list('id', flat=True)}
+    for entry in os.scandir(uploads_dir):
+        session_id, ext = os.path.splitext(entry.name)
+        if not entry.is_file() or ext != '.upload':
+            continue
+        if session_id in sessions:
+            os.makedirs(os.path.join(uploads_dir, session_id), exist_ok=True)
+            os.replace(entry.path, os.path.join(uploads_dir, session_id, 'upload'))
+        else:
+            os.remove(entry.path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0023_company_code'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='uploadsession',
+            name='expires',
+            field=models.DateTimeField(db_index=True, default=backups.models.default_session_expiry),
+        ),
+        migrations.RunPython(move_staging_files, migrations.RunPython.noop),
+    ]
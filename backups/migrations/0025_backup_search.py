@@ -0,0 +1,87 @@
+import warnings
+from django.db import migrations, transaction
+from django.db.utils import OperationalError
+
+# backups_search is an SQLite FTS5 index with one row per backup (rowid = the backup's id). Triggers keep it in step
+# with backups_backup and backups_comment, so nothing in Python has to remember to update it. See backups/search.py
+COMMENTS = "(SELECT coalesce(group_concat(body, ' '), '') FROM backups_comment WHERE backup_id = {id})"
+# the file's name without the folders in front of it (they're in directory, and may start with MEDIA_ROOT): everything
+# after the last / (or \)
+PATH = "replace({file}, '\\', '/')"
+NAME = f"replace({PATH}, rtrim({PATH}, replace({PATH}, '/', '')), '')"
+
+CREATE_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE backups_search USING fts5(name, directory, company_code, comments, "
+    "tokenize = 'unicode61', prefix = '2 3')",
+
+    "INSERT INTO backups_search (rowid, name, directory, company_code, comments) "
+    f"SELECT id, {NAME.format(file='file')}, directory, company_code, {COMMENTS.format(id='backups_backup.id')} "
+    "FROM backups_backup",
+
+    "CREATE TRIGGER backups_search_backup_insert AFTER INSERT ON backups_backup BEGIN "
+    "INSERT INTO backups_search (rowid, name, directory, company_code, comments) "
+    f"VALUES (new.id, {NAME.format(file='new.file')}, new.directory, new.company_code, "
+    f"{COMMENTS.format(id='new.id')}); "
+    "END",
+
+    "CREATE TRIGGER backups_search_backup_update AFTER UPDATE OF file, directory, company_code ON backups_backup BEGIN "
+    f"UPDATE backups_search SET name = {NAME.format(file='new.file')}, directory = new.directory, "
+    "company_code = new.company_code WHERE rowid = new.id; "
+    "END",
+
+    "CREATE TRIGGER backups_search_backup_delete AFTER DELETE ON backups_backup BEGIN "
+    "DELETE FROM backups_search WHERE rowid = old.id; "
+    "END",
+
+    "CREATE TRIGGER backups_search_comment_insert AFTER INSERT ON backups_comment BEGIN "
+    f"UPDATE backups_search SET comments = {COMMENTS.format(id='new.backup_id')} WHERE rowid = new.backup_id; "
+    "END",
+
+    "CREATE TRIGGER backups_search_comment_update AFTER UPDATE OF body, backup_id ON backups_comment BEGIN "
+    f"UPDATE backups_search SET comments = {COMMENTS.format(id='old.backup_id')} WHERE rowid = old.backup_id; "
+    f"UPDATE backups_search SET comments = {COMMENTS.format(id='new.backup_id')} WHERE rowid = new.backup_id; "
+    "END",
+
+    "CREATE TRIGGER backups_search_comment_delete AFTER DELETE ON backups_comment BEGIN "
+    f"UPDATE backups_search SET comments = {COMMENTS.format(id='old.backup_id')} WHERE rowid = old.backup_id; "
+    "END",
+]
+
+DROP_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS backups_search_backup_insert",
+    "DROP TRIGGER IF EXISTS backups_search_backup_update",
+    "DROP TRIGGER IF EXISTS backups_search_backup_delete",
+    "DROP TRIGGER IF EXISTS backups_search_comment_insert",
+    "DROP TRIGGER IF EXISTS backups_search_comment_update",
+    "DROP TRIGGER IF EXISTS backups_search_comment_delete",
+    "DROP TABLE IF EXISTS backups_search",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # other databases (and SQLite builds without FTS5) search with icontains instead
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            for statement in CREATE_SEARCH_INDEX:
+                schema_editor.execute(statement)
+    except OperationalError as e:
+        warnings.warn(f"Not creating the backup search index, SQLite doesn't have FTS5: {e}")
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in DROP_SEARCH_INDEX:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0024_upload_staging_dirs'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
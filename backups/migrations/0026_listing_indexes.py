@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def analyze(apps, schema_editor):
+    # so SQLite's planner has statistics for the new indexes too (see 0023_company_code)
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute('ANALYZE backups_backup')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0025_backup_search'),
+        ('users', '0009_company_reserved_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='backup',
+            name='backup_company_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['company', '-date_uploaded', '-id'], name='backup_company_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['user', '-date_uploaded', '-id'], name='backup_user_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['-date_uploaded', '-id'], name='backup_date_idx'),
+        ),
+        migrations.RunPython(analyze, migrations.RunPython.noop),
+    ]
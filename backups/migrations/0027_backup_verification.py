@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:43
+
+from django.conf import settings
+from django.db import migrations, models
+
+# Adding the NOT NULL verify_* columns makes SQLite rebuild backups_backup (create a copy, drop the old table, rename),
+# which drops the triggers 0025_backup_search put on it, so the search index would stop following backups. They're
+# created again (as they were in 0025) once the columns are in.
+COMMENTS = "(SELECT coalesce(group_concat(body, ' '), '') FROM backups_comment WHERE backup_id = {id})"
+PATH = "replace({file}, '\\', '/')"
+NAME = f"replace({PATH}, rtrim({PATH}, replace({PATH}, '/', '')), '')"
+
+BACKUP_TRIGGERS = [
+    "CREATE TRIGGER IF NOT EXISTS backups_search_backup_insert AFTER INSERT ON backups_backup BEGIN "
+    "INSERT INTO backups_search (rowid, name, directory, company_code, comments) "
+    f"VALUES (new.id, {NAME.format(file='new.file')}, new.directory, new.company_code, "
+    f"{COMMENTS.format(id='new.id')}); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS backups_search_backup_update AFTER UPDATE OF file, directory, company_code "
+    "ON backups_backup BEGIN "
+    f"UPDATE backups_search SET name = {NAME.format(file='new.file')}, directory = new.directory, "
+    "company_code = new.company_code WHERE rowid = new.id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS backups_search_backup_delete AFTER DELETE ON backups_backup BEGIN "
+    "DELETE FROM backups_search WHERE rowid = old.id; "
+    "END",
+]
+
+
+def restore_search_triggers(apps, schema_editor):
+    connection = schema_editor.connection
+    # no index without FTS5 (see 0025), nothing to restore
+    if connection.vendor != 'sqlite' or 'backups_search' not in connection.introspection.table_names():
+        return
+    for statement in BACKUP_TRIGGERS:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0026_listing_indexes'),
+        ('users', '0009_company_reserved_storage'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backup',
+            name='verified_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='verify_error',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='backup',
+            name='verify_status',
+            field=models.CharField(blank=True, choices=[('ok', 'OK'), ('mismatch', 'Checksum mismatch'), ('bad_zip', 'Damaged zip'), ('missing', 'Missing'), ('error', 'Unreadable')], max_length=10),
+        ),
+        migrations.AddIndex(
+            model_name='backup',
+            index=models.Index(fields=['verified_at', 'id'], name='backup_verified_idx'),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:10
+
+import backups.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0027_backup_verification'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupSearch',
+            fields=[
+                ('backup', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='search', serialize=False, to='backups.backup')),
+                ('name', models.TextField()),
+                ('directory', models.TextField()),
+                ('company_code', models.TextField()),
+                ('comments', models.TextField()),
+                ('document', backups.models.SearchIndexField(db_column='backups_search')),
+            ],
+            options={
+                'db_table': 'backups_search',
+                'managed': False,
+            },
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:12
+
+from django.db import migrations, models
+
+
+# chunks used to be indexed once per company, in whichever blob had them first, so deleting that blob dropped them
+# from the index even though other backups still had them. Index every stored backup's chunks in its own blob.
+def index_chunks_per_blob(apps, schema_editor):
+    BackupManifest = apps.get_model('backups', 'BackupManifest')
+    Chunk = apps.get_model('backups', 'Chunk')
+    manifests = BackupManifest.objects.filter(backup__blob__isnull=False, backup__company__isnull=False)
+    for company_id, blob_id, chunks in manifests.values_list('backup__company_id', 'backup__blob_id',
+                                                             'chunks').iterator():
+        rows = []
+        offset = 0
+        for digest, size in chunks:
+            rows.append(Chunk(company_id=company_id, digest=digest, size=size, blob_id=blob_id, offset=offset))
+            offset += size
+        Chunk.objects.bulk_create(rows, ignore_conflicts=True, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0028_backup_search_model'),
+        ('users', '0010_clear_sent_email_bodies'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='chunk',
+            name='unique_company_chunk',
+        ),
+        migrations.AddConstraint(
+            model_name='chunk',
+            constraint=models.UniqueConstraint(fields=('company', 'digest', 'blob'), name='unique_company_blob_chunk'),
+        ),
+        migrations.RunPython(index_chunks_per_blob, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:14
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0029_chunk_per_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='locked_by',
+            field=models.CharField(blank=True, max_length=32),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:15
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0030_job_locked_by'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='uploadsession',
+            name='hashed_offset',
+        ),
+    ]
@@ -0,0 +1,77 @@
+import warnings
+import django.db.models.deletion
+from django.db import migrations, models, transaction
+from django.db.utils import OperationalError
+import backups.models
+
+# backups_name_search is an SQLite FTS5 index of the backups' file names (rowid = the backup's id) with the trigram
+# tokenizer, so the backup lists can find a name by any part of it. Triggers keep it in step with backups_backup. See
+# backups/search.py
+PATH = "replace({file}, '\\', '/')"
+NAME = f"replace({PATH}, rtrim({PATH}, replace({PATH}, '/', '')), '')"
+
+CREATE_NAME_SEARCH_INDEX = [
+    "CREATE VIRTUAL TABLE backups_name_search USING fts5(name, tokenize = 'trigram')",
+
+    f"INSERT INTO backups_name_search (rowid, name) SELECT id, {NAME.format(file='file')} FROM backups_backup",
+
+    "CREATE TRIGGER IF NOT EXISTS backups_name_search_insert AFTER INSERT ON backups_backup BEGIN "
+    f"INSERT INTO backups_name_search (rowid, name) VALUES (new.id, {NAME.format(file='new.file')}); "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS backups_name_search_update AFTER UPDATE OF file ON backups_backup BEGIN "
+    f"UPDATE backups_name_search SET name = {NAME.format(file='new.file')} WHERE rowid = new.id; "
+    "END",
+
+    "CREATE TRIGGER IF NOT EXISTS backups_name_search_delete AFTER DELETE ON backups_backup BEGIN "
+    "DELETE FROM backups_name_search WHERE rowid = old.id; "
+    "END",
+]
+
+DROP_NAME_SEARCH_INDEX = [
+    "DROP TRIGGER IF EXISTS backups_name_search_insert",
+    "DROP TRIGGER IF EXISTS backups_name_search_update",
+    "DROP TRIGGER IF EXISTS backups_name_search_delete",
+    "DROP TABLE IF EXISTS backups_name_search",
+]
+
+
+def create_name_search_index(apps, schema_editor):
+    # other databases (and SQLite without FTS5 or older than 3.34, which has no trigram tokenizer) use icontains
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        with transaction.atomic(using=schema_editor.connection.alias):
+            for statement in CREATE_NAME_SEARCH_INDEX:
+                schema_editor.execute(statement)
+    except OperationalError as e:
+        warnings.warn(f"Not creating the backup name index, SQLite doesn't have FTS5's trigram tokenizer: {e}")
+
+
+def drop_name_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        for statement in DROP_NAME_SEARCH_INDEX:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0031_remove_uploadsession_hashed_offset'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_name_search_index, drop_name_search_index),
+        migrations.CreateModel(
+            name='BackupNameSearch',
+            fields=[
+                ('backup', models.OneToOneField(db_column='rowid', on_delete=django.db.models.deletion.DO_NOTHING, primary_key=True, related_name='name_search', serialize=False, to='backups.backup')),
+                ('name', models.TextField()),
+                ('document', backups.models.SearchIndexField(db_column='backups_name_search')),
+            ],
+            options={
+                'db_table': 'backups_name_search',
+                'managed': False,
+            },
+        ),
+    ]
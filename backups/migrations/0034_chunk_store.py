@@ -0,0 +1,79 @@
+# Generated by Django 5.2.18 on 2026-10-17 03:05
+
+import os
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+# backup files used to be hard links to their blob, so the blobs can simply go. A backup whose own link went missing
+# gets it back from the blob first. The backups stay hot and move into the chunk store through the index_new_backups
+# job (their manifests, if they have one, are kept and used for that)
+def unlink_blobs(apps, schema_editor):
+    Backup = apps.get_model('backups', 'Backup')
+    Blob = apps.get_model('backups', 'Blob')
+    for blob in Blob.objects.iterator():
+        blob_path = os.path.join(settings.MEDIA_ROOT, 'blobs', blob.algorithm, blob.digest[:2], blob.digest)
+        if not os.path.isfile(blob_path):
+            continue
+        for name in Backup.objects.filter(blob=blob, storage_tier='hot').values_list('file', flat=True):
+            path = os.path.join(settings.MEDIA_ROOT, name)  # absolute names stay as they are
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.link(blob_path, path)
+        os.remove(blob_path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0033_uploadsession_filling'),
+        ('users', '0011_storage_counters_not_editable'),
+    ]
+
+    operations = [
+        migrations.RunPython(unlink_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='backup',
+            name='blob',
+        ),
+        migrations.DeleteModel(
+            name='Chunk',
+        ),
+        migrations.DeleteModel(
+            name='Blob',
+        ),
+        migrations.CreateModel(
+            name='Chunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('digest', models.CharField(max_length=64, unique=True)),
+                ('size', models.IntegerField()),
+                ('refcount', models.IntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CompanyChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('refcount', models.IntegerField(default=0)),
+                ('chunk', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='backups.chunk')),
+                ('company', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='users.company')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('company', 'chunk'), name='unique_company_chunk')],
+            },
+        ),
+        migrations.AddField(
+            model_name='backupmanifest',
+            name='sha256',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='backup',
+            name='storage_tier',
+            field=models.CharField(choices=[('hot', 'Hot'), ('chunks', 'Chunk store'), ('archive', 'Archive')],
+                                   default='hot', max_length=10),
+        ),
+    ]
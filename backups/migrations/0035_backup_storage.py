@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:52
+
+import os
+import backups.objectstore
+from django.conf import settings
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+
+def relative_names(apps, schema_editor):
+    """
+    Backup files were saved by absolute path, BackupStorage names are keys in the hot store, relative to MEDIA_ROOT
+    for the default local one.
+    """
+    Backup = apps.get_model('backups', 'Backup')
+    media_root = os.path.abspath(settings.MEDIA_ROOT)
+
+    changed = []
+    for backup in Backup.objects.only('id', 'file').iterator(chunk_size=BATCH_SIZE):
+        name = backup.file.name
+        if not os.path.isabs(name):
+            continue
+        relative = os.path.relpath(os.path.abspath(name), media_root)
+        if relative.startswith('..'):  # outside MEDIA_ROOT, there's nothing it could be a key of
+            continue
+        backup.file = relative.replace(os.sep, '/')
+        changed.append(backup)
+        if len(changed) == BATCH_SIZE:
+            Backup.objects.bulk_update(changed, ['file'])
+            changed = []
+    Backup.objects.bulk_update(changed, ['file'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('backups', '0034_chunk_store'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backup',
+            name='file',
+            field=models.FileField(storage=backups.objectstore.BackupStorage(), upload_to=''),
+        ),
+        migrations.RunPython(relative_names, migrations.RunPython.noop),
+    ]
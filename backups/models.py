@@ -1,11 +1,18 @@
 import os
-from django.db import models
-from datetime import datetime
+import uuid
+import posixpath
+from django.db import models, transaction
+from django.db.models import F
+from django.conf import settings
+from django.utils import timezone
+from datetime import datetime, timedelta
 from django.contrib.auth.models import User
 from django.core.files.storage import FileSystemStorage
 from users.models import Profile, Company
+from backups.objectstore import BackupStorage
 
 
+# Backup.file used to be stored here, old migrations still refer to it (see BackupStorage now)
 class MyFileStorage(FileSystemStorage):
     # This method is actually defined in the Storage class
     def get_available_name(self, name, max_length=None):
@@ -15,19 +22,129 @@ class MyFileStorage(FileSystemStorage):
         if self.exists(name):
             now = datetime.now().strftime('%m-%d-%Y at %H.%M.%S')
             name, ext = os.path.splitext(name)
-            return f"{name} ({now}){ext}"
+            candidate = f"{name} ({now}){ext}"
+            # FileSystemStorage._save opens the name with O_EXCL and asks again if it was taken in the meantime, so
+            # keep counting up instead of handing back the same timestamped name
+            attempt = 1
+            while self.exists(candidate):
+                attempt += 1
+                candidate = f"{name} ({now}) ({attempt}){ext}"
+            return candidate
         return name
 
 
-customFileStorage = MyFileStorage()
+backup_storage = BackupStorage()
+
+
+def backup_directory(name: str) -> str:
+    """
+    The folder a backup file is in, from its name in the hot store ('backups/Company/PAYROLL/file.zip'): relative to
+    backups/ and '/' separated (e.g. 'Company/PAYROLL'), the same on every OS. '' is the backups root.
+    """
+    directory = posixpath.relpath(posixpath.dirname(name.replace(os.sep, '/')), 'backups')
+    if directory == '.' or directory.startswith('..'):  # not under backups/
+        return ''
+    return directory
+
+
+def backup_company_code(directory: str, basename: str) -> str:
+    """
+    The Adaski company code of a backup, lower case. Adaski keeps every payroll company's backups in a folder named
+    after its code (MEDIA_ROOT/backups/<company>/<code>/...) and puts the code in the file name too. '' for backups
+    that aren't laid out like that, e.g. manual uploads.
+    """
+    segments = directory.split('/')
+    if len(segments) < 2:
+        return ''
+    code = segments[1].lower()
+    return code if code in basename.lower() else ''
+
+
+def parent_directory(path: str) -> str:
+    return path.rpartition('/')[0]
+
+
+class BackupDirectory(models.Model):
+    """
+    A folder in the backups tree that has backups somewhere under it, so the file browser can list a folder's
+    subfolders with one indexed query instead of walking the disk. Paths are like Backup.directory.
+    """
+    path = models.CharField(max_length=1024, unique=True)
+    parent = models.CharField(max_length=1024, db_index=True)
+    name = models.CharField(max_length=255)
+
+    class Meta:
+        ordering = ['name']
+        verbose_name_plural = 'backup directories'
+
+    def __str__(self):
+        return self.path
+
+    @classmethod
+    def add(cls, path: str):
+        """record path and every folder above it (the ones that aren't recorded yet)"""
+        while path and not cls.objects.filter(path=path).exists():
+            cls.objects.get_or_create(path=path, defaults={'parent': parent_directory(path),
+                                                           'name': path.rpartition('/')[2]})
+            path = parent_directory(path)
+
+    @classmethod
+    def prune(cls, path: str):
+        """remove path, and the folders above it, once there's nothing left in them"""
+        while path and not Backup.objects.filter(directory=path).exists() and \
+                not cls.objects.filter(parent=path).exists():
+            cls.objects.filter(path=path).delete()
+            path = parent_directory(path)
+
+
+# where a backup's bytes are: its own file (how every upload starts off), its chunks in the content-addressed chunk
+# store (see backups/chunkstore.py), or the archive (see backups/archive.py)
+HOT_TIER = 'hot'
+CHUNK_TIER = 'chunks'
+ARCHIVE_TIER = 'archive'
+STORAGE_TIER_CHOICES = [
+    (HOT_TIER, 'Hot'),
+    (CHUNK_TIER, 'Chunk store'),
+    (ARCHIVE_TIER, 'Archive'),
+]
+
+
+# what the last integrity check of a backup found (see backups/scrub.py)
+VERIFY_OK = 'ok'
+VERIFY_MISMATCH = 'mismatch'  # its bytes don't match its checksum anymore
+VERIFY_BAD_ZIP = 'bad_zip'
+VERIFY_MISSING = 'missing'
+VERIFY_ERROR = 'error'  # couldn't be read
+VERIFY_STATUS_CHOICES = [
+    (VERIFY_OK, 'OK'),
+    (VERIFY_MISMATCH, 'Checksum mismatch'),
+    (VERIFY_BAD_ZIP, 'Damaged zip'),
+    (VERIFY_MISSING, 'Missing'),
+    (VERIFY_ERROR, 'Unreadable'),
+]
 
 
 class Backup(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     company = models.ForeignKey(Company, on_delete=models.CASCADE, null=True)
-    file = models.FileField(storage=customFileStorage)
+    file = models.FileField(storage=backup_storage)
+    directory = models.CharField(max_length=1024, db_index=True, blank=True)  # see backup_directory()
+    company_code = models.CharField(max_length=255, blank=True)  # see backup_company_code()
     date_uploaded = models.DateTimeField(auto_now_add=True)
-    filesize = models.IntegerField()  # store the filesize in bytes
+    filesize = models.BigIntegerField()  # store the filesize in bytes
+    checksum = models.CharField(max_length=128, blank=True)  # digest of the file, computed while it was uploaded
+    checksum_algorithm = models.CharField(max_length=10, blank=True)
+    zip_indexed_at = models.DateTimeField(null=True, blank=True)  # when its zip members were last indexed
+    # a new backup's file is moved into the chunk store in the background, backups older than their company's archive
+    # policy are moved to the archive tier (see STORAGE_TIER_CHOICES)
+    storage_tier = models.CharField(max_length=10, choices=STORAGE_TIER_CHOICES, default=HOT_TIER)
+    archive_key = models.CharField(max_length=255, blank=True)  # where its copy is in the archive
+    archive_compressed = models.BooleanField(default=False)
+    archived_at = models.DateTimeField(null=True, blank=True)
+    recalled_at = models.DateTimeField(null=True, blank=True)  # last brought back from the archive
+    verified_at = models.DateTimeField(null=True, blank=True)  # last checked by the scrubber
+    verify_status = models.CharField(max_length=10, choices=VERIFY_STATUS_CHOICES, blank=True)
+    verify_error = models.TextField(blank=True)
 
     def __str__(self):
         return f"{self.company.name} Backup on {self.date_uploaded.strftime('%m-%d-%Y at %H:%M')}" \
@@ -35,40 +152,47 @@ class Backup(models.Model):
 
     class Meta:
         ordering = ["-date_uploaded"]
+        # every listing is newest first, filtered by company or user (or not at all, in the admin). id is in them for
+        # the pages of get_backups_list and the admin, which break ties on it, so no listing ever has to sort
+        indexes = [
+            models.Index(fields=['company', '-date_uploaded', '-id'], name='backup_company_date_idx'),
+            models.Index(fields=['user', '-date_uploaded', '-id'], name='backup_user_date_idx'),
+            models.Index(fields=['-date_uploaded', '-id'], name='backup_date_idx'),
+            models.Index(fields=['company', 'company_code', '-date_uploaded'], name='backup_company_code_idx'),
+            models.Index(fields=['verified_at', 'id'], name='backup_verified_idx'),  # the scrubber's queue
+        ]
 
     @property
     def basename(self):
         return os.path.basename(self.file.name)
 
     @property
-    def adaski_path(self):
-        # return the filepath of the backup but remove the MEDIA_ROOT from the beginning
-        return os.path.dirname(self.file.path).replace(
-            os.path.join(os.getcwd(), os.path.normpath('media/backups/')), '')
-
-    def save(self, *args, **kwargs):
-        self.filesize = self.file.size
-
-        self.company.used_storage += self.filesize
-        self.company.save()
+    def is_chunked(self):
+        return self.storage_tier == CHUNK_TIER
 
-        super().save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        if self.company.used_storage >= self.filesize:
-            self.company.used_storage -= self.filesize
-        else:
-            self.company.used_storage = 0
+    @property
+    def is_archived(self):
+        return self.storage_tier == ARCHIVE_TIER
 
-        self.company.save()
+    @property
+    def adaski_path(self):
+        # the backup's folder under backups/, in the server's path format
+        return os.sep + self.directory.replace('/', os.sep) if self.directory else ''
 
-        # this ended up being unnecessary because I'm using django-cleanup to automatically delete files
-        # when the model is deleted
-        """# check if file exists before deleting
-        if hasattr(self.file, 'storage') and self.file.storage.exists(self.file.name):
-            self.file.delete()"""
+    def save(self, *args, **kwargs):
+        if self.storage_tier == HOT_TIER:  # otherwise the file isn't there, filesize was set when it was stored
+            self.filesize = self.file.size
+        self.directory = backup_directory(self.file.name)
+        self.company_code = backup_company_code(self.directory, self.basename)
+        adding = self._state.adding
 
-        super().delete(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            BackupDirectory.add(self.directory)
+            # an F() update rather than read-modify-write, so concurrent uploads can't lose each other's bytes
+            # (the company's storage goes back down in the post_delete signal)
+            if adding and self.company_id:
+                Company.objects.filter(pk=self.company_id).update(used_storage=F('used_storage') + self.filesize)
 
 
 class Comment(models.Model):
@@ -84,3 +208,336 @@ class Comment(models.Model):
 
     def __str__(self):
         return f"Comment by {self.user.username} on {self.created.strftime('%m-%d-%Y at %H:%M')}"
+
+
+class SearchIndexField(models.TextField):
+    """
+    The hidden column an FTS5 table has under its own name. field__match=<query> is '<table> MATCH <query>'.
+    """
+
+
+@SearchIndexField.register_lookup
+class Match(models.Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs} MATCH {rhs}", [*lhs_params, *rhs_params]
+
+
+class BackupSearch(models.Model):
+    """
+    A backup's row in backups_search, the FTS5 index created and kept up to date by migration 0025_backup_search
+    (see backups/search.py). Not managed by Django, it's only here so a search can join backups to it.
+    """
+    backup = models.OneToOneField(Backup, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                  related_name='search')
+    name = models.TextField()
+    directory = models.TextField()
+    company_code = models.TextField()
+    comments = models.TextField()
+    document = SearchIndexField(db_column='backups_search')
+
+    class Meta:
+        managed = False
+        db_table = 'backups_search'
+
+
+class BackupNameSearch(models.Model):
+    """
+    A backup's row in backups_name_search, the trigram index of file names created and kept up to date by migration
+    0032_backup_name_search (see backups/search.py). Not managed by Django, like BackupSearch.
+    """
+    backup = models.OneToOneField(Backup, on_delete=models.DO_NOTHING, primary_key=True, db_column='rowid',
+                                  related_name='name_search')
+    name = models.TextField()
+    document = SearchIndexField(db_column='backups_name_search')
+
+    class Meta:
+        managed = False
+        db_table = 'backups_name_search'
+
+
+CHECKSUM_ALGORITHM_CHOICES = [
+    ('md5', 'MD5'),  # what older Adaski clients send
+    ('sha256', 'SHA-256'),
+    ('blake2b', 'BLAKE2b'),
+]
+
+
+def default_checksum_algorithm():
+    return settings.BACKUP_CHECKSUM_ALGORITHM
+
+
+def default_session_expiry():
+    return timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_MAX_AGE)
+
+
+class UploadSession(models.Model):
+    """
+    A resumable chunked upload. The chunks that have been received are recorded in the database (as a bitmap) so that
+    any worker can accept any chunk, and a client whose connection dropped can ask which chunks are still missing
+    instead of sending the whole file again.
+    """
+    UPLOADING = 'uploading'
+    ASSEMBLING = 'assembling'  # every chunk is in, one request is turning it into a backup
+    COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (UPLOADING, 'Uploading'),
+        (ASSEMBLING, 'Assembling'),
+        (COMPLETE, 'Complete'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    filename = models.CharField(max_length=255)
+    save_dir = models.CharField(max_length=255, blank=True)
+    filesize = models.BigIntegerField()  # expected size of the whole file in bytes
+    total_chunks = models.PositiveIntegerField()
+    chunk_size = models.BigIntegerField(null=True, blank=True)  # size of every chunk except the last one
+    # for uploads split by content-defined chunking, [[sha256, size], ...] of every chunk in file order
+    manifest = models.JSONField(null=True, blank=True)
+    received = models.BinaryField(default=bytes)  # bit i is set once chunk i has been stored
+    # chunks of a manifest upload that the company already has: the client doesn't send them, a fill_known_chunks job
+    # copies them into the staging file and marks them received (see backups/tasks.py)
+    filling = models.JSONField(default=list, blank=True)
+    checksum = models.CharField(max_length=128, blank=True)  # whole file checksum sent by the client
+    checksum_algorithm = models.CharField(max_length=10, choices=CHECKSUM_ALGORITHM_CHOICES,
+                                          default=default_checksum_algorithm)
+    chunk_checksums = models.JSONField(default=dict, blank=True)  # chunk index -> checksum of the chunk
+    # bytes of the company's storage held for this upload until it finishes (see backups/quota.py)
+    reserved_storage = models.BigIntegerField(default=0)
+    # uploads assembled straight in an S3 hot store (see backups/uploads.py): the object's key and the multipart
+    # upload its chunks are parts of
+    multipart_key = models.CharField(max_length=1024, blank=True)
+    multipart_upload_id = models.CharField(max_length=1024, blank=True)
+    comment = models.TextField(blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=UPLOADING)
+    backup = models.ForeignKey(Backup, on_delete=models.SET_NULL, null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(default=default_session_expiry, db_index=True)  # swept by cleanup_incomplete_uploads
+
+    class Meta:
+        ordering = ['-created']
+
+    def __str__(self):
+        return f"Upload of '{self.filename}' by {self.user.username} ({len(self.received_chunks())}/" \
+               f"{self.total_chunks} chunks)"
+
+    def has_chunk(self, index: int) -> bool:
+        byte, bit = divmod(index, 8)
+        bitmap = bytes(self.received)
+        return byte < len(bitmap) and bool(bitmap[byte] & (1 << bit))
+
+    def mark_chunk_received(self, index: int):
+        bitmap = bytearray(self.received)
+        byte, bit = divmod(index, 8)
+        if byte >= len(bitmap):
+            bitmap.extend(bytes(byte + 1 - len(bitmap)))
+        bitmap[byte] |= 1 << bit
+        self.received = bytes(bitmap)
+
+    def received_chunks(self) -> list[int]:
+        return [i for i in range(self.total_chunks) if self.has_chunk(i)]
+
+    def missing_chunks(self) -> list[int]:
+        return [i for i in range(self.total_chunks) if not self.has_chunk(i)]
+
+    def chunks_to_send(self) -> list[int]:
+        """the missing chunks the client has to send, the ones being filled in by the server aren't its job"""
+        filling = set(self.filling)
+        return [i for i in self.missing_chunks() if i not in filling]
+
+    def manifest_offset(self, index: int) -> int:
+        """where chunk `index` of a content-defined (manifest) upload starts"""
+        return sum(size for digest, size in self.manifest[:index])
+
+    @property
+    def contiguous_offset(self) -> int:
+        """number of bytes from the start of the file that have been received without gaps (tus 'Upload-Offset')"""
+        for i in range(self.total_chunks):
+            if not self.has_chunk(i):
+                if self.manifest:
+                    return self.manifest_offset(i)
+                return min(i * (self.chunk_size or 0), self.filesize)
+        return self.filesize
+
+    @property
+    def is_complete(self) -> bool:
+        return not self.missing_chunks()
+
+    @property
+    def is_expired(self) -> bool:
+        return self.expires <= timezone.now()
+
+    def touch(self):
+        """
+        Push the expiry date back (one UPDATE), an upload that is still receiving chunks shouldn't expire. Sessions
+        only expire UPLOAD_SESSION_MAX_AGE after their last chunk.
+        """
+        self.expires = default_session_expiry()
+        UploadSession.objects.filter(id=self.id).update(expires=self.expires)
+
+
+def chunk_path(digest: str) -> str:
+    # fanned out by the first two characters of the digest so no directory gets too big
+    return os.path.join(settings.MEDIA_ROOT, 'chunks', 'sha256', digest[:2], digest)
+
+
+class Chunk(models.Model):
+    """
+    A unique content-defined chunk in the chunk store (MEDIA_ROOT/chunks), its bytes stored once under their sha256
+    however many backups, of whichever companies, are made of it. refcount is how many backups that is; the chunk goes
+    once it drops to 0.
+    """
+    digest = models.CharField(max_length=64, unique=True)  # sha256
+    size = models.IntegerField()
+    refcount = models.IntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.digest} ({self.size} bytes, {self.refcount} reference{'s' if self.refcount != 1 else ''})"
+
+    @property
+    def path(self):
+        return chunk_path(self.digest)
+
+
+class CompanyChunk(models.Model):
+    """
+    A chunk that some of a company's backups are made of, so the chunks of a new upload (or a restore) that the company
+    already has don't have to be sent. Only a company's own chunks are ever offered to it, knowing a digest isn't
+    enough to get another company's bytes. refcount is how many of the company's backups have the chunk.
+    """
+    company = models.ForeignKey(Company, on_delete=models.CASCADE)
+    chunk = models.ForeignKey(Chunk, on_delete=models.CASCADE)
+    refcount = models.IntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['company', 'chunk'], name='unique_company_chunk'),
+        ]
+
+    def __str__(self):
+        return f"{self.chunk.digest} of {self.company.name}"
+
+
+class BackupManifest(models.Model):
+    """
+    The content-defined chunks a backup is made of, in order. Joining them gives back the exact original file, which
+    is all there is of a backup in the chunk store (CHUNK_TIER).
+    """
+    backup = models.OneToOneField(Backup, on_delete=models.CASCADE, related_name='manifest')
+    chunks = models.JSONField()  # [[sha256, size], ...]
+    sha256 = models.CharField(max_length=64, blank=True)  # of the whole file, worked out while it was chunked
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Manifest of {self.backup.basename} ({len(self.chunks)} chunks)"
+
+
+class ZipMember(models.Model):
+    """
+    One entry of a backup zip's central directory, so a single file can be listed and read out of the zip without
+    opening (or downloading) the whole archive. See backups/zipindex.py.
+    """
+    backup = models.ForeignKey(Backup, on_delete=models.CASCADE, related_name='zip_members')
+    name = models.CharField(max_length=1024)
+    file_size = models.BigIntegerField()  # uncompressed
+    compress_size = models.BigIntegerField()
+    crc = models.BigIntegerField()  # CRC-32 of the uncompressed data
+    header_offset = models.BigIntegerField()  # where the member's local file header starts in the zip
+    compress_type = models.PositiveSmallIntegerField()
+    flag_bits = models.PositiveIntegerField(default=0)
+    date_time = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['name']
+        indexes = [
+            models.Index(fields=['backup', 'name'], name='zipmember_backup_name_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} in {self.backup.basename}"
+
+    @property
+    def is_dir(self):
+        return self.name.endswith('/')
+
+
+class RetentionPolicy(models.Model):
+    """
+    Grandfather-father-son retention for a company's backups (see backups/retention.py). Within every folder the
+    newest backup of each of the last keep_daily days, keep_weekly weeks and keep_monthly months is kept, the rest
+    are deleted. Companies without a policy keep everything.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name='retention_policy')
+    enabled = models.BooleanField(default=True)
+    keep_daily = models.PositiveIntegerField(default=7)
+    keep_weekly = models.PositiveIntegerField(default=4)
+    keep_monthly = models.PositiveIntegerField(default=12)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'retention policies'
+
+    def __str__(self):
+        return f"{self.company.name}: {self.keep_daily} daily, {self.keep_weekly} weekly, {self.keep_monthly} monthly"
+
+
+class ArchivePolicy(models.Model):
+    """
+    How long a company's backups stay on the hot tier before they're moved to the archive. Companies without one use
+    settings.ARCHIVE_AFTER_DAYS.
+    """
+    company = models.OneToOneField(Company, on_delete=models.CASCADE, related_name='archive_policy')
+    enabled = models.BooleanField(default=True)
+    archive_after_days = models.PositiveIntegerField(default=90)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'archive policies'
+
+    def __str__(self):
+        return f"{self.company.name}: archive after {self.archive_after_days} days"
+
+
+class Job(models.Model):
+    """
+    A piece of background work (see backups/jobs.py). Jobs live in the database so they survive restarts and can be
+    picked up by whichever worker gets to them first.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict, blank=True)
+    # enqueueing a job with a key that's already queued (or done) doesn't add it again
+    idempotency_key = models.CharField(max_length=255, unique=True, null=True, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)  # when it was claimed, refreshed while it runs
+    locked_by = models.CharField(max_length=32, blank=True)  # the claim's token
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    finished = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['run_after']
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.kind} job #{self.id} ({self.status})"
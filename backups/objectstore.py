@@ -0,0 +1,405 @@
+"""
+Where backup bytes live, apart from the chunk store. Two stores, configured the same way:
+
+ - the hot store (settings.BACKUP_HOT_STORE): backups' own files, behind Backup.file through BackupStorage, and
+   with an S3 store, uploads assembled straight in the bucket
+ - the archive store (settings.BACKUP_OBJECT_STORE): archived backups (backups/archive.py)
+
+    {'BACKEND': 'local', 'OPTIONS': {'root': '/mnt/archive'}}
+    {'BACKEND': 's3', 'OPTIONS': {'bucket': 'backups', 'prefix': 'softrite/', 'endpoint_url': 'http://minio:9000',
+                                  'region_name': 'us-east-1', 'access_key': '...', 'secret_key': '...'}}
+
+Anything S3 compatible works (AWS, MinIO, or moto for tests). The s3 backend needs boto3, which is only imported when
+it's configured.
+"""
+import io
+import os
+import uuid
+import shutil
+import logging
+from datetime import datetime
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+
+logger = logging.getLogger(__name__)
+
+COPY_SIZE = 1024 * 1024
+MIN_PART_SIZE = 1024 * 1024 * 5  # S3 multipart parts have to be at least 5MB, except the last one
+MAX_PARTS = 10000
+
+
+class ObjectStoreError(Exception):
+    """raised when the object store can't do what was asked of it"""
+
+
+class LocalObjectStore:
+    """
+    Objects are files under root, named by their key.
+    """
+    remote = False
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def local_path(self, key: str) -> str:
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key: str) -> bool:
+        return os.path.isfile(self.local_path(key))
+
+    def size(self, key: str) -> int:
+        return os.path.getsize(self.local_path(key))
+
+    def put_file(self, source_file, key: str):
+        destination = self.local_path(key)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        tmp_path = f"{destination}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as object_file:
+                shutil.copyfileobj(source_file, object_file, COPY_SIZE)
+                object_file.flush()
+                os.fsync(object_file.fileno())  # callers delete their copy once this returns
+            os.replace(tmp_path, destination)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def create_exclusive(self, key: str) -> bool:
+        """
+        Create an empty object, unless there's one already. False if there is.
+        """
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            return False
+        return True
+
+    def copy(self, source_key: str, key: str):
+        with self.open(source_key) as source_file:
+            self.put_file(source_file, key)
+
+    def open(self, key: str):
+        return open(self.local_path(key), 'rb')
+
+    def open_seekable(self, key: str):
+        return self.open(key)
+
+    def read_range(self, key: str, start: int, end: int):
+        with open(self.local_path(key), 'rb') as object_file:
+            object_file.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                data = object_file.read(min(COPY_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.local_path(key))
+        except FileNotFoundError:
+            pass
+
+    def url(self, key: str, filename: str = None) -> str | None:
+        return None  # served by this process
+
+
+class S3ObjectStore:
+    """
+    Objects in an S3 (compatible) bucket, under prefix.
+    """
+    remote = True
+
+    def __init__(self, bucket: str, prefix: str = '', endpoint_url: str = None, region_name: str = None,
+                 access_key: str = None, secret_key: str = None, url_expiry: int = 60 * 15):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise ImproperlyConfigured("An object store uses the s3 backend, install boto3 for it.")
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.url_expiry = url_expiry
+        self.client_error = ClientError
+        self.client = boto3.client('s3', endpoint_url=endpoint_url, region_name=region_name,
+                                   aws_access_key_id=access_key, aws_secret_access_key=secret_key)
+
+    def object_key(self, key: str) -> str:
+        return f"{self.prefix}{key}"
+
+    def local_path(self, key: str) -> None:
+        return None
+
+    def head(self, key: str) -> dict | None:
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.object_key(key))
+        except self.client_error as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key: str) -> bool:
+        return self.head(key) is not None
+
+    def size(self, key: str) -> int:
+        head = self.head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return head['ContentLength']
+
+    def put_file(self, source_file, key: str):
+        # upload_fileobj switches to a multipart upload for big files by itself
+        self.client.upload_fileobj(source_file, self.bucket, self.object_key(key))
+
+    def create_exclusive(self, key: str) -> bool:
+        """
+        Create an empty object, unless there's one already (a conditional write, so two servers can't both get it).
+        False if there is.
+        """
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=self.object_key(key), Body=b'', IfNoneMatch='*')
+        except self.client_error as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412', 'ConditionalRequestConflict'):
+                return False
+            raise
+        return True
+
+    def copy(self, source_key: str, key: str):
+        # copied in the bucket, in parts for big objects
+        self.client.copy({'Bucket': self.bucket, 'Key': self.object_key(source_key)}, self.bucket,
+                         self.object_key(key))
+
+    def open(self, key: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self.object_key(key))['Body']
+        except self.client_error as e:
+            raise FileNotFoundError(key) from e
+
+    def open_seekable(self, key: str):
+        """
+        A readable, seekable binary file of the object, for zip listings and Range reads that shouldn't download all
+        of it.
+        """
+        head = self.head(key)
+        if head is None:
+            raise FileNotFoundError(key)
+        return io.BufferedReader(S3ObjectFile(self, key, head['ContentLength']), buffer_size=COPY_SIZE)
+
+    def read_range(self, key: str, start: int, end: int):
+        body = self.client.get_object(Bucket=self.bucket, Key=self.object_key(key), Range=f"bytes={start}-{end}")['Body']
+        with body:
+            yield from body.iter_chunks(COPY_SIZE)
+
+    def delete(self, key: str):
+        self.client.delete_object(Bucket=self.bucket, Key=self.object_key(key))
+
+    def url(self, key: str, filename: str = None) -> str:
+        """
+        A short lived link the client can download the object from directly (with Range requests and all).
+        """
+        params = {'Bucket': self.bucket, 'Key': self.object_key(key)}
+        if filename:
+            from backups.downloads import content_disposition
+            params['ResponseContentDisposition'] = content_disposition(filename)
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=self.url_expiry)
+
+    # multipart uploads, so a chunked upload is assembled in the bucket instead of on local disk
+
+    def start_multipart(self, key: str) -> str:
+        return self.client.create_multipart_upload(Bucket=self.bucket, Key=self.object_key(key))['UploadId']
+
+    def put_part(self, key: str, upload_id: str, part_number: int, data, size: int):
+        self.client.upload_part(Bucket=self.bucket, Key=self.object_key(key), UploadId=upload_id,
+                                PartNumber=part_number, Body=data, ContentLength=size)
+
+    def complete_multipart(self, key: str, upload_id: str, expected_size: int):
+        """
+        Join the uploaded parts into the object. The parts' ETags are listed from the store rather than kept
+        anywhere, since any worker may have received any part. Completing an upload that's already complete is fine.
+        """
+        parts = []
+        try:
+            for page in self.client.get_paginator('list_parts').paginate(Bucket=self.bucket, Key=self.object_key(key),
+                                                                          UploadId=upload_id):
+                parts += [{'PartNumber': part['PartNumber'], 'ETag': part['ETag']} for part in page.get('Parts', [])]
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.object_key(key), UploadId=upload_id,
+                                                  MultipartUpload={'Parts': sorted(parts,
+                                                                                   key=lambda p: p['PartNumber'])})
+        except self.client_error as e:
+            # a retry after the upload was completed (the upload id is gone)
+            if e.response['Error']['Code'] != 'NoSuchUpload' or not self.exists(key):
+                raise ObjectStoreError(f"Could not complete the multipart upload of '{key}': {e}") from e
+
+        if self.size(key) != expected_size:
+            raise ObjectStoreError(f"'{key}' is {self.size(key)} bytes after assembly, expected {expected_size}.")
+
+    def abort_multipart(self, key: str, upload_id: str):
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.object_key(key), UploadId=upload_id)
+        except self.client_error as e:
+            if e.response['Error']['Code'] != 'NoSuchUpload':  # already completed or aborted
+                logger.warning(f"Could not abort the multipart upload of '{key}'. Error: {e}")
+
+
+class S3ObjectFile(io.RawIOBase):
+    """
+    An object as a seekable file. Reads carry on from one GET while they're sequential, a seek elsewhere starts a
+    ranged GET from there. Wrapped in a buffered reader by S3ObjectStore.open_seekable.
+    """
+
+    def __init__(self, store: S3ObjectStore, key: str, size: int):
+        super().__init__()
+        self.store = store
+        self.key = key
+        self.size = size
+        self.position = 0
+        self.body, self.body_position = None, None  # the open GET and where it has got to
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        start = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: self.size}[whence]
+        if start + offset < 0:
+            raise ValueError(f"Negative seek position {start + offset}.")
+        self.position = start + offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        if self.body is None or self.body_position != self.position:
+            self.close_body()
+            self.body = self.store.client.get_object(Bucket=self.store.bucket, Key=self.store.object_key(self.key),
+                                                     Range=f"bytes={self.position}-")['Body']
+            self.body_position = self.position
+        data = self.body.read(len(buffer))
+        buffer[:len(data)] = data
+        self.position += len(data)
+        self.body_position = self.position
+        return len(data)
+
+    def close_body(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+    def close(self):
+        self.close_body()
+        super().close()
+
+
+BACKENDS = {
+    'local': LocalObjectStore,
+    's3': S3ObjectStore,
+}
+
+_object_stores: dict = {}
+
+
+def build_store(setting: str, default_root: str):
+    """
+    The store settings.<setting> describes, a local one's root defaulting to default_root. Made once per
+    configuration (an S3 client is slow to set up), a changed setting simply gets a store of its own.
+    """
+    config = getattr(settings, setting)
+    key = repr((setting, config, default_root))
+    if key not in _object_stores:
+        try:
+            backend = BACKENDS[config.get('BACKEND', 'local')]
+        except KeyError:
+            raise ImproperlyConfigured(f"Unknown {setting} backend '{config.get('BACKEND')}', use one of: "
+                                       f"{', '.join(BACKENDS)}")
+        options = config.get('OPTIONS', {})
+        if backend is LocalObjectStore:
+            options = {'root': default_root, **options}
+        _object_stores[key] = backend(**options)
+    return _object_stores[key]
+
+
+def get_object_store():
+    """
+    The archive store, see settings.BACKUP_OBJECT_STORE.
+    """
+    return build_store('BACKUP_OBJECT_STORE', settings.BACKUP_ARCHIVE_ROOT)
+
+
+def get_hot_store():
+    """
+    The store backups' own files are in, see settings.BACKUP_HOT_STORE. Keys are Backup.file names.
+    """
+    return build_store('BACKUP_HOT_STORE', settings.MEDIA_ROOT)
+
+
+def local_backups_root() -> str | None:
+    """
+    The folder backup files are in on this server, None if they're in a bucket.
+    """
+    return get_hot_store().local_path('backups')
+
+
+@deconstructible(path='backups.objectstore.BackupStorage')
+class BackupStorage(Storage):
+    """
+    The storage behind Backup.file: names are keys in the hot store (e.g. 'backups/<company>/<folder>/<file>.zip'),
+    whichever backend that is. The store is looked up on every call rather than kept, since it's settings that decide
+    it. Backup files are written whole (they're uploaded elsewhere and moved in), so they only open for reading.
+    """
+
+    @property
+    def store(self):
+        return get_hot_store()
+
+    def _open(self, name, mode='rb'):
+        if any(flag in mode for flag in 'wa+'):
+            raise ValueError("Backup files can only be opened for reading.")
+        return File(self.store.open_seekable(name), name)
+
+    def _save(self, name, content):
+        content.seek(0)
+        self.store.put_file(content, name)
+        return name
+
+    def delete(self, name):
+        self.store.delete(name)
+
+    def exists(self, name):
+        return self.store.exists(name)
+
+    def size(self, name):
+        return self.store.size(name)
+
+    def path(self, name):
+        path = self.store.local_path(name)
+        if path is None:
+            raise NotImplementedError("Backup files are in a bucket, they don't have a local path.")
+        return path
+
+    def url(self, name):
+        return self.store.url(name, os.path.basename(name))
+
+    def get_available_name(self, name, max_length=None):
+        if self.exists(name):
+            now = datetime.now().strftime('%m-%d-%Y at %H.%M.%S')
+            name, ext = os.path.splitext(name)
+            candidate = f"{name} ({now}){ext}"
+            attempt = 1
+            while self.exists(candidate):
+                attempt += 1
+                candidate = f"{name} ({now}) ({attempt}){ext}"
+            return candidate
+        return name
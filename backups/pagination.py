@@ -0,0 +1,43 @@
+import base64
+from datetime import datetime
+from django.db.models import Q
+
+MAX_PAGE_SIZE = 1000
+
+
+class InvalidCursor(Exception):
+    """raised when a cursor sent by a client can't be decoded"""
+
+
+def encode_cursor(value: datetime, row_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{value.isoformat()}|{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        value, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(value), int(row_id)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(f"Invalid cursor '{cursor}'.")
+
+
+def keyset_page(queryset, cursor: str | None, limit: int, field: str = 'date_uploaded',
+                descending: bool = True) -> tuple[list, str | None]:
+    """
+    One page of rows (a .values() queryset) ordered by field and id, newest first unless not descending, and the
+    cursor of the page after it (None on the last page). The cursor is the (field, id) of the last row sent, so every
+    page is an index range scan from where the last one ended, however deep into the history it is, and rows added in
+    the meantime don't shift the pages.
+    """
+    direction = '-' if descending else ''
+    beyond = 'lt' if descending else 'gt'
+    queryset = queryset.order_by(f"{direction}{field}", f"{direction}id")
+    if cursor:
+        value, row_id = decode_cursor(cursor)
+        queryset = queryset.filter(Q(**{f"{field}__{beyond}": value}) | Q(**{field: value, f"id__{beyond}": row_id}))
+
+    rows = list(queryset[:limit + 1])  # one more to know if there's a next page
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1][field], rows[-1]['id'])
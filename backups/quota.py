@@ -0,0 +1,90 @@
+import logging
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce, Greatest
+from backups.models import Backup, UploadSession
+from users.models import Company
+from backups.utils import convert_size
+
+logger = logging.getLogger(__name__)
+drift_logger = logging.getLogger('storage_drift')
+
+
+class StorageLimitExceeded(Exception):
+    """raised when an upload doesn't fit in what's left of its company's storage"""
+
+
+def storage_left(company: Company) -> int:
+    return company.max_storage - company.used_storage - company.reserved_storage
+
+
+def reserve_storage(company: Company, nbytes: int) -> bool:
+    """
+    Set nbytes of the company's storage aside for an upload. It's a single conditional UPDATE, so two uploads
+    starting at the same time can't both take the last of the free space. Returns False if it doesn't fit.
+    """
+    return bool(Company.objects.filter(
+        pk=company.pk, max_storage__gte=F('used_storage') + F('reserved_storage') + nbytes
+    ).update(reserved_storage=F('reserved_storage') + nbytes))
+
+
+def unreserve_storage(company_id: int, nbytes: int):
+    Company.objects.filter(pk=company_id).update(reserved_storage=Greatest(F('reserved_storage') - nbytes, 0))
+
+
+def release_session_storage(session: UploadSession):
+    """
+    Give back the storage an upload session reserved. The session's reservation is cleared with a conditional update
+    first, so calling this twice (or from two requests) only gives it back once.
+    """
+    with transaction.atomic():
+        if session.reserved_storage and UploadSession.objects.filter(
+                pk=session.pk, reserved_storage=session.reserved_storage).update(reserved_storage=0):
+            unreserve_storage(session.company_id, session.reserved_storage)
+    session.reserved_storage = 0
+
+
+def company_totals(queryset, field: str) -> dict:
+    """
+    {company_id: SUM(field)} for every company in queryset, in one GROUP BY query.
+    """
+    return dict(queryset.order_by().values('company_id').annotate(total=Sum(field)).values_list('company_id', 'total'))
+
+
+def reconcile_storage() -> list[dict]:
+    """
+    Check every company's storage counters against the backups and upload sessions it actually has, fix the ones that
+    have drifted and report them to the storage drift log. The counters are kept up to date as backups come and go,
+    so this is only a safety net: drift means something bypassed them (raw SQL, a crash half way through, ...).
+    Returns the drifted companies.
+    """
+    used = company_totals(Backup.objects.all(), 'filesize')
+    reserved = company_totals(UploadSession.objects.all(), 'reserved_storage')
+
+    drifted = []
+    for company_id, name, used_storage, reserved_storage in Company.objects.values_list(
+            'id', 'name', 'used_storage', 'reserved_storage'):
+        actual_used, actual_reserved = used.get(company_id) or 0, reserved.get(company_id) or 0
+        if (used_storage, reserved_storage) != (actual_used, actual_reserved):
+            drifted.append({'company_id': company_id, 'name': name,
+                            'used_storage': used_storage, 'actual_used_storage': actual_used,
+                            'reserved_storage': reserved_storage, 'actual_reserved_storage': actual_reserved})
+
+    if drifted:
+        # the totals are recalculated inside the UPDATE itself, so a backup committed since they were read above
+        # isn't lost
+        backup_total = Backup.objects.filter(company=OuterRef('pk')).order_by().values('company').annotate(
+            total=Sum('filesize')).values('total')
+        reserved_total = UploadSession.objects.filter(company=OuterRef('pk')).order_by().values('company').annotate(
+            total=Sum('reserved_storage')).values('total')
+        Company.objects.filter(pk__in=[row['company_id'] for row in drifted]).update(
+            used_storage=Coalesce(Subquery(backup_total), 0), reserved_storage=Coalesce(Subquery(reserved_total), 0))
+
+    for row in drifted:
+        drift_logger.warning(
+            f"Company '{row['name']}' (id {row['company_id']}): "
+            f"used storage was {convert_size(row['used_storage'])}, actually {convert_size(row['actual_used_storage'])} "
+            f"(off by {row['used_storage'] - row['actual_used_storage']} bytes); "
+            f"reserved storage was {row['reserved_storage']} bytes, actually {row['actual_reserved_storage']} bytes.")
+    drift_logger.info(f"Reconciled storage for {Company.objects.count()} companies, {len(drifted)} had drifted.")
+    return drifted
@@ -0,0 +1,93 @@
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from backups.models import Backup, RetentionPolicy
+from backups.utils import convert_size
+
+logger = logging.getLogger(__name__)
+
+
+def bucket_keys(date_uploaded):
+    local = timezone.localtime(date_uploaded)
+    year, week, _ = local.isocalendar()
+    return {
+        'daily': local.date(),
+        'weekly': (year, week),
+        'monthly': (local.year, local.month),
+    }
+
+
+def select_kept(backups: list, policy: RetentionPolicy) -> set:
+    """
+    The ids out of backups (newest first, one folder) that the policy keeps: the newest backup of each of the most
+    recent keep_daily days, keep_weekly weeks and keep_monthly months that have backups.
+    """
+    limits = {'daily': policy.keep_daily, 'weekly': policy.keep_weekly, 'monthly': policy.keep_monthly}
+    seen = {period: set() for period in limits}
+    kept = set()
+
+    for backup_id, date_uploaded in backups:
+        for period, key in bucket_keys(date_uploaded).items():
+            if key not in seen[period] and len(seen[period]) < limits[period]:
+                seen[period].add(key)
+                kept.add(backup_id)
+    return kept
+
+
+def plan_company_prune(policy: RetentionPolicy) -> list[dict]:
+    """
+    The backups of the policy's company that it doesn't keep. One query, on the (company, date_uploaded) index.
+    """
+    folders = {}
+    rows = Backup.objects.filter(company_id=policy.company_id).order_by('-date_uploaded').values_list(
+        'id', 'date_uploaded', 'file', 'filesize', 'directory')
+    for backup_id, date_uploaded, name, filesize, directory in rows:
+        # every folder is its own series (e.g. one per payroll system), retention never mixes them
+        folders.setdefault(directory, []).append((backup_id, date_uploaded, name, filesize))
+
+    expired = []
+    for folder_backups in folders.values():
+        kept = select_kept([(backup_id, date_uploaded) for backup_id, date_uploaded, *_ in folder_backups], policy)
+        expired += [{'id': backup_id, 'date_uploaded': date_uploaded, 'name': name, 'filesize': filesize}
+                    for backup_id, date_uploaded, name, filesize in folder_backups if backup_id not in kept]
+    return expired
+
+
+def delete_in_batches(backup_ids: list[int], batch_size: int) -> int:
+    """
+    Delete backups a batch at a time, each batch in its own short transaction so uploads aren't held up behind one
+    long delete. Files, chunks and quota are released by the usual delete signals (and django-cleanup).
+    """
+    deleted = 0
+    for i in range(0, len(backup_ids), batch_size):
+        with transaction.atomic():
+            for backup in Backup.objects.filter(id__in=backup_ids[i:i + batch_size]):
+                backup.delete()
+                deleted += 1
+    return deleted
+
+
+def apply_retention(dry_run: bool = False, company_id: int = None) -> list[dict]:
+    """
+    Evaluate every enabled retention policy and delete the backups they don't keep (or with dry_run, only report
+    them). Returns a report per company.
+    """
+    policies = RetentionPolicy.objects.filter(enabled=True).select_related('company')
+    if company_id:
+        policies = policies.filter(company_id=company_id)
+
+    report = []
+    for policy in policies:
+        if not (policy.keep_daily or policy.keep_weekly or policy.keep_monthly):
+            logger.warning(f"Retention policy for '{policy.company.name}' keeps nothing, ignoring it.")
+            continue
+
+        expired = plan_company_prune(policy)
+        freed = sum(backup['filesize'] for backup in expired)
+        if expired and not dry_run:
+            delete_in_batches([backup['id'] for backup in expired], settings.RETENTION_BATCH_SIZE)
+            logger.info(f"Retention removed {len(expired)} backup(s) of '{policy.company.name}', "
+                        f"freeing {convert_size(freed)}.")
+        report.append({'company': policy.company.name, 'expired': expired, 'freed': freed})
+    return report
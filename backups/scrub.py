@@ -0,0 +1,186 @@
+"""
+The integrity scrubber: every stored backup is read back now and then (at least every SCRUB_INTERVAL_DAYS) and its
+digest compared to the checksum recorded when it was uploaded, and its zip structure checked, so bit rot or a
+truncated file is found long before someone needs to restore it. What it found is kept on the backup (verified_at,
+verify_status, verify_error).
+
+Reads happen on a small pool of threads (SCRUB_WORKERS) that share one rate limit (SCRUB_RATE_LIMIT bytes a second),
+so the scrubber never crowds out uploads and downloads. Backups are taken least recently verified first, so after a
+restart it simply carries on with the ones it hadn't got to.
+"""
+import time
+import hashlib
+import logging
+import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import repeat
+from django.conf import settings
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from backups.models import ARCHIVE_TIER, VERIFY_BAD_ZIP, VERIFY_ERROR, VERIFY_MISMATCH, VERIFY_MISSING, VERIFY_OK, \
+    Backup
+from backups.archive import backup_opener, open_archive_object
+from backups.objectstore import get_object_store
+
+logger = logging.getLogger(__name__)
+
+READ_SIZE = 1024 * 1024
+
+
+class RateLimiter:
+    """
+    Spaces out reads so that, across every thread using it, no more than bytes_per_second are read (None for no
+    limit).
+    """
+
+    def __init__(self, bytes_per_second: int | None):
+        self.rate = bytes_per_second
+        self.lock = threading.Lock()
+        self.next_free = time.monotonic()
+
+    def consume(self, size: int):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            start = max(self.next_free, now)
+            self.next_free = start + size / self.rate
+        if start > now:
+            time.sleep(start - now)
+
+
+def file_digest(file, algorithm: str, limiter: RateLimiter) -> tuple[str, int]:
+    hasher = hashlib.new(algorithm)
+    size = 0
+    while data := file.read(READ_SIZE):
+        limiter.consume(len(data))
+        hasher.update(data)
+        size += len(data)
+    return hasher.hexdigest(), size
+
+
+def check_zip(open_file, size: int) -> str | None:
+    """
+    What's wrong with the structure of the zip open_file() opens, None if nothing. Only its central directory is read
+    (the digest has been checked already), every member has to lie inside the file.
+    """
+    try:
+        with open_file() as file, zipfile.ZipFile(file) as zip_file:
+            for info in zip_file.infolist():
+                if info.header_offset + info.compress_size > size:
+                    return f"'{info.filename}' runs past the end of the file."
+    except (zipfile.BadZipFile, ValueError, NotImplementedError) as e:
+        return f"Not a valid zip: {e}"
+    return None
+
+
+def verify_backup(backup: Backup, limiter: RateLimiter) -> dict:
+    """
+    Read a backup back and check it. Returns the fields to record on it. Runs on the scrubber's threads, so it
+    doesn't touch the database.
+    """
+    algorithm = backup.checksum_algorithm or settings.BACKUP_CHECKSUM_ALGORITHM
+    open_file = backup_opener(backup)
+    try:
+        if open_file:
+            with open_file() as file:
+                digest, size = file_digest(file, algorithm, limiter)
+        else:  # compressed, or in an S3 store
+            with open_archive_object(backup.archive_key, backup.archive_compressed) as file:
+                digest, size = file_digest(file, algorithm, limiter)
+    except FileNotFoundError:
+        return {'verify_status': VERIFY_MISSING, 'verify_error': "The backup's file is gone."}
+    except OSError as e:
+        return {'verify_status': VERIFY_ERROR, 'verify_error': str(e)}
+
+    fields = {'verify_status': VERIFY_OK, 'verify_error': ''}
+    if not backup.checksum:  # from before checksums were kept, this is the baseline from now on
+        fields.update(checksum=digest, checksum_algorithm=algorithm)
+    elif digest != backup.checksum.lower():
+        return {'verify_status': VERIFY_MISMATCH,
+                'verify_error': f"{algorithm} is {digest}, expected {backup.checksum} ({size} of {backup.filesize} "
+                                f"bytes read)."}
+
+    problem = check_zip(open_file, size) if open_file else None  # archived copies that can't be seeked are only digested
+    if problem:
+        return {'verify_status': VERIFY_BAD_ZIP, 'verify_error': problem}
+    return fields
+
+
+def due_backups():
+    """
+    Backups that haven't been verified in SCRUB_INTERVAL_DAYS, never verified first, then the longest ago.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.SCRUB_INTERVAL_DAYS)
+    backups = Backup.objects.filter(Q(verified_at__isnull=True) | Q(verified_at__lt=cutoff))
+    if not settings.SCRUB_REMOTE_ARCHIVE and get_object_store().remote:
+        backups = backups.exclude(storage_tier=ARCHIVE_TIER)  # reading those back means downloading them
+    return backups.order_by(F('verified_at').asc(nulls_first=True), 'id')
+
+
+def next_batch(max_bytes: int) -> list[Backup]:
+    """
+    The next due backups, as many as add up to max_bytes (but always at least one, however big it is).
+    """
+    batch = []
+    total = 0
+    for backup in due_backups().select_related('manifest')[:settings.SCRUB_WORKERS * 4]:  # see verify_backup
+        if batch and total + backup.filesize > max_bytes:
+            break
+        batch.append(backup)
+        total += backup.filesize
+    return batch
+
+
+def scrub_backups(max_seconds: int) -> tuple[int, bool]:
+    """
+    Verify due backups until there are none left or max_seconds is up. Each batch is only as big as can be read in
+    the time that's left at SCRUB_RATE_LIMIT (and never more than SCRUB_BATCH_BYTES), so a run ends close to
+    max_seconds however big the backups are. The exception is a single backup that takes longer than that on its own,
+    there's always at least one. Returns how many were verified and whether any are still due.
+    """
+    limiter = RateLimiter(settings.SCRUB_RATE_LIMIT)
+    deadline = time.monotonic() + max_seconds
+    verified = 0
+
+    with ThreadPoolExecutor(max_workers=settings.SCRUB_WORKERS, thread_name_prefix='scrub') as pool:
+        while verified == 0 or time.monotonic() < deadline:
+            max_bytes = settings.SCRUB_BATCH_BYTES
+            if settings.SCRUB_RATE_LIMIT:
+                max_bytes = min(max_bytes, int(settings.SCRUB_RATE_LIMIT * max(deadline - time.monotonic(), 0)))
+            backups = next_batch(max_bytes)
+            if not backups:
+                return verified, False
+
+            for backup, fields in zip(backups, pool.map(verify_backup, backups, repeat(limiter))):
+                Backup.objects.filter(pk=backup.pk).update(verified_at=timezone.now(), **fields)
+                verified += 1
+                if fields['verify_status'] != VERIFY_OK:
+                    logger.error(f"Backup '{backup.basename}' (id {backup.id}) failed its integrity check: "
+                                 f"{fields['verify_error']}")
+
+    return verified, due_backups().exists()
+
+
+def scrub_report(company_id: int = None) -> list[dict]:
+    """
+    Per company: how many of its backups have been verified, and the ones whose last check failed.
+    """
+    backups = Backup.objects.all()
+    if company_id:
+        backups = backups.filter(company_id=company_id)
+
+    report = {}
+    counts = backups.values('company_id', 'company__name').annotate(
+        total=Count('id'), verified=Count('id', filter=Q(verified_at__isnull=False))).order_by('company__name')
+    for row in counts:
+        report[row['company_id']] = {'company': row['company__name'], 'total': row['total'],
+                                     'verified': row['verified'], 'failed': []}
+
+    failed = backups.exclude(verify_status__in=['', VERIFY_OK]).order_by('company_id', '-date_uploaded').values(
+        'id', 'company_id', 'file', 'verify_status', 'verify_error', 'verified_at')
+    for backup in failed:
+        report[backup['company_id']]['failed'].append(backup)
+    return list(report.values())
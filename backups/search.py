@@ -0,0 +1,189 @@
+"""
+Searching backups by file name, folder, company code and the text of their comments.
+
+On SQLite this goes through backups_search, an FTS5 index kept up to date by triggers (see migration
+0025_backup_search): every word of the search has to appear, as a word or the start of one, and matches are ranked
+with bm25, a hit in the file name counting most. Other databases (or SQLite without FTS5) fall back to icontains
+filters, which find the same backups but scan the table and can't rank them.
+
+The backup lists' name filter (anywhere in the file name, e.g. '2024' in ABC2024_backup.zip) goes through a second
+index, backups_name_search, with FTS5's trigram tokenizer (migration 0032_backup_name_search): a substring of 3 or more
+characters is looked up instead of compared against every file name. Shorter ones, and SQLite builds older than 3.34
+(no trigram tokenizer), use icontains.
+
+SQLite drops a table's triggers when a migration has to rebuild the table (e.g. to add a NOT NULL column), so after
+every migrate repair_search_index() puts back any that went missing and rebuilds the index from the tables.
+"""
+import re
+import logging
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from backups.models import BackupNameSearch
+
+logger = logging.getLogger(__name__)
+
+SEARCH_TABLE = 'backups_search'
+NAME_SEARCH_TABLE = 'backups_name_search'
+MIN_TRIGRAM_LENGTH = 3
+# bm25 weights of the index's columns: name, directory, company_code, comments
+RANK = f"bm25({SEARCH_TABLE}, 10.0, 4.0, 4.0, 1.0)"
+
+# the same definitions as 0025_backup_search: a backup's comments as one text, and the file's name without the folders
+# in front of it (everything after the last / or \)
+COMMENTS = "(SELECT coalesce(group_concat(body, ' '), '') FROM backups_comment WHERE backup_id = {id})"
+PATH = "replace({file}, '\\', '/')"
+NAME = f"replace({PATH}, rtrim({PATH}, replace({PATH}, '/', '')), '')"
+
+SEARCH_TRIGGERS = {
+    'backups_search_backup_insert':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_backup_insert AFTER INSERT ON backups_backup BEGIN "
+        "INSERT INTO backups_search (rowid, name, directory, company_code, comments) "
+        f"VALUES (new.id, {NAME.format(file='new.file')}, new.directory, new.company_code, "
+        f"{COMMENTS.format(id='new.id')}); "
+        "END",
+    'backups_search_backup_update':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_backup_update AFTER UPDATE OF file, directory, company_code "
+        "ON backups_backup BEGIN "
+        f"UPDATE backups_search SET name = {NAME.format(file='new.file')}, directory = new.directory, "
+        "company_code = new.company_code WHERE rowid = new.id; "
+        "END",
+    'backups_search_backup_delete':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_backup_delete AFTER DELETE ON backups_backup BEGIN "
+        "DELETE FROM backups_search WHERE rowid = old.id; "
+        "END",
+    'backups_search_comment_insert':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_comment_insert AFTER INSERT ON backups_comment BEGIN "
+        f"UPDATE backups_search SET comments = {COMMENTS.format(id='new.backup_id')} WHERE rowid = new.backup_id; "
+        "END",
+    'backups_search_comment_update':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_comment_update AFTER UPDATE OF body, backup_id "
+        "ON backups_comment BEGIN "
+        f"UPDATE backups_search SET comments = {COMMENTS.format(id='old.backup_id')} WHERE rowid = old.backup_id; "
+        f"UPDATE backups_search SET comments = {COMMENTS.format(id='new.backup_id')} WHERE rowid = new.backup_id; "
+        "END",
+    'backups_search_comment_delete':
+        "CREATE TRIGGER IF NOT EXISTS backups_search_comment_delete AFTER DELETE ON backups_comment BEGIN "
+        f"UPDATE backups_search SET comments = {COMMENTS.format(id='old.backup_id')} WHERE rowid = old.backup_id; "
+        "END",
+}
+
+REBUILD_SEARCH_INDEX = [
+    f"DELETE FROM {SEARCH_TABLE}",
+    f"INSERT INTO {SEARCH_TABLE} (rowid, name, directory, company_code, comments) "
+    f"SELECT id, {NAME.format(file='file')}, directory, company_code, {COMMENTS.format(id='backups_backup.id')} "
+    "FROM backups_backup",
+]
+
+# the same definitions as 0032_backup_name_search
+NAME_SEARCH_TRIGGERS = {
+    'backups_name_search_insert':
+        "CREATE TRIGGER IF NOT EXISTS backups_name_search_insert AFTER INSERT ON backups_backup BEGIN "
+        f"INSERT INTO backups_name_search (rowid, name) VALUES (new.id, {NAME.format(file='new.file')}); "
+        "END",
+    'backups_name_search_update':
+        "CREATE TRIGGER IF NOT EXISTS backups_name_search_update AFTER UPDATE OF file ON backups_backup BEGIN "
+        f"UPDATE backups_name_search SET name = {NAME.format(file='new.file')} WHERE rowid = new.id; "
+        "END",
+    'backups_name_search_delete':
+        "CREATE TRIGGER IF NOT EXISTS backups_name_search_delete AFTER DELETE ON backups_backup BEGIN "
+        "DELETE FROM backups_name_search WHERE rowid = old.id; "
+        "END",
+}
+
+REBUILD_NAME_SEARCH_INDEX = [
+    f"DELETE FROM {NAME_SEARCH_TABLE}",
+    f"INSERT INTO {NAME_SEARCH_TABLE} (rowid, name) SELECT id, {NAME.format(file='file')} FROM backups_backup",
+]
+
+# each index: the triggers that keep it up to date, and how to fill it again from the tables
+SEARCH_INDEXES = {
+    SEARCH_TABLE: (SEARCH_TRIGGERS, REBUILD_SEARCH_INDEX),
+    NAME_SEARCH_TABLE: (NAME_SEARCH_TRIGGERS, REBUILD_NAME_SEARCH_INDEX),
+}
+
+_fts_available: dict = {}
+
+
+def fts_available(using: str = 'default', table: str = SEARCH_TABLE) -> bool:
+    if (using, table) not in _fts_available:
+        connection = connections[using]
+        _fts_available[using, table] = connection.vendor == 'sqlite' and table in connection.introspection.table_names()
+    return _fts_available[using, table]
+
+
+def repair_search_index(using: str = 'default') -> list[str]:
+    """
+    Put back any of the indexes' triggers that are missing and rebuild the indexes that were missing some (they
+    missed the changes made while the triggers were gone). Returns the names of the triggers that were missing.
+    """
+    missing = []
+    for table, (triggers, rebuild) in SEARCH_INDEXES.items():
+        _fts_available.pop((using, table), None)  # the table may have come or gone with the migrations
+        if not fts_available(using, table):
+            continue  # and a trigger writing to a table that isn't there would break every save
+        connection = connections[using]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN "
+                           "('backups_backup', 'backups_comment')")
+            existing = {row[0] for row in cursor.fetchall()}
+            table_missing = [name for name in triggers if name not in existing]
+            if table_missing:
+                with transaction.atomic(using=using):
+                    for name in table_missing:
+                        cursor.execute(triggers[name])
+                    for statement in rebuild:
+                        cursor.execute(statement)
+                logger.warning(f"Recreated the missing triggers of {table} ({', '.join(table_missing)}) and "
+                               f"rebuilt the index.")
+        missing += table_missing
+    return missing
+
+
+def search_terms(text: str) -> list[str]:
+    return [term for term in re.split(r'\s+', text.replace('"', ' ')) if term]
+
+
+def match_expression(terms: list[str]) -> str:
+    """
+    An FTS5 query matching rows that have every term, each as a word or the start of one. Terms are quoted, so
+    anything a user types is taken literally rather than as FTS5 syntax (and 'ABC-2024' is the phrase 'abc 2024').
+    """
+    return ' AND '.join(f'"{term}"*' for term in terms)
+
+
+def text_filter(terms: list[str]) -> Q:
+    query = Q()
+    for term in terms:
+        query &= (Q(file__icontains=term) | Q(directory__icontains=term) | Q(company_code__icontains=term) |
+                  Q(comment__body__icontains=term))
+    return query
+
+
+def ranked_search(queryset, text: str):
+    """
+    The backups out of queryset that match text, best match first (newest first where the index can't rank them).
+    """
+    terms = search_terms(text)
+    if not terms:
+        return queryset.none()
+    if not fts_available(queryset.db):
+        return queryset.filter(text_filter(terms)).distinct().order_by('-date_uploaded', '-id')
+    # joined to the index, so SQLite walks the (few) matching rows of the index and looks the backups up by id
+    return queryset.filter(search__document__match=match_expression(terms)).annotate(
+        search_rank=RawSQL(RANK, []),
+    ).order_by('search_rank', '-date_uploaded')
+
+
+def name_filter(queryset, name: str):
+    """
+    The backups out of queryset with name anywhere in their file name, ignoring case: what file__icontains did, off
+    the trigram index where there is one.
+    """
+    if len(name) < MIN_TRIGRAM_LENGTH or not fts_available(queryset.db, NAME_SEARCH_TABLE):
+        return queryset.filter(file__icontains=name)
+    # a quoted string is a phrase, which to the trigram tokenizer means those characters in a row
+    matches = BackupNameSearch.objects.filter(document__match='"' + name.replace('"', '""') + '"')
+    # IN (subquery) rather than a join: the lists are read newest first off a backups index, and joined SQLite would
+    # run the MATCH again for every backup it reads (seconds for a few thousand), this runs it once
+    return queryset.filter(id__in=matches.values('backup_id'))
@@ -1,38 +1,51 @@
 import os
-from .models import Backup
 from django.utils import timezone
-from rest_framework import serializers
 
-
-class BackupSerializer(serializers.ModelSerializer):
-    date_uploaded = serializers.DateTimeField(format="%m-%d-%Y")
-    time = serializers.SerializerMethodField()
-    user = serializers.SerializerMethodField()
-    company = serializers.SerializerMethodField()
-    file = serializers.SerializerMethodField()
-    savepath = serializers.SerializerMethodField()
-
-    class Meta:
-        model = Backup
-        fields = ['id', 'user', 'company', 'file', 'date_uploaded', 'time', 'filesize', 'savepath']
-
-    def get_file(self, obj):
-        return os.path.basename(obj.file.name)
-
-    def get_time(self, obj):
-        # return the time the backup was uploaded in the format "%H:%M" and in the user's timezone
-        return timezone.localtime(obj.date_uploaded).strftime("%H:%M")
-
-    def get_user(self, obj):
-        return obj.user.username
-
-    def get_company(self, obj):
-        return obj.company.name
-
-    def get_savepath(self, obj):
-        path = obj.adaski_path.replace(obj.company.name + os.path.sep, '')  # remove the company name from the path
-        # remove the starting slash from the path if it's still there
-        if path.startswith(os.path.sep):
-            path = path[1:]
-
-        return path
+BACKUP_LIST_FIELDS = ('id', 'file', 'directory', 'date_uploaded', 'filesize', 'user__username', 'company__name')
+COMMENT_FIELDS = ('id', 'parent_id', 'body', 'created', 'user__username')
+
+
+def backup_list_data(rows) -> list[dict]:
+    """
+    How backups are listed to Adaski, built straight from .values(*BACKUP_LIST_FIELDS) rows: one query with the user
+    and company joined in, and no model instances per backup. savepath is the backup's folder without the company's
+    folder, in the server's path format.
+    """
+    data = []
+    for row in rows:
+        local = timezone.localtime(row['date_uploaded'])
+        path = row['directory'].replace(row['company__name'] + '/', '')
+        data.append({
+            'id': row['id'],
+            'user': row['user__username'],
+            'company': row['company__name'],
+            'file': os.path.basename(row['file']),
+            'date_uploaded': local.strftime("%m-%d-%Y"),
+            'time': local.strftime("%H:%M"),
+            'filesize': row['filesize'],
+            'savepath': path.replace('/', os.path.sep),
+        })
+    return data
+
+
+def comment_thread_data(roots, replies) -> list[dict]:
+    """
+    Nest .values(*COMMENT_FIELDS) rows into threads: the roots in the order given, each with its replies (and theirs)
+    under it, oldest first.
+    """
+    children = {}
+    for reply in sorted(replies, key=lambda row: (row['created'], row['id'])):
+        children.setdefault(reply['parent_id'], []).append(reply)
+
+    def thread(row: dict) -> dict:
+        thread_replies = [thread(reply) for reply in children.get(row['id'], [])]
+        return {
+            'id': row['id'],
+            'user': row['user__username'],
+            'body': row['body'],
+            'created': timezone.localtime(row['created']).isoformat(),
+            'reply_count': len(thread_replies),
+            'replies': thread_replies,
+        }
+
+    return [thread(row) for row in roots]
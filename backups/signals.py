@@ -0,0 +1,83 @@
+import logging
+import os
+from .models import Backup, BackupDirectory, UploadSession
+from users.models import Company
+from django.dispatch import receiver
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, pre_delete
+from django_cleanup.signals import cleanup_post_delete
+from backups.objectstore import get_hot_store, local_backups_root
+from backups.search import repair_search_index
+from backups.utils import remove_empty_parents
+
+logger = logging.getLogger(__name__)
+
+
+# a receiver (rather than Backup.delete) so backups removed by a cascade, e.g. when their company is deleted, let go of
+# their chunks too. pre_delete, while the backup's manifest is still there to say which chunks those are
+@receiver(pre_delete, sender=Backup)
+def release_backup_chunks(sender, instance, **kwargs):
+    if instance.is_chunked:
+        from backups.chunkstore import release_chunks
+        release_chunks(instance)
+
+
+# the files themselves are removed by django-cleanup
+@receiver(post_delete, sender=Backup)
+def release_backup_storage(sender, instance, **kwargs):
+    if instance.company_id:
+        Company.objects.filter(pk=instance.company_id).update(
+            used_storage=Greatest(F('used_storage') - instance.filesize, 0))
+
+
+# folders that are left empty drop out of the file browser
+@receiver(post_delete, sender=Backup)
+def prune_backup_directory(sender, instance, **kwargs):
+    BackupDirectory.prune(instance.directory)
+
+
+# and once django-cleanup has removed the file, its folder goes from the disk too if that left it empty (folders
+# missed here, e.g. emptied by hand, are caught by the background sweep in backups/tasks.py). A bucket has no folders
+@receiver(cleanup_post_delete, sender=Backup)
+def remove_empty_backup_folder(sender, file, file_name, success, **kwargs):
+    path = get_hot_store().local_path(file_name)
+    if success and path is not None:
+        remove_empty_parents(os.path.dirname(path), local_backups_root())
+
+
+# uploads that are aborted or expire give back the storage they had reserved
+@receiver(post_delete, sender=UploadSession)
+def release_upload_session_storage(sender, instance, **kwargs):
+    if instance.reserved_storage:
+        from backups.quota import unreserve_storage
+        unreserve_storage(instance.company_id, instance.reserved_storage)
+
+
+# whichever way a session goes (aborted, expired, or its company deleted), its staging directory goes with it
+@receiver(post_delete, sender=UploadSession)
+def discard_upload_staging(sender, instance, **kwargs):
+    from backups.uploads import discard_upload
+    discard_upload(instance)
+
+
+# a multipart upload that never became a backup is aborted, and its object removed if it had been assembled already
+@receiver(post_delete, sender=UploadSession)
+def discard_multipart_upload(sender, instance, **kwargs):
+    if instance.multipart_upload_id and instance.status != UploadSession.COMPLETE:
+        store = get_hot_store()
+        store.abort_multipart(instance.multipart_key, instance.multipart_upload_id)
+        store.delete(instance.multipart_key)
+
+
+# backups with the same content share an archive object, it goes when the last of them does
+@receiver(post_delete, sender=Backup)
+def release_archive_object(sender, instance, **kwargs):
+    if instance.archive_key and not Backup.objects.filter(archive_key=instance.archive_key).exists():
+        from backups.archive import delete_archive_object
+        delete_archive_object(instance.archive_key)
+
+
+# connected in BackupsConfig.ready, for the backups app's post_migrate only
+def repair_search_triggers(sender, using, **kwargs):
+    repair_search_index(using)
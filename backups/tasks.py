@@ -0,0 +1,249 @@
+import logging
+from datetime import timedelta
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+from users.models import Profile
+from django.conf import settings
+from backups.models import HOT_TIER, Backup, UploadSession
+from backups.jobs import job, enqueue
+from backups.chunkstore import fill_known_chunks, index_new_backups, store_backup_chunks
+from backups.quota import reconcile_storage
+from backups.zipindex import index_zip
+from backups.retention import apply_retention
+from backups.archive import archive_cold_backups, backup_opener, recall_backup
+from backups.utils import sweep_empty_folders
+from backups.scrub import scrub_backups
+from backups.uploads import advance_digest, staging_path
+from backups.objectstore import local_backups_root
+
+logger = logging.getLogger(__name__)
+
+
+@job('store_backup')
+def store_backup(backup_id: int, session_id: str = None):
+    """
+    Move a freshly uploaded backup into the chunk store. One uploaded with a manifest is split the way the manifest
+    says, right away; anything else needs content-defined chunking, which is left to the index_backup job. Running this
+    twice is fine, a backup that isn't hot anymore is left alone.
+    """
+    backup = Backup.objects.filter(pk=backup_id).first()
+    if backup is None or backup.storage_tier != HOT_TIER:  # deleted before the job got to it, or stored already
+        return
+
+    session = UploadSession.objects.filter(pk=session_id).first() if session_id else None
+    if session is not None and session.manifest:
+        store_backup_chunks(backup, session.manifest)
+    else:
+        enqueue_backup_index(backup)
+
+
+@job('index_backup')
+def index_backup_job(backup_id: int):
+    backup = Backup.objects.filter(pk=backup_id).first()
+    if backup is None or backup.storage_tier != HOT_TIER:  # stored already, or archived
+        return
+    store_backup_chunks(backup)
+
+
+def enqueue_backup_index(backup: Backup):
+    enqueue('index_backup', idempotency_key=f"index_backup:{backup.id}", backup_id=backup.id)
+
+
+@job('index_new_backups')
+def index_new_backups_job():
+    index_new_backups()
+
+
+def enqueue_index_new_backups():
+    slot = timezone.now().strftime('%Y-%m-%dT%H:%M')[:-1]  # once every 10 minutes across all processes
+    enqueue('index_new_backups', idempotency_key=f"index_new_backups:{slot}")
+
+
+@job('fill_known_chunks')
+def fill_known_chunks_job(session_id: str):
+    """
+    Copy the chunks of a manifest upload that the company already has into its staging file, mark them received and
+    finish the upload if they were all it was waiting for. A job rather than part of the request that created the
+    session, which would otherwise read and write every known chunk (possibly the whole file) before answering; the
+    session only becomes complete once this has run.
+    """
+    session = UploadSession.objects.filter(id=session_id, status=UploadSession.UPLOADING).select_related(
+        'user__profile__company', 'company').first()
+    if session is None or not session.filling:  # aborted or expired, or this is a retry that got this far already
+        return
+
+    filled = fill_known_chunks(session, staging_path(session))
+    with transaction.atomic():
+        session.touch()  # see the upload view, the same goes for this UPDATE
+        locked = UploadSession.objects.select_for_update().get(id=session.id)
+        for chunk_index in filled:
+            locked.mark_chunk_received(chunk_index)
+        locked.filling = []  # what couldn't be filled in is up to the client now
+        locked.save(update_fields=['received', 'filling'])
+    if len(filled) < len(session.filling):
+        logger.warning(f"Could only fill in {len(filled)} of the {len(session.filling)} known chunks of upload "
+                       f"'{session.filename}', the client has to send the rest.")
+    session.received, session.filling = locked.received, locked.filling
+
+    advance_digest(session)
+
+    from backups.views import finish_upload_if_complete
+    finish_upload_if_complete(session, session.user)
+
+
+def enqueue_fill_known_chunks(session: UploadSession):
+    enqueue('fill_known_chunks', idempotency_key=f"fill_known_chunks:{session.id}", session_id=str(session.id))
+
+
+@job('index_zip')
+def index_zip_job(backup_id: int):
+    backup = Backup.objects.filter(pk=backup_id).first()
+    open_file = backup_opener(backup) if backup is not None else None
+    if open_file:  # otherwise it's indexed the first time someone asks for its members
+        index_zip(backup, open_file)
+
+
+@job('backup_complete_email')
+def backup_complete_email(backup_id: int, user_id: int):
+    from backups.views import send_backup_complete_email
+
+    backup = Backup.objects.filter(pk=backup_id).first()
+    user = User.objects.filter(pk=user_id).select_related('profile').first()
+    if backup is None or user is None:
+        return
+
+    users_list = [user] if user.profile.get_backup_emails else []
+    users_list += list(User.objects.filter(profile__is_company_admin=True,  # include company admins
+                                           profile__get_backup_emails=True,  # don't include profiles that have False
+                                           profile__company=user.profile.company).select_related('profile'))
+    # users on the daily digest hear about this backup in that instead
+    users_list = set(u for u in users_list if not u.profile.backup_email_digest)  # remove duplicates (if any)
+
+    if users_list:
+        send_backup_complete_email(users_list, backup)
+
+
+@job('backup_digests')
+def backup_digests():
+    """
+    Send the daily digest to everyone who chose it: company admins get every backup their company uploaded since
+    their last digest, everyone else only their own.
+    """
+    from backups.views import send_backup_digest_email
+
+    now = timezone.now()
+    profiles = Profile.objects.filter(get_backup_emails=True, backup_email_digest=True,
+                                      company__isnull=False).select_related('user')
+    for profile in profiles:
+        since = profile.last_backup_digest or now - timedelta(days=1)
+        backups = Backup.objects.filter(company_id=profile.company_id, date_uploaded__gt=since,
+                                        date_uploaded__lte=now).select_related('user').order_by('date_uploaded')
+        if not profile.is_company_admin:
+            backups = backups.filter(user=profile.user)
+        backups = list(backups)
+
+        # move the profile's digest window on first, so a retried job doesn't send the same digest twice
+        if not Profile.objects.filter(pk=profile.pk, last_backup_digest=profile.last_backup_digest).update(
+                last_backup_digest=now):
+            continue
+        if backups:
+            send_backup_digest_email(profile.user, backups)
+
+
+def enqueue_backup_digests():
+    """
+    Scheduled in every process, the idempotency key makes sure the digests only go out once a day.
+    """
+    enqueue('backup_digests', idempotency_key=f"backup_digests:{timezone.localdate().isoformat()}")
+
+
+@job('reconcile_storage')
+def reconcile_storage_job():
+    reconcile_storage()
+
+
+def enqueue_reconcile_storage():
+    enqueue('reconcile_storage', idempotency_key=f"reconcile_storage:{timezone.now().strftime('%Y-%m-%dT%H')}")
+
+
+@job('apply_retention')
+def apply_retention_job():
+    apply_retention()
+
+
+def enqueue_apply_retention():
+    enqueue('apply_retention', idempotency_key=f"apply_retention:{timezone.localdate().isoformat()}")
+
+
+@job('archive_cold_backups')
+def archive_cold_backups_job():
+    archive_cold_backups()
+
+
+def enqueue_archive_cold_backups():
+    enqueue('archive_cold_backups', idempotency_key=f"archive_cold_backups:{timezone.localdate().isoformat()}")
+
+
+@job('recall_backup')
+def recall_backup_job(backup_id: int):
+    backup = Backup.objects.filter(pk=backup_id).first()
+    if backup is not None:
+        recall_backup(backup)
+
+
+def enqueue_recall(backup: Backup):
+    # keyed on when it was archived, so a backup that's been archived again can be recalled again
+    archived_at = backup.archived_at.timestamp() if backup.archived_at else 0
+    return enqueue('recall_backup', idempotency_key=f"recall_backup:{backup.id}:{archived_at}", backup_id=backup.id)
+
+
+@job('sweep_empty_folders')
+def sweep_empty_folders_job(sweep: str, batch: int = 0, cursor: str = None):
+    """
+    One slice of a sweep for empty folders in the backups tree. Each slice queues the next one, so a sweep of a big
+    tree is spread out, and picks up where it stopped if the server restarts half way. Nothing to do if backup files are
+    in a bucket.
+    """
+    root = local_backups_root()
+    if root is None:
+        return
+    cursor = sweep_empty_folders(root, cursor, settings.EMPTY_FOLDER_SWEEP_BATCH,
+                                 settings.EMPTY_FOLDER_SWEEP_PAUSE)
+    if cursor is not None:
+        enqueue('sweep_empty_folders', idempotency_key=f"sweep_empty_folders:{sweep}:{batch + 1}",
+                delay=settings.EMPTY_FOLDER_SWEEP_DELAY, sweep=sweep, batch=batch + 1, cursor=cursor)
+
+
+def enqueue_sweep_empty_folders():
+    sweep = timezone.now().strftime('%Y-%m-%dT%H')
+    enqueue('sweep_empty_folders', idempotency_key=f"sweep_empty_folders:{sweep}:0", sweep=sweep)
+
+
+@job('scrub_backups')
+def scrub_backups_job(run: str, batch: int = 0):
+    """
+    Verify backups for about SCRUB_JOB_SECONDS (see scrub_backups), then queue the next batch if any are still due.
+    Which backups are due is worked out from when they were last verified, so nothing is lost if the server restarts
+    in between. The job's heartbeat keeps it from being taken back while a big backup is being read.
+    """
+    verified, more = scrub_backups(settings.SCRUB_JOB_SECONDS)
+    logger.info(f"Integrity scrub verified {verified} backup(s){', more to go' if more else ''}.")
+    if more:
+        enqueue('scrub_backups', idempotency_key=f"scrub_backups:{run}:{batch + 1}", run=run, batch=batch + 1)
+
+
+def enqueue_scrub_backups():
+    run = timezone.localdate().isoformat()
+    enqueue('scrub_backups', idempotency_key=f"scrub_backups:{run}:0", run=run)
+
+
+def enqueue_backup_uploaded(backup: Backup, user, session: UploadSession = None):
+    """
+    Queue everything that happens after an upload once the file is safely in place and recorded.
+    """
+    enqueue('store_backup', idempotency_key=f"store_backup:{backup.id}", backup_id=backup.id,
+            session_id=str(session.id) if session else None)
+    enqueue('index_zip', idempotency_key=f"index_zip:{backup.id}", backup_id=backup.id)
+    enqueue('backup_complete_email', idempotency_key=f"backup_complete_email:{backup.id}", backup_id=backup.id,
+            user_id=user.id)
@@ -1,3 +1,966 @@
-from django.test import TestCase
+import io
+import os
+import random
+import hashlib
+import zipfile
+import tempfile
+from datetime import datetime, timedelta
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+from backups.archive import archive_backup, archive_cold_backups, backup_opener, recall_backup
+from backups.chunkstore import iter_chunks, known_chunks, read_chunk, store_backup_chunks
+from backups.jobs import Heartbeat, claim_next_job, enqueue, job, purge_finished_jobs, requeue_stale_jobs, \
+    retry_delay, run_job, run_pending_jobs
+from backups.models import ARCHIVE_TIER, CHUNK_TIER, HOT_TIER, VERIFY_BAD_ZIP, VERIFY_MISMATCH, VERIFY_MISSING, \
+    VERIFY_OK, ArchivePolicy, Backup, Chunk, Comment, CompanyChunk, Job, RetentionPolicy, UploadSession
+from backups.objectstore import MIN_PART_SIZE, ObjectStoreError, S3ObjectStore
+from backups.pagination import keyset_page
+from backups.retention import apply_retention
+from backups import objectstore, uploads
+from backups.scrub import next_batch, scrub_backups, scrub_report
+from backups.search import NAME_SEARCH_TABLE, SEARCH_TABLE, fts_available, name_filter, ranked_search, \
+    repair_search_index
+from backups.utils import cleanup_incomplete_uploads
+from backups.views import BackupListView, CompanyBackupListView
+from users.models import Company, Profile
 
-# Create your tests here.
+try:
+    import boto3
+    from moto import mock_aws
+except ImportError:  # the S3 object store is optional
+    mock_aws = None
+
+
+@skipUnless(connection.vendor == 'sqlite', "checks SQLite query plans")
+class BackupListingQueryPlanTests(TestCase):
+    """
+    Every way backups are listed (newest first, for a user, a company or everyone) has to be read straight off an
+    index. A plan that scans the table or sorts the rows means an index went missing, and a listing that gets slower
+    with every backup anyone uploads.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        # bulk_create, so saving them doesn't go looking for their default images in MEDIA_ROOT
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob', is_staff=True, is_superuser=True)])
+
+    def query_plan(self, queryset) -> list[str]:
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+            return [row[3] for row in cursor.fetchall()]
+
+    def assertUsesIndex(self, queryset, index: str):
+        plan = self.query_plan(queryset)
+        self.assertTrue(any(f"USING INDEX {index}" in step for step in plan), plan)
+        self.assertFalse(any('TEMP B-TREE' in step for step in plan), plan)  # sorting the rows
+        self.assertFalse(any(step == 'SCAN backups_backup' for step in plan), plan)
+
+    def list_view_queryset(self, view_class, **kwargs):
+        view = view_class()
+        view.setup(RequestFactory().get('/', {'start_date': '2024-01-01', 'end_date': '2024-12-31', 'name': 'abc'}),
+                   **kwargs)
+        view.request.user = self.user
+        return view.get_queryset()
+
+    def test_profile_recent_backups(self):
+        self.assertUsesIndex(Backup.objects.filter(user=self.user).order_by('-date_uploaded')[0:5],
+                             'backup_user_date_idx')
+
+    def test_user_backup_list(self):
+        self.assertUsesIndex(self.list_view_queryset(BackupListView), 'backup_user_date_idx')
+
+    def test_company_backup_list(self):
+        self.assertUsesIndex(self.list_view_queryset(CompanyBackupListView, company_id=self.company.id),
+                             'backup_company_date_idx')
+
+    def test_backups_list_api_pages(self):
+        Backup.objects.bulk_create([Backup(user=self.user, company=self.company, file=f"backups/Co/{i}.zip",
+                                           filesize=1) for i in range(3)])
+        backups = Backup.objects.filter(company=self.company).values('id', 'date_uploaded')
+        _, cursor = keyset_page(backups, None, 1)
+
+        with CaptureQueriesContext(connection) as queries:
+            keyset_page(backups, cursor, 1)  # a page after the first one
+        with connection.cursor() as db_cursor:
+            db_cursor.execute(f"EXPLAIN QUERY PLAN {queries[0]['sql']}")
+            plan = [row[3] for row in db_cursor.fetchall()]
+        self.assertFalse(any('TEMP B-TREE' in step or step == 'SCAN backups_backup' for step in plan), plan)
+
+    def test_admin_changelist(self):
+        request = RequestFactory().get('/admin/backups/backup/')
+        request.user = self.user
+        changelist = admin.site._registry[Backup].get_changelist_instance(request)
+        self.assertUsesIndex(changelist.get_queryset(request), 'backup_date_idx')
+
+
+@skipUnless(connection.vendor == 'sqlite', "the search index is SQLite's FTS5")
+class BackupSearchIndexTests(TestCase):
+    """
+    The search index is kept in step with backups_backup by triggers, which SQLite drops whenever a migration has to
+    rebuild the table. Every migration has run on the test database, so these catch one that lost them.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+
+    def setUp(self):
+        if not fts_available():
+            self.skipTest("SQLite was built without FTS5")
+
+    def test_triggers_exist(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND name LIKE %s",
+                           [f"{SEARCH_TABLE}_%"])
+            triggers = {row[0] for row in cursor.fetchall()}
+        self.assertEqual(triggers, {f"{SEARCH_TABLE}_{table}_{event}" for table in ('backup', 'comment')
+                                    for event in ('insert', 'update', 'delete')})
+
+    def test_name_filter_uses_the_trigram_index(self):
+        if not fts_available(table=NAME_SEARCH_TABLE):
+            self.skipTest("SQLite doesn't have FTS5's trigram tokenizer")
+        payroll, ledger = Backup.objects.bulk_create([
+            Backup(user=self.user, company=self.company, filesize=1, file='backups/Co/PAYROLL/ABC2024_backup.zip'),
+            Backup(user=self.user, company=self.company, filesize=1, file='backups/Co/LEDGER/ABC_ledger.zip'),
+        ])
+        backups = Backup.objects.all()
+        self.assertEqual(list(name_filter(backups, '2024')), [payroll])  # in the middle of a word
+        self.assertEqual(list(name_filter(backups, 'abc')), [ledger, payroll])
+        self.assertFalse(name_filter(backups, 'LEDGER/').exists())  # folders aren't part of the name
+        self.assertEqual(list(name_filter(backups, '"x')), [])
+
+        with CaptureQueriesContext(connection) as queries:
+            list(name_filter(backups, '2024'))
+        self.assertIn(f'"{NAME_SEARCH_TABLE}" MATCH', queries[0]['sql'])
+        self.assertNotIn('LIKE', queries[0]['sql'])
+
+        Backup.objects.filter(pk=ledger.pk).update(file='backups/Co/LEDGER/ABC2024_ledger.zip')
+        self.assertEqual(set(name_filter(backups, '2024')), {payroll, ledger})
+        Backup.objects.filter(pk=payroll.pk).delete()
+        self.assertEqual(list(name_filter(backups, '2024')), [ledger])
+
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {NAME_SEARCH_TABLE}_delete")
+        self.assertEqual(repair_search_index(), [f"{NAME_SEARCH_TABLE}_delete"])
+
+    def test_new_backup_is_found(self):
+        backup, = Backup.objects.bulk_create([Backup(user=self.user, company=self.company, filesize=1,
+                                                     file='backups/Co/PAYROLL/ABC_payroll_2024.zip')])
+        self.assertEqual(list(ranked_search(Backup.objects.all(), 'payroll_2024')), [backup])
+
+        Backup.objects.filter(pk=backup.pk).update(file='backups/Co/PAYROLL/ABC_ledger.zip')
+        self.assertFalse(ranked_search(Backup.objects.all(), 'payroll_2024').exists())
+        self.assertEqual(list(ranked_search(Backup.objects.all(), 'ledger')), [backup])
+
+        Backup.objects.filter(pk=backup.pk).delete()
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {SEARCH_TABLE}")
+            self.assertEqual(cursor.fetchone()[0], 0)
+
+    def test_missing_triggers_are_repaired(self):
+        backup, = Backup.objects.bulk_create([Backup(user=self.user, company=self.company, filesize=1,
+                                                     file='backups/Co/ABC_payroll.zip')])
+        with connection.cursor() as cursor:
+            cursor.execute(f"DROP TRIGGER {SEARCH_TABLE}_backup_update")
+        Backup.objects.filter(pk=backup.pk).update(file='backups/Co/ABC_ledger.zip')  # the index doesn't follow
+
+        self.assertEqual(repair_search_index(), [f"{SEARCH_TABLE}_backup_update"])
+        self.assertEqual(list(ranked_search(Backup.objects.all(), 'ledger')), [backup])
+        self.assertEqual(repair_search_index(), [])
+
+
+class BackupSearchApiTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, other_company = Company.objects.bulk_create([Company(name='Co'), Company(name='Other')])
+        cls.user, other_user = User.objects.bulk_create([User(username='bob'), User(username='alice')])
+        Profile.objects.bulk_create([Profile(user=cls.user, company=cls.company, is_company_admin=True),
+                                     Profile(user=other_user, company=other_company)])
+        cls.payroll, cls.ledger, cls.other = Backup.objects.bulk_create([
+            Backup(user=cls.user, company=cls.company, filesize=1, file='backups/Co/PAYROLL/ABC_payroll_2024.zip'),
+            Backup(user=cls.user, company=cls.company, filesize=1, file='backups/Co/LEDGER/ABC_ledger.zip'),
+            Backup(user=other_user, company=other_company, filesize=1, file='backups/Other/XYZ_payroll.zip'),
+        ])
+        Comment.objects.create(backup=cls.ledger, user=cls.user, body="Restored after the March payroll run")
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def search(self, q: str) -> list[int]:
+        response = self.client.get('/backups/search/', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [backup['id'] for backup in response.data]
+
+    def test_search_by_name(self):
+        self.assertEqual(self.search('ledger'), [self.ledger.id])
+        self.assertEqual(self.search('ABC payroll_2024'), [self.payroll.id])
+
+    def test_search_by_comment(self):
+        self.assertEqual(self.search('march'), [self.ledger.id])
+
+    def test_name_ranks_above_comments(self):
+        # both mention payroll, the one named after it first, and nothing from the other company
+        self.assertEqual(self.search('payroll'), [self.payroll.id, self.ledger.id])
+
+    def test_nothing_to_search_for(self):
+        self.assertEqual(self.search(' " '), [])
+
+    def test_list_name_filter_matches_anywhere(self):
+        # the backup lists' name filter stays a substring match, unlike the word prefixes of the search
+        backup, = Backup.objects.bulk_create([Backup(user=self.user, company=self.company, filesize=1,
+                                                     file='backups/Co/ABC2024_backup.zip')])
+        view = BackupListView()
+        view.setup(RequestFactory().get('/', {'name': '2024'}))
+        view.request.user = self.user
+        self.assertEqual(set(view.get_queryset()), {self.payroll, backup})
+        self.assertEqual(self.search('2024'), [self.payroll.id])  # a word of its own in ABC_payroll_2024.zip
+
+
+class TemporaryMediaMixin:
+    """
+    Backups, chunks and the archive go to temporary directories instead of MEDIA_ROOT and BACKUP_ARCHIVE_ROOT.
+    """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        archive_root = os.path.join(media_root.name, 'archive')
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name, BACKUP_ARCHIVE_ROOT=archive_root,
+                                            BACKUP_OBJECT_STORE={'BACKEND': 'local',
+                                                                 'OPTIONS': {'root': archive_root}}))
+
+    def backup_file(self, name: str, content: bytes, **fields) -> Backup:
+        """
+        A backup of the test's company whose file (under backups/Co) holds content, saved without any of its signals.
+        """
+        file = f"backups/Co/{name}"
+        path = os.path.join(settings.MEDIA_ROOT, file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as backup_file:
+            backup_file.write(content)
+        backup, = Backup.objects.bulk_create([Backup(user=self.user, company=self.company, file=file,
+                                                     filesize=len(content), **fields)])
+        return backup
+
+
+class ChunkIndexTests(TemporaryMediaMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+
+    def test_shared_chunks_are_stored_once(self):
+        shared = random.Random(1).randbytes(400_000)
+        first = self.backup_file('first.zip', shared + b'first')
+        second = self.backup_file('second.zip', shared + b'second version')
+        first_chunks = store_backup_chunks(first).chunks
+        second_chunks = store_backup_chunks(second).chunks
+        in_both = {digest for digest, size in first_chunks} & {digest for digest, size in second_chunks}
+        self.assertGreater(len(in_both), 2)
+        self.assertFalse(os.path.exists(first.file.path))  # the chunks are all there is of it now
+
+        self.assertEqual(Chunk.objects.count(), len({digest for digest, size in first_chunks + second_chunks}))
+        self.assertEqual(set(Chunk.objects.filter(refcount=2).values_list('digest', flat=True)), in_both)
+        known = known_chunks(self.company, in_both)
+        self.assertEqual(set(known), in_both)
+        for chunk in known.values():
+            self.assertIn(read_chunk(chunk), shared)
+        with backup_opener(Backup.objects.get(pk=first.pk))() as first_file:
+            self.assertEqual(first_file.read(), shared + b'first')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(set(Chunk.objects.values_list('digest', 'refcount')),
+                         {(digest, 1) for digest, size in second_chunks})
+        self.assertEqual(CompanyChunk.objects.count(), len(second_chunks))
+        chunk_files = {name for root, dirs, files in os.walk(os.path.join(settings.MEDIA_ROOT, 'chunks'))
+                       for name in files}
+        self.assertEqual(chunk_files, {digest for digest, size in second_chunks})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Backup.objects.get(pk=second.pk).delete()
+        self.assertFalse(Chunk.objects.exists())
+        self.assertFalse(CompanyChunk.objects.exists())
+
+    def test_web_processes_leave_chunking_to_workers(self):
+        with self.settings(WORKER_ONLY_JOBS=['index_backup']):
+            indexing = enqueue('index_backup', backup_id=0)
+            run_pending_jobs(exclude_kinds=['index_backup'])
+            self.assertEqual(Job.objects.get(pk=indexing.pk).status, Job.PENDING)
+            run_pending_jobs()
+            self.assertEqual(Job.objects.get(pk=indexing.pk).status, Job.DONE)
+
+
+@job('test_taken_over')
+def taken_over_job():
+    # this run's lock looks expired, and another worker takes the job while it's still running
+    Job.objects.filter(kind='test_taken_over').update(locked_at=timezone.now() - timedelta(hours=1))
+    requeue_stale_jobs()
+    JobQueueTests.second_claim = claim_next_job()
+
+
+@job('test_fail')
+def failing_job():
+    raise ValueError("boom")
+
+
+@override_settings(JOB_MAX_ATTEMPTS=2, JOB_RETRY_DELAY=30, JOB_RETENTION_DAYS=30)
+class JobQueueTests(TestCase):
+    second_claim = None
+
+    def test_idempotency_key(self):
+        first = enqueue('test_fail', idempotency_key='once')
+        self.assertEqual(enqueue('test_fail', idempotency_key='once'), first)
+        self.assertEqual(Job.objects.count(), 1)
+
+    def test_retry_then_fail(self):
+        queued = enqueue('test_fail')
+        run_pending_jobs()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts, queued.locked_by), (Job.PENDING, 1, ''))
+        self.assertIn('boom', queued.last_error)
+        self.assertGreater(queued.run_after, timezone.now() + timedelta(seconds=retry_delay(1) - 5))
+
+        Job.objects.filter(pk=queued.pk).update(run_after=timezone.now())
+        run_pending_jobs()
+        queued.refresh_from_db()
+        self.assertEqual((queued.status, queued.attempts), (Job.FAILED, 2))
+
+    def test_heartbeat(self):
+        enqueue('test_fail')
+        claimed = claim_next_job()
+        Job.objects.filter(pk=claimed.pk).update(locked_at=timezone.now() - timedelta(hours=1))
+        heartbeat = Heartbeat(claimed)
+        self.assertTrue(heartbeat.beat())
+        requeue_stale_jobs()
+        self.assertEqual(Job.objects.get(pk=claimed.pk).status, Job.RUNNING)  # the lock is fresh, it's left alone
+
+        Job.objects.filter(pk=claimed.pk).update(locked_by='someone else')
+        self.assertFalse(heartbeat.beat())
+
+    def test_requeued_run_doesnt_overwrite_the_new_one(self):
+        queued = enqueue('test_taken_over')
+        run_job(claim_next_job())
+
+        second = JobQueueTests.second_claim
+        self.assertEqual(second.id, queued.id)
+        queued.refresh_from_db()
+        # the first run finished, but the job is still the second worker's
+        self.assertEqual((queued.status, queued.locked_by, queued.finished), (Job.RUNNING, second.locked_by, None))
+
+    def test_purge(self):
+        old, recent, failed = (enqueue('test_fail') for _ in range(3))
+        long_ago = timezone.now() - timedelta(days=31)
+        Job.objects.filter(pk=old.pk).update(status=Job.DONE, finished=long_ago)
+        Job.objects.filter(pk=recent.pk).update(status=Job.DONE, finished=timezone.now())
+        Job.objects.filter(pk=failed.pk).update(status=Job.FAILED, finished=long_ago)
+
+        self.assertEqual(purge_finished_jobs(), 1)
+        self.assertEqual(set(Job.objects.values_list('id', flat=True)), {recent.id, failed.id})
+
+
+class RunningDigestTests(TestCase):
+
+    def setUp(self):
+        self.addCleanup(uploads._running_digests.clear)
+
+    def test_idle_digests_are_dropped(self):
+        abandoned, active = UploadSession(checksum_algorithm='md5'), UploadSession(checksum_algorithm='md5')
+        uploads.running_digest(abandoned).last_used -= uploads.DIGEST_IDLE_TIMEOUT + 1
+        digest = uploads.running_digest(active)
+
+        self.assertEqual(list(uploads._running_digests), [active.id])
+        self.assertIs(uploads.running_digest(active), digest)
+
+
+class ContentAddressingTests(TemporaryMediaMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+
+    def test_identical_backups_share_their_chunks(self):
+        first = self.backup_file('first.zip', b'same bytes')
+        second = self.backup_file('second.zip', b'same bytes')
+        self.assertEqual(store_backup_chunks(first).chunks, store_backup_chunks(second).chunks)
+
+        chunk = Chunk.objects.get()
+        self.assertEqual((chunk.digest, chunk.refcount), (hashlib.sha256(b'same bytes').hexdigest(), 2))
+        self.assertEqual(Backup.objects.filter(storage_tier=CHUNK_TIER).count(), 2)
+
+    def test_matching_md5_checksums_dont_share_content(self):
+        # two files crafted to have the same md5 (and size) are still different files
+        checksum = hashlib.md5(b'company A').hexdigest()
+        theirs = self.backup_file('a.zip', b'company A', checksum=checksum, checksum_algorithm='md5')
+        crafted = self.backup_file('b.zip', b'company B', checksum=checksum, checksum_algorithm='md5')
+
+        self.assertNotEqual(store_backup_chunks(theirs).chunks, store_backup_chunks(crafted).chunks)
+        with backup_opener(crafted)() as crafted_file:
+            self.assertEqual(crafted_file.read(), b'company B')
+
+    @override_settings(ARCHIVE_COMPRESSION=False)
+    def test_archive_objects_are_keyed_on_sha256(self):
+        checksum = hashlib.md5(b'company A').hexdigest()
+        theirs = self.backup_file('a.zip', b'company A', checksum=checksum, checksum_algorithm='md5')
+        crafted = self.backup_file('b.zip', b'company B', checksum=checksum, checksum_algorithm='md5')
+        self.assertTrue(archive_backup(theirs))
+        self.assertTrue(archive_backup(crafted))
+
+        theirs.refresh_from_db()
+        crafted.refresh_from_db()
+        digest = hashlib.sha256(b'company B').hexdigest()
+        self.assertEqual(crafted.archive_key, f"sha256/{digest[:2]}/{digest}")
+        self.assertNotEqual(theirs.archive_key, crafted.archive_key)
+
+    def test_checksum_filled_in_for_old_backups(self):
+        old = self.backup_file('old.zip', b'from before checksums')
+        store_backup_chunks(old)
+        old.refresh_from_db()
+        self.assertEqual((old.checksum_algorithm, old.checksum),
+                         ('sha256', hashlib.sha256(b'from before checksums').hexdigest()))
+
+
+def zip_bytes(**members) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+    return buffer.getvalue()
+
+
+@override_settings(SCRUB_WORKERS=2, SCRUB_RATE_LIMIT=None, SCRUB_BATCH_BYTES=1024 ** 3, SCRUB_INTERVAL_DAYS=30,
+                   SCRUB_REMOTE_ARCHIVE=False)
+class ScrubTests(TemporaryMediaMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+
+    def checked_backup(self, name: str, content: bytes, checksum: str = None) -> Backup:
+        checksum = hashlib.md5(content).hexdigest() if checksum is None else checksum
+        return self.backup_file(name, content, checksum=checksum, checksum_algorithm='md5' if checksum else '')
+
+    def test_verify(self):
+        content = zip_bytes(a='hello')
+        good = self.checked_backup('good.zip', content)
+        rotten = self.checked_backup('rotten.zip', content, checksum=hashlib.md5(b'what it was').hexdigest())
+        missing = self.checked_backup('missing.zip', content)
+        os.remove(missing.file.path)
+        truncated = self.checked_backup('truncated.zip', content[:-10])
+        unchecked = self.checked_backup('unchecked.zip', content, checksum='')
+
+        self.assertEqual(scrub_backups(60), (5, False))
+        statuses = dict(Backup.objects.values_list('id', 'verify_status'))
+        self.assertEqual(statuses, {good.id: VERIFY_OK, rotten.id: VERIFY_MISMATCH, missing.id: VERIFY_MISSING,
+                                    truncated.id: VERIFY_BAD_ZIP, unchecked.id: VERIFY_OK})
+        unchecked.refresh_from_db()
+        self.assertEqual(unchecked.checksum, hashlib.md5(content).hexdigest())  # the baseline from now on
+
+        report, = scrub_report()
+        self.assertEqual((report['total'], report['verified']), (5, 5))
+        self.assertEqual({backup['id'] for backup in report['failed']}, {rotten.id, missing.id, truncated.id})
+
+        self.assertEqual(scrub_backups(60), (0, False))  # nothing due until SCRUB_INTERVAL_DAYS have gone by
+
+    def test_batches_are_bounded_by_size(self):
+        backups = [self.checked_backup(f"{i}.zip", zip_bytes(a=str(i) * 1000)) for i in range(4)]
+        size = backups[0].filesize
+        self.assertEqual(next_batch(size * 2 + 1), backups[:2])
+        self.assertEqual(next_batch(1), backups[:1])  # one too big for the batch still gets verified
+
+        with self.settings(SCRUB_BATCH_BYTES=size * 3):
+            self.assertEqual(scrub_backups(0), (3, True))  # out of time, but a batch always runs
+        with self.settings(SCRUB_RATE_LIMIT=size):  # a second's worth is two of them
+            self.assertEqual(scrub_backups(2)[0], 1)
+
+
+class UploadClientMixin(TemporaryMediaMixin):
+    """
+    A company admin uploading through the API, with the company's storage to spare.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co', max_storage=50 * 1024 * 1024)])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+        Profile.objects.bulk_create([Profile(user=cls.user, company=cls.company, is_company_admin=True)])
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(uploads._running_digests.clear)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def start_upload(self, content: bytes, chunk_size: int, **fields):
+        return self.client.post('/backups/upload/sessions/', {
+            'filename': 'backup.zip', 'filesize': len(content), 'total_chunks': -(-len(content) // chunk_size),
+            'chunk_size': chunk_size, 'checksum': hashlib.md5(content).hexdigest(), 'checksum_algorithm': 'md5',
+            **fields})
+
+    def send_chunk(self, upload_id: str, content: bytes, chunk_index: int, chunk_size: int, **fields):
+        chunk = content[chunk_index * chunk_size:(chunk_index + 1) * chunk_size]
+        return self.client.post('/backups/upload/', {'upload_id': upload_id, 'chunk_index': chunk_index,
+                                                     'file': io.BytesIO(chunk), **fields})
+
+    def assertStorage(self, used: int, reserved: int):
+        self.company.refresh_from_db()
+        self.assertEqual((self.company.used_storage, self.company.reserved_storage), (used, reserved))
+
+
+class UploadSessionTests(UploadClientMixin, TestCase):
+    content = random.Random(2).randbytes(2500)
+
+    def test_chunks_in_any_order(self):
+        response = self.start_upload(self.content, 1000)
+        self.assertEqual(response.status_code, 201)
+        upload_id = response.data['upload_id']
+        self.assertEqual(response['Location'], f"/backups/upload/sessions/{upload_id}/")
+        session = UploadSession.objects.get(id=upload_id)
+        self.assertEqual(os.path.getsize(uploads.staging_path(session)), len(self.content))  # preallocated
+        self.assertStorage(0, len(self.content))
+
+        self.assertEqual(self.send_chunk(upload_id, self.content, 2, 1000).status_code, 200)
+        self.assertEqual(self.send_chunk(upload_id, self.content, 0, 1000).status_code, 200)
+        response = self.client.get(f"/backups/upload/sessions/{upload_id}/")
+        self.assertEqual((response.data['received_chunks'], response.data['missing_chunks']), ([0, 2], [1]))
+        self.assertEqual(response['Upload-Offset'], '1000')
+
+        response = self.send_chunk(upload_id, self.content, 1, 1000)
+        self.assertEqual((response.status_code, response.content), (200, b"File uploaded successfully"))
+        session.refresh_from_db()
+        backup = session.backup
+        self.assertEqual(session.status, UploadSession.COMPLETE)
+        self.assertEqual((backup.checksum, backup.filesize), (hashlib.md5(self.content).hexdigest(), 2500))
+        with open(backup.file.path, 'rb') as backup_file:
+            self.assertEqual(backup_file.read(), self.content)
+        self.assertFalse(os.path.exists(uploads.staging_dir(session)))
+        self.assertStorage(len(self.content), 0)  # the reservation turned into used storage
+
+    def test_bad_chunk_is_sent_again(self):
+        upload_id = self.start_upload(self.content, 1000).data['upload_id']
+        response = self.send_chunk(upload_id, self.content, 0, 1000, chunk_checksum=hashlib.md5(b'other').hexdigest())
+        self.assertEqual(response.status_code, 460)
+        self.assertEqual(UploadSession.objects.get(id=upload_id).received_chunks(), [])
+
+        for chunk_index in range(3):
+            response = self.send_chunk(upload_id, self.content, chunk_index, 1000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Backup.objects.get().checksum, hashlib.md5(self.content).hexdigest())
+
+    def test_checksum_mismatch_discards_the_upload(self):
+        upload_id = self.start_upload(self.content, 1000, checksum=hashlib.md5(b'other').hexdigest()).data['upload_id']
+        staging_dir = uploads.staging_dir(UploadSession.objects.get(id=upload_id))
+        for chunk_index in range(3):
+            response = self.send_chunk(upload_id, self.content, chunk_index, 1000)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertFalse(Backup.objects.exists())
+        self.assertFalse(os.path.exists(staging_dir))
+        self.assertStorage(0, 0)
+
+    def test_stored_backups_keep_their_name(self):
+        # once the first upload is in the chunk store its file is gone, but not its name
+        names = []
+        for _ in range(2):
+            upload_id = self.start_upload(self.content, 1000).data['upload_id']
+            for chunk_index in range(3):
+                self.send_chunk(upload_id, self.content, chunk_index, 1000)
+            run_pending_jobs()
+            names.append(UploadSession.objects.get(id=upload_id).backup.file.name)
+        self.assertNotEqual(names[0], names[1])
+        self.assertEqual(Backup.objects.filter(storage_tier=CHUNK_TIER).count(), 2)
+
+    def test_storage_limit(self):
+        response = self.client.post('/backups/upload/sessions/', {'filename': 'backup.zip',
+                                                                  'filesize': 51 * 1024 * 1024, 'total_chunks': 1})
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertStorage(0, 0)
+
+    def test_chunks_push_the_expiry_back(self):
+        upload_id = self.start_upload(self.content, 1000).data['upload_id']
+        UploadSession.objects.filter(id=upload_id).update(expires=timezone.now() + timedelta(minutes=1))
+        self.send_chunk(upload_id, self.content, 0, 1000)
+        expires = UploadSession.objects.get(id=upload_id).expires
+        self.assertGreater(expires, timezone.now() + timedelta(seconds=settings.UPLOAD_SESSION_MAX_AGE - 60))
+
+    def start_manifest_upload(self, filename: str, content: bytes) -> tuple[dict, list]:
+        manifest = [[hashlib.sha256(data).hexdigest(), len(data)] for data in iter_chunks(io.BytesIO(content))]
+        response = self.client.post('/backups/upload/sessions/', {
+            'filename': filename, 'manifest': manifest, 'checksum': hashlib.md5(content).hexdigest()}, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data, manifest
+
+    def send_manifest_chunk(self, upload_id: str, content: bytes, manifest: list, chunk_index: int):
+        offset = sum(size for digest, size in manifest[:chunk_index])
+        chunk = content[offset:offset + manifest[chunk_index][1]]
+        return self.client.post('/backups/upload/', {'upload_id': upload_id, 'chunk_index': chunk_index,
+                                                     'file': io.BytesIO(chunk)})
+
+    def test_known_chunks_are_filled_in_by_a_job(self):
+        content = random.Random(5).randbytes(300_000)
+        upload, manifest = self.start_manifest_upload('first.zip', content)
+        self.assertEqual((upload['missing_chunks'], upload['filling_chunks']), (list(range(len(manifest))), []))
+        for chunk_index in range(len(manifest)):
+            self.send_manifest_chunk(upload['upload_id'], content, manifest, chunk_index)
+        run_pending_jobs()  # the first backup goes into the chunk store
+
+        # the same file again: nothing to send, and nothing copied while the request waited
+        upload, manifest = self.start_manifest_upload('again.zip', content)
+        self.assertEqual((upload['status'], upload['missing_chunks'], upload['filling_chunks']),
+                         (UploadSession.UPLOADING, [], list(range(len(manifest)))))
+        run_pending_jobs()
+        session = UploadSession.objects.get(id=upload['upload_id'])
+        self.assertEqual((session.status, session.backup.storage_tier), (UploadSession.COMPLETE, CHUNK_TIER))
+        with backup_opener(session.backup)() as backup_file:
+            self.assertEqual(backup_file.read(), content)
+
+        # a new version: only its new chunks are sent, it's finished by whichever of the two comes last
+        changed = content + b'new data at the end'
+        upload, manifest = self.start_manifest_upload('changed.zip', changed)
+        self.assertEqual(upload['missing_chunks'], [len(manifest) - 1])
+        response = self.send_manifest_chunk(upload['upload_id'], changed, manifest, len(manifest) - 1)
+        self.assertEqual((response.status_code, response.content), (200, b"Chunk uploaded successfully"))
+        self.assertEqual(UploadSession.objects.get(id=upload['upload_id']).status, UploadSession.UPLOADING)
+        run_pending_jobs()
+        session = UploadSession.objects.get(id=upload['upload_id'])
+        self.assertEqual((session.status, session.backup.checksum), (UploadSession.COMPLETE,
+                                                                     hashlib.md5(changed).hexdigest()))
+
+    def test_abandoned_and_expired_sessions(self):
+        abandoned = self.start_upload(self.content, 1000).data['upload_id']
+        expired = self.start_upload(self.content, 1000).data['upload_id']
+        staging_dir = uploads.staging_dir(UploadSession.objects.get(id=abandoned))
+        self.send_chunk(abandoned, self.content, 0, 1000)
+
+        self.assertEqual(self.client.delete(f"/backups/upload/sessions/{abandoned}/").status_code, 204)
+        self.assertFalse(os.path.exists(staging_dir))
+        UploadSession.objects.filter(id=expired).update(expires=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(self.client.get(f"/backups/upload/sessions/{expired}/").status_code, 410)
+
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertStorage(0, 0)
+
+
+@skipUnless(mock_aws, "needs moto")
+class MultipartUploadTests(UploadClientMixin, TestCase):
+    """
+    Uploads to an S3 hot store go straight into a multipart upload, in moto's pretend S3.
+    """
+    content = random.Random(3).randbytes(MIN_PART_SIZE * 2 + 100)
+
+    def setUp(self):
+        super().setUp()
+        self.enterContext(mock_aws())
+        self.addCleanup(objectstore._object_stores.clear)  # its S3 client only works inside this test's mock
+        self.s3 = boto3.client('s3', region_name='us-east-1')
+        self.s3.create_bucket(Bucket='backups')
+        self.enterContext(override_settings(UPLOAD_MULTIPART_PASSTHROUGH=True, BACKUP_HOT_STORE={
+            'BACKEND': 's3', 'OPTIONS': {'bucket': 'backups', 'prefix': 'sr/', 'region_name': 'us-east-1'}}))
+
+    def multipart_uploads(self) -> list:
+        return self.s3.list_multipart_uploads(Bucket='backups').get('Uploads', [])
+
+    def keys(self) -> list:
+        return [item['Key'] for item in self.s3.list_objects_v2(Bucket='backups').get('Contents', [])]
+
+    def upload(self) -> Backup:
+        upload_id = self.start_upload(self.content, MIN_PART_SIZE).data['upload_id']
+        for chunk_index in range(3):
+            self.send_chunk(upload_id, self.content, chunk_index, MIN_PART_SIZE)
+        return Backup.objects.get()
+
+    def test_chunks_go_to_the_store(self):
+        upload_id = self.start_upload(self.content, MIN_PART_SIZE).data['upload_id']
+        session = UploadSession.objects.get(id=upload_id)
+        self.assertEqual(session.multipart_key, f"uploads/{upload_id}/backup.zip")
+        self.assertFalse(os.path.exists(uploads.staging_dir(session)))
+
+        for chunk_index in (1, 2, 0):  # out of order, so the digest is worked out from the assembled object
+            response = self.send_chunk(upload_id, self.content, chunk_index, MIN_PART_SIZE)
+        self.assertEqual(response.status_code, 200)
+
+        # a hot backup like any other, its file in the bucket under its name
+        backup = Backup.objects.get()
+        self.assertEqual((backup.storage_tier, backup.archive_key, backup.filesize, backup.file.name),
+                         (HOT_TIER, '', len(self.content), 'backups/Co/backup.zip'))
+        self.assertEqual(backup.checksum, hashlib.md5(self.content).hexdigest())
+        self.assertEqual(self.keys(), ['sr/backups/Co/backup.zip'])  # the assembled upload was moved there
+        with backup.file.open() as backup_file:
+            self.assertEqual(backup_file.read(), self.content)
+        self.assertEqual(self.multipart_uploads(), [])
+        self.assertStorage(len(self.content), 0)
+
+    def test_same_name_twice(self):
+        first = self.upload()
+        upload_id = self.start_upload(self.content, MIN_PART_SIZE).data['upload_id']
+        for chunk_index in range(3):
+            self.send_chunk(upload_id, self.content, chunk_index, MIN_PART_SIZE)
+        second = UploadSession.objects.get(id=upload_id).backup
+        self.assertNotEqual(first.file.name, second.file.name)  # the name was claimed with a conditional write
+        self.assertEqual(len(self.keys()), 2)
+
+    def test_download_and_chunk_store(self):
+        backup = self.upload()
+        response = self.client.get(f"/backups/download_backup/{backup.id}/")
+        self.assertEqual(response.status_code, 302)  # to the bucket, which handles ranges itself
+        self.assertIn('sr/backups/Co/backup.zip', response['Location'])
+
+        run_pending_jobs()  # read back out of the bucket into the chunk store, and removed from it
+        backup.refresh_from_db()
+        self.assertEqual(backup.storage_tier, CHUNK_TIER)
+        self.assertEqual(self.keys(), [])
+        response = self.client.get(f"/backups/download_backup/{backup.id}/", HTTP_RANGE='bytes=100-199')
+        self.assertEqual((response.status_code, response.getvalue()), (206, self.content[100:200]))
+
+    def test_hot_file_reads_seek(self):
+        backup = self.upload()
+        with backup_opener(backup)() as backup_file:
+            backup_file.seek(-10, io.SEEK_END)
+            self.assertEqual(backup_file.read(), self.content[-10:])
+            backup_file.seek(MIN_PART_SIZE)
+            self.assertEqual(backup_file.read(10), self.content[MIN_PART_SIZE:MIN_PART_SIZE + 10])
+
+    def test_small_chunks_are_staged_locally(self):
+        # S3 parts have to be at least MIN_PART_SIZE
+        session = UploadSession.objects.get(id=self.start_upload(self.content[:2500], 1000).data['upload_id'])
+        self.assertEqual(session.multipart_upload_id, '')
+        self.assertTrue(os.path.isfile(uploads.staging_path(session)))
+
+    def test_staged_locally_when_the_store_fails(self):
+        with mock.patch.object(S3ObjectStore, 'start_multipart', side_effect=ObjectStoreError("unavailable")):
+            upload_id = self.start_upload(self.content, MIN_PART_SIZE).data['upload_id']
+        self.assertEqual(UploadSession.objects.get(id=upload_id).multipart_upload_id, '')
+
+        for chunk_index in range(3):
+            response = self.send_chunk(upload_id, self.content, chunk_index, MIN_PART_SIZE)
+        self.assertEqual(response.status_code, 200)
+        backup = Backup.objects.get()
+        self.assertEqual((backup.storage_tier, backup.checksum), (HOT_TIER, hashlib.md5(self.content).hexdigest()))
+
+    def test_expired_session_aborts_the_multipart_upload(self):
+        upload_id = self.start_upload(self.content, MIN_PART_SIZE).data['upload_id']
+        self.send_chunk(upload_id, self.content, 0, MIN_PART_SIZE)
+        self.assertEqual(len(self.multipart_uploads()), 1)
+
+        UploadSession.objects.filter(id=upload_id).update(expires=timezone.now() - timedelta(seconds=1))
+        cleanup_incomplete_uploads()
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(self.multipart_uploads(), [])
+        self.assertStorage(0, 0)
+
+
+class DownloadTests(UploadClientMixin, TestCase):
+    content = bytes(range(256)) * 4
+
+    def setUp(self):
+        super().setUp()
+        self.backup = self.backup_file('backup.zip', self.content, checksum=hashlib.md5(self.content).hexdigest(),
+                                       checksum_algorithm='md5')
+        self.url = f"/backups/download_backup/{self.backup.id}/"
+        self.etag = f'"md5-{self.backup.checksum}"'
+
+    def test_whole_file(self):
+        response = self.client.get(self.url)
+        self.assertEqual((response.status_code, response.getvalue()), (200, self.content))
+        self.assertEqual((response['ETag'], response['Accept-Ranges']), (self.etag, 'bytes'))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="backup.zip"')
+
+    def test_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, response.getvalue()), (206, self.content[10:20]))
+        self.assertEqual(response['Content-Range'], f"bytes 10-19/{len(self.content)}")
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-5')
+        self.assertEqual((response.status_code, response.getvalue()), (206, self.content[-5:]))
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-1,100-101')
+        body = response.getvalue()
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response['Content-Type'].startswith('multipart/byteranges; boundary='))
+        self.assertEqual(int(response['Content-Length']), len(body))
+        self.assertIn(b"Content-Range: bytes 100-101/1024\r\n\r\n" + self.content[100:102], body)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5000-')
+        self.assertEqual((response.status_code, response['Content-Range']), (416, 'bytes */1024'))
+
+    def test_conditional_requests(self):
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=self.etag)
+        self.assertEqual((response.status_code, response['ETag']), (304, self.etag))
+
+        # a resumed download of a file that has since changed gets the whole new file
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"md5-earlier"')
+        self.assertEqual((response.status_code, response.getvalue()), (200, self.content))
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE=self.etag)
+        self.assertEqual(response.status_code, 206)
+
+    def test_weak_etag_without_a_checksum(self):
+        Backup.objects.filter(pk=self.backup.pk).update(checksum='', checksum_algorithm='')
+        response = self.client.get(self.url)
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('W/"'))
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # If-Range needs a strong ETag
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=etag).status_code, 200)
+
+    def test_other_companies_backups(self):
+        other, = Company.objects.bulk_create([Company(name='Other')])
+        Backup.objects.filter(pk=self.backup.pk).update(company=other)
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_delta_base_has_to_be_a_backup(self):
+        for base in ('', 'abc', '0', str(self.backup.id + 1)):
+            response = self.client.get(f"/backups/delta/{self.backup.id}/", {'base': base})
+            self.assertEqual(response.status_code, 400, base)
+
+    def test_chunked_backup(self):
+        content = random.Random(6).randbytes(300_000)
+        backup = self.backup_file('chunked.zip', content, checksum=hashlib.md5(content).hexdigest(),
+                                  checksum_algorithm='md5')
+        self.assertGreater(len(store_backup_chunks(backup).chunks), 2)
+        url = f"/backups/download_backup/{backup.id}/"
+
+        response = self.client.get(url)
+        self.assertEqual((response.status_code, response.getvalue()), (200, content))
+        self.assertEqual(response['ETag'], f'"md5-{backup.checksum}"')
+        response = self.client.get(url, HTTP_RANGE='bytes=100000-200000')  # across chunk boundaries
+        self.assertEqual((response.status_code, response.getvalue()), (206, content[100000:200001]))
+        response = self.client.get(url, HTTP_RANGE='bytes=0-1,-3')
+        self.assertIn(b"Content-Range: bytes 299997-299999/300000\r\n\r\n" + content[-3:], response.getvalue())
+
+    @override_settings(ARCHIVE_COMPRESSION=True)
+    def test_compressed_archive_is_sent_whole(self):
+        self.assertTrue(archive_backup(self.backup))
+        response = self.client.get(self.url, {'recall': 1}, HTTP_RANGE='bytes=10-19')
+        self.assertEqual((response.status_code, response.getvalue()), (200, self.content))
+        self.assertEqual((response['Accept-Ranges'], response['ETag']), ('none', self.etag))
+        self.assertTrue(Job.objects.filter(kind='recall_backup', status=Job.PENDING).exists())
+
+
+class RetentionTests(TemporaryMediaMixin, TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.company, = Company.objects.bulk_create([Company(name='Co')])
+        cls.user, = User.objects.bulk_create([User(username='bob')])
+
+    def dated_backup(self, name: str, day: int, hour: int, directory: str = 'Co') -> Backup:
+        backup = self.backup_file(name, name.encode(), directory=directory)
+        backup.date_uploaded = timezone.make_aware(datetime(2024, 3, day, hour))
+        Backup.objects.filter(pk=backup.pk).update(date_uploaded=backup.date_uploaded)
+        return backup
+
+    def test_keeps_the_newest_of_each_day(self):
+        RetentionPolicy.objects.create(company=self.company, keep_daily=2, keep_weekly=0, keep_monthly=0)
+        newest, same_day, yesterday, older = (self.dated_backup('a.zip', 5, 18), self.dated_backup('b.zip', 5, 9),
+                                              self.dated_backup('c.zip', 4, 12), self.dated_backup('d.zip', 3, 12))
+        other_series = self.dated_backup('e.zip', 1, 12, directory='Co/OTHER')  # every folder is its own series
+
+        report, = apply_retention(dry_run=True)
+        self.assertEqual({backup['id'] for backup in report['expired']}, {same_day.id, older.id})
+        self.assertEqual(Backup.objects.count(), 5)
+
+        with self.captureOnCommitCallbacks(execute=True):  # django-cleanup removes the files once it's committed
+            report, = apply_retention()
+        self.assertEqual(report['freed'], same_day.filesize + older.filesize)
+        self.assertEqual(set(Backup.objects.values_list('id', flat=True)), {newest.id, yesterday.id, other_series.id})
+        self.assertFalse(os.path.exists(older.file.path))
+        self.assertTrue(os.path.exists(newest.file.path))
+
+    def test_policy_that_keeps_nothing_is_ignored(self):
+        RetentionPolicy.objects.create(company=self.company, keep_daily=0, keep_weekly=0, keep_monthly=0)
+        self.dated_backup('a.zip', 5, 18)
+        self.assertEqual(apply_retention(), [])
+        self.assertEqual(Backup.objects.count(), 1)
+
+
+@override_settings(ARCHIVE_RECALL_KEEP_DAYS=7)
+class ArchiveTests(UploadClientMixin, TestCase):
+    compressible = b'payroll ' * 10000
+    incompressible = random.Random(4).randbytes(10000)
+
+    def aged_backup(self, name: str, content: bytes, days: int) -> Backup:
+        backup = self.backup_file(name, content)
+        Backup.objects.filter(pk=backup.pk).update(date_uploaded=timezone.now() - timedelta(days=days))
+        return backup
+
+    def test_cold_backups_are_archived(self):
+        ArchivePolicy.objects.create(company=self.company, archive_after_days=30)
+        old, recent = self.aged_backup('old.zip', self.compressible, 40), self.aged_backup('new.zip', b'new', 5)
+        self.assertEqual(archive_cold_backups(), 1)
+
+        old.refresh_from_db()
+        self.assertEqual((old.storage_tier, old.archive_compressed), (ARCHIVE_TIER, True))
+        self.assertTrue(old.archive_key.endswith('.gz'))
+        self.assertFalse(os.path.exists(old.file.path))
+        self.assertEqual(Backup.objects.get(pk=recent.pk).storage_tier, HOT_TIER)
+
+    def test_recall(self):
+        for content in (self.compressible, self.incompressible):
+            with self.subTest(compressed=content is self.compressible):
+                backup = self.backup_file('backup.zip', content)
+                self.assertTrue(archive_backup(backup))
+                backup.refresh_from_db()
+                self.assertTrue(recall_backup(backup))
+
+                backup.refresh_from_db()
+                self.assertEqual(backup.storage_tier, HOT_TIER)
+                self.assertIsNotNone(backup.recalled_at)
+                with open(backup.file.path, 'rb') as backup_file:
+                    self.assertEqual(backup_file.read(), content)
+                backup.delete()
+
+    def test_chunked_backup_is_recalled_into_the_chunk_store(self):
+        backup = self.backup_file('backup.zip', self.incompressible)
+        chunks = store_backup_chunks(backup).chunks
+        self.assertTrue(archive_backup(backup))
+        self.assertFalse(Chunk.objects.exists())  # the archive has it now
+
+        backup.refresh_from_db()
+        self.assertTrue(recall_backup(backup))
+        backup.refresh_from_db()
+        self.assertEqual((backup.storage_tier, backup.manifest.chunks), (CHUNK_TIER, chunks))
+        self.assertEqual(Chunk.objects.count(), len({digest for digest, size in chunks}))
+        with backup_opener(backup)() as backup_file:
+            self.assertEqual(backup_file.read(), self.incompressible)
+
+    def test_recalled_backups_stay_hot_for_a_while(self):
+        ArchivePolicy.objects.create(company=self.company, archive_after_days=30)
+        backup = self.aged_backup('old.zip', self.incompressible, 40)
+        archive_backup(backup)
+        backup.refresh_from_db()
+        recall_backup(backup)
+        self.assertEqual(archive_cold_backups(), 0)
+
+        Backup.objects.filter(pk=backup.pk).update(recalled_at=timezone.now() - timedelta(days=8))
+        self.assertEqual(archive_cold_backups(), 1)
+        backup.refresh_from_db()
+        self.assertTrue(backup.archive_key)  # the copy made the first time round was used again
+
+    def test_recall_api(self):
+        backup = self.backup_file('backup.zip', self.compressible)
+        archive_backup(backup)
+        url = f"/backups/recall/{backup.id}/"
+
+        response = self.client.post(url)
+        self.assertEqual((response.status_code, response['Retry-After']), (202, '60'))
+        run_pending_jobs()  # recalled to its own file, then moved into the chunk store
+        response = self.client.post(url)
+        self.assertEqual((response.status_code, response.data), (200, {'id': backup.id, 'storage_tier': CHUNK_TIER}))
@@ -0,0 +1,348 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from django.conf import settings
+from django.db import transaction
+from backups.models import Backup, UploadSession
+from backups.objectstore import MAX_PARTS, MIN_PART_SIZE, get_hot_store
+from backups.quota import StorageLimitExceeded, reserve_storage
+
+logger = logging.getLogger(__name__)
+
+
+class ChunkError(Exception):
+    """raised when a chunk doesn't fit the upload session it was sent for"""
+
+
+class ChunkChecksumError(ChunkError):
+    """raised when a chunk doesn't match the checksum the client sent with it"""
+
+
+class RunningDigest:
+    """
+    The digest of the first `offset` bytes of an upload, updated as chunks arrive so the finished file never has to be
+    read back just to checksum it.
+
+    hashlib objects can't be pickled (or their state saved any other way), so this only lives in the memory of the
+    worker the chunks went to. A worker that hasn't seen the earlier chunks (another process, or one that restarted)
+    starts from the beginning and catches up by reading the staging file, once, when it needs the digest: hashlib
+    reads it at roughly 350MB/s for md5 and 700MB/s for sha256 when it's in the page cache, so a 1GB upload finished
+    on the wrong worker costs about 3 seconds (1.5 with sha256) more.
+    """
+
+    def __init__(self, algorithm: str):
+        self.offset = 0
+        self.hasher = hashlib.new(algorithm)
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+
+
+_running_digests: dict = {}
+_running_digests_lock = threading.Lock()
+
+HASH_READ_SIZE = 1024 * 1024  # read 1MB at a time when catching the digest up from the staging file
+# digests of uploads this worker hasn't had a chunk of in this long are dropped (the upload was finished by another
+# worker, or abandoned), if it does come back they're caught up from the staging file
+DIGEST_IDLE_TIMEOUT = 60 * 60
+
+
+def staging_dir(session: UploadSession) -> str:
+    """
+    Every upload session stages its bytes in a directory of its own (MEDIA_ROOT/uploads/<session id>), so throwing a
+    session away only ever touches its own files, not the other uploads in flight.
+    """
+    return os.path.join(settings.MEDIA_ROOT, 'uploads', str(session.id))
+
+
+def staging_path(session: UploadSession) -> str:
+    """
+    Every upload is assembled in a single staging file. Chunks are written straight to their offset in it, so when
+    the last chunk arrives the file only has to be renamed into place.
+    """
+    return os.path.join(staging_dir(session), 'upload')
+
+
+def can_use_multipart(session: UploadSession) -> bool:
+    """
+    Whether the session's chunks can go straight to the hot store as the parts of a multipart upload. S3 needs
+    every part but the last to be at least 5MB and allows 10,000 of them, so the chunk size has to be declared up
+    front. Content-defined chunks are too small and get filled in from the chunk store, so those stay on local disk.
+    """
+    return (settings.UPLOAD_MULTIPART_PASSTHROUGH and get_hot_store().remote and not session.manifest and
+            session.total_chunks <= MAX_PARTS and
+            (session.total_chunks == 1 or (session.chunk_size or 0) >= MIN_PART_SIZE))
+
+
+def start_multipart_upload(session: UploadSession) -> bool:
+    key = f"uploads/{session.id}/{session.filename}"
+    try:
+        upload_id = get_hot_store().start_multipart(key)
+    except Exception as e:
+        logger.warning(f"Could not start a multipart upload for '{session.filename}', staging it locally. Error: {e}")
+        return False
+
+    session.multipart_key, session.multipart_upload_id = key, upload_id
+    UploadSession.objects.filter(id=session.id).update(multipart_key=key, multipart_upload_id=upload_id)
+    return True
+
+
+def start_upload_session(**kwargs) -> UploadSession:
+    """
+    Create an upload session, reserving its size out of the company's storage, and preallocate its staging file at
+    the full expected size (or, with an S3 hot store, start the multipart upload its chunks go to). Raises
+    StorageLimitExceeded if the company doesn't have room for it.
+    """
+    company, filesize = kwargs['company'], kwargs['filesize']
+    # one transaction, so the company's reserved storage always matches the sessions holding it
+    with transaction.atomic():
+        if not reserve_storage(company, filesize):
+            raise StorageLimitExceeded(f"{filesize} bytes don't fit in the storage left for '{company.name}'.")
+        session = UploadSession.objects.create(reserved_storage=filesize, **kwargs)
+
+    if can_use_multipart(session) and start_multipart_upload(session):
+        return session
+
+    os.makedirs(staging_dir(session), exist_ok=True)
+    with open(staging_path(session), 'wb') as staging_file:
+        if session.filesize and hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(staging_file.fileno(), 0, session.filesize)
+        else:
+            staging_file.truncate(session.filesize)
+    return session
+
+
+def chunk_offset(session: UploadSession, chunk_index: int, size: int) -> int:
+    """
+    Work out where a chunk goes in the staging file. Every chunk except the last one is chunk_size bytes long, so the
+    last chunk always ends at filesize and the others start at chunk_index * chunk_size. Clients that don't declare a
+    chunk size have it taken from the first non-final chunk they send. Uploads with a manifest (content-defined
+    chunks) have their sizes listed up front.
+    """
+    if session.manifest:
+        digest, expected_size = session.manifest[chunk_index]
+        if size != expected_size:
+            raise ChunkError(f"Chunk {chunk_index} should be {expected_size} bytes, got {size} bytes.")
+        return session.manifest_offset(chunk_index)
+
+    last_chunk = chunk_index == session.total_chunks - 1
+
+    if last_chunk:
+        offset = session.filesize - size
+        if offset < 0 or (session.chunk_size and offset != chunk_index * session.chunk_size):
+            raise ChunkError(f"The last chunk should be {session.filesize - chunk_index * session.chunk_size} bytes, "
+                             f"got {size} bytes.")
+        return offset
+
+    if not session.chunk_size:
+        session.chunk_size = size
+    elif size != session.chunk_size:
+        raise ChunkError(f"Chunk {chunk_index} should be {session.chunk_size} bytes, got {size} bytes.")
+
+    offset = chunk_index * session.chunk_size
+    if offset + size > session.filesize:
+        raise ChunkError(f"Chunk {chunk_index} goes past the end of the file ({session.filesize} bytes).")
+    return offset
+
+
+def running_digest(session: UploadSession) -> RunningDigest:
+    now = time.monotonic()
+    with _running_digests_lock:
+        for session_id, idle in list(_running_digests.items()):
+            if now - idle.last_used > DIGEST_IDLE_TIMEOUT:
+                del _running_digests[session_id]
+
+        if session.id not in _running_digests:
+            _running_digests[session.id] = RunningDigest(session.checksum_algorithm)
+        digest = _running_digests[session.id]
+        digest.last_used = now
+        return digest
+
+
+def forget_digest(session: UploadSession):
+    with _running_digests_lock:
+        _running_digests.pop(session.id, None)
+
+
+def write_chunk(session: UploadSession, chunk_index: int, file_data, expected_checksum: str = '') -> str:
+    """
+    Write an uploaded chunk straight into its place in the staging file (or send it to the hot store as a
+    multipart upload part), hashing it on the way through. Returns the chunk's checksum. Raises ChunkChecksumError
+    if it doesn't match expected_checksum; the chunk isn't marked as received, so the client only has to send that
+    chunk again.
+    """
+    offset = chunk_offset(session, chunk_index, file_data.size)
+    chunk_hasher = hashlib.new(session.checksum_algorithm)
+    # chunks listed in a manifest have to be exactly the chunk the client said they'd be
+    manifest_hasher = hashlib.sha256() if session.manifest else None
+
+    # if this chunk is the next one the file digest needs (the usual case, chunks sent one after another),
+    # feed it to a copy of the digest while it's being written instead of reading it back later
+    digest = running_digest(session)
+    following = digest.lock.acquire(blocking=False)
+    file_hasher = digest.hasher.copy() if following and digest.offset == offset else None
+
+    def hash_piece(piece):
+        chunk_hasher.update(piece)
+        if manifest_hasher:
+            manifest_hasher.update(piece)
+        if file_hasher:
+            file_hasher.update(piece)
+
+    try:
+        if session.multipart_upload_id:
+            # checked before it's sent, so a bad chunk never becomes a part
+            for piece in file_data.chunks():
+                hash_piece(piece)
+        else:
+            # r+b so that chunks written by other requests (or other workers) aren't truncated away
+            with open(staging_path(session), 'r+b') as staging_file:
+                staging_file.seek(offset)
+                for piece in file_data.chunks():
+                    staging_file.write(piece)
+                    hash_piece(piece)
+
+        checksum = chunk_hasher.hexdigest()
+        if expected_checksum and expected_checksum.lower() != checksum:
+            raise ChunkChecksumError(f"Chunk {chunk_index} checksum mismatch, expected {expected_checksum} "
+                                     f"but received data hashes to {checksum} ({session.checksum_algorithm}).")
+        if manifest_hasher and manifest_hasher.hexdigest() != session.manifest[chunk_index][0]:
+            raise ChunkChecksumError(f"Chunk {chunk_index} doesn't match its sha256 digest in the manifest.")
+
+        if session.multipart_upload_id:
+            file_data.seek(0)
+            get_hot_store().put_part(session.multipart_key, session.multipart_upload_id, chunk_index + 1, file_data,
+                                     file_data.size)
+
+        if file_hasher:
+            digest.hasher = file_hasher
+            digest.offset = offset + file_data.size
+    finally:
+        if following:
+            digest.lock.release()
+
+    return checksum
+
+
+def read_upload(session: UploadSession, start: int, end: int):
+    """
+    The received bytes of an upload from start up to end (not included). A multipart upload can only be read back
+    once it's been assembled.
+    """
+    if session.multipart_upload_id:
+        yield from get_hot_store().read_range(session.multipart_key, start, end - 1)
+        return
+
+    with open(staging_path(session), 'rb') as staging_file:
+        staging_file.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            data = staging_file.read(min(HASH_READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+
+
+def advance_digest(session: UploadSession, assembled: bool = False) -> int:
+    """
+    Hash whatever received bytes follow the running digest (chunks that arrived out of order, or were handled by
+    another worker). Returns the offset the digest has reached. The parts of a multipart upload aren't readable until
+    it's assembled, so until then its digest only follows chunks that arrive in order.
+    """
+    digest = running_digest(session)
+    end = session.contiguous_offset
+
+    with digest.lock:
+        if digest.offset < end and (assembled or not session.multipart_upload_id):
+            for data in read_upload(session, digest.offset, end):
+                digest.hasher.update(data)
+                digest.offset += len(data)
+        return digest.offset
+
+
+def assemble_upload(session: UploadSession):
+    """
+    Put a multipart upload's parts together into one object in the store. Chunks written to a staging file are
+    already in place. Only call once every chunk has been received.
+    """
+    if session.multipart_upload_id:
+        get_hot_store().complete_multipart(session.multipart_key, session.multipart_upload_id, session.filesize)
+
+
+def final_digest(session: UploadSession) -> str:
+    """
+    The checksum of the whole uploaded file. Only call once the upload has been assembled.
+    """
+    advance_digest(session, assembled=True)
+    digest = running_digest(session)
+    with digest.lock:
+        return digest.hasher.hexdigest()
+
+
+def finalize_upload(session: UploadSession, final_name: str):
+    """
+    Move the assembled upload to its final (already reserved) name in the hot store. A staging file is renamed into
+    place when the store is MEDIA_ROOT (both live under it, so that's not a copy), and copied into a bucket otherwise.
+    A multipart upload is copied to its name within the bucket, and the object it was assembled in removed.
+    """
+    store = get_hot_store()
+    if session.multipart_upload_id:
+        store.copy(session.multipart_key, final_name)
+        store.delete(session.multipart_key)
+        forget_digest(session)
+        return
+
+    final_path = store.local_path(final_name)
+    if final_path is not None:
+        with open(staging_path(session), 'r+b') as staging_file:
+            os.fsync(staging_file.fileno())  # make sure the bytes are on disk before the backup is recorded
+        os.replace(staging_path(session), final_path)
+    else:
+        with open(staging_path(session), 'rb') as staging_file:
+            store.put_file(staging_file, final_name)
+        os.remove(staging_path(session))
+    try:
+        os.rmdir(staging_dir(session))
+    except OSError:
+        pass  # whatever is left goes when the session does
+    forget_digest(session)
+
+
+def discard_upload(session: UploadSession):
+    """
+    Delete an upload session's staging directory (if it's still there). Called whenever a session is deleted (see
+    backups/signals.py), where a multipart upload is aborted too.
+    """
+    forget_digest(session)
+    shutil.rmtree(staging_dir(session), ignore_errors=True)
+
+
+def reserve_available_name(final_name: str) -> str:
+    """
+    Atomically claim a name in the hot store that isn't taken yet, by creating an empty placeholder object only if
+    there's none (see create_exclusive). A backup that's been moved out of its file (into the chunk store or the
+    archive) keeps its name too, so a name in use by a backup is skipped even if there's no file. Returns the name that
+    was claimed; the caller is responsible for replacing (or removing) the placeholder.
+    """
+    name, ext = os.path.splitext(final_name)
+    candidates = [final_name, f"{name} ({datetime.now().strftime('%m-%d-%Y at %H.%M.%S')}){ext}"]
+
+    attempt = 0
+    while True:
+        if attempt < len(candidates):
+            candidate = candidates[attempt]
+        else:  # two uploads of the same file in the same second
+            candidate = f"{os.path.splitext(candidates[1])[0]} ({attempt}){ext}"
+
+        if Backup.objects.filter(file=candidate).exists():
+            attempt += 1
+            continue
+
+        if not get_hot_store().create_exclusive(candidate):
+            attempt += 1
+            continue
+        return candidate
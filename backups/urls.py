@@ -3,10 +3,20 @@ from . import views
 
 urlpatterns = [
     path('upload/', views.upload, name='upload'),
+    path('upload/sessions/', views.upload_session_create, name='upload_session_create'),
+    path('upload/sessions/<uuid:upload_id>/', views.upload_session_status, name='upload_session_status'),
     path('get_backups_list/', views.get_backups_list, name='get_backups_list'),
     path('get_backups_list/<str:company_code>/', views.get_backups_list, name='get_backups_list'),
     path('get_directories/', views.get_directories, name='get_directories_list'),
     path('download_backup/<int:backup_id>/', views.download_backup, name='download_backup'),
+    path('manifest/<int:backup_id>/', views.backup_manifest, name='backup_manifest'),
+    path('zip_members/<int:backup_id>/', views.backup_zip_members, name='backup_zip_members'),
+    path('zip_members/<int:backup_id>/<path:member_name>', views.backup_zip_member, name='backup_zip_member'),
+    path('delta/<int:backup_id>/', views.backup_delta, name='backup_delta'),
+    path('recall/<int:backup_id>/', views.recall_backup, name='recall_backup'),
+    path('comments/<int:backup_id>/', views.backup_comments, name='backup_comments'),
+    path('search/', views.search_backups_api, name='search_backups'),
+    path('chunks/<str:digest>/', views.get_chunk, name='get_chunk'),
     path('manual_upload/', views.manual_upload, name='manual_upload'),
     path('delete/<int:pk>/', views.BackupDeleteView.as_view(), name='delete'),
     path('user_list/', views.BackupListView.as_view(), name='user_list'),
@@ -1,6 +1,7 @@
 import logging
 import os
 import math
+import time
 import hashlib
 from datetime import datetime
 from SoftriteAPI.settings import MEDIA_ROOT
@@ -27,50 +28,78 @@ def convert_size(size_bytes: int | bytes) -> str:
     return f"{size:.2f} {unit}"
 
 
-def calculate_checksum(filepath: str) -> str:
-    hasher = hashlib.md5()
+def calculate_checksum(filepath: str, algorithm: str = 'md5') -> str:
+    hasher = hashlib.new(algorithm)
     with open(filepath, "rb") as file:
-        for chunk in iter(lambda: file.read(4096), b""):
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
             hasher.update(chunk)
     return hasher.hexdigest()
 
 
-def get_available_name(name: str) -> str:
-    if os.path.exists(name):
-        now = datetime.now().strftime('%m-%d-%Y at %H.%M.%S')
-        name, ext = os.path.splitext(name)
-        return f"{name} ({now}){ext}"
-    return name
+def cleanup_incomplete_uploads():
+    """
+    Delete the upload sessions that have expired. Their staging directories (and reserved storage, and multipart
+    uploads) go with them through the post_delete signals. expires is indexed, so this only ever looks at the expired
+    sessions, however many uploads are in flight.
+    """
+    from django.utils import timezone
+    from backups.models import UploadSession
 
+    _, deleted = UploadSession.objects.filter(expires__lte=timezone.now()).delete()
+    if deleted.get(UploadSession._meta.label):
+        logger.info(f"Removed {deleted[UploadSession._meta.label]} expired upload session(s).")
 
-def cleanup_incomplete_uploads():
-    destination = os.path.join(MEDIA_ROOT, 'uploads')
-    MAX_AGE = 60 * 60 * 3  # 3 hours
-    for file in os.listdir(destination):
-        file_path = os.path.join(destination, file)
-        # check if file is older than the max age, if so, delete it
-        if os.stat(file_path).st_mtime < datetime.now().timestamp() - MAX_AGE:
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-
-
-def remove_empty_folders(path, removeRoot=True):  # removeRoot specifies whether to delete the root dir
-    """Function to remove empty folders"""
-    if not os.path.isdir(path):
-        return
-
-    # remove empty folders
-    files = os.listdir(path)
-    if len(files):
-        for f in files:
-            fullpath = os.path.join(path, f)
-            if os.path.isdir(fullpath):
-                remove_empty_folders(fullpath)
-
-    # if folder empty, delete it
-    files = os.listdir(path)
-    if len(files) == 0 and removeRoot:
-        logger.info(f"Removed empty directory: {path}")
-        os.rmdir(path)
+
+def remove_empty_parents(path: str, root: str):
+    """
+    Remove path and the folders above it, up to (not including) root, for as long as they're empty. Cheap enough to
+    run whenever a file goes: one rmdir per level, and it stops at the first folder that still has something in it.
+    """
+    root = os.path.abspath(root)
+    path = os.path.abspath(path)
+    while path != root and path.startswith(root + os.sep):
+        try:
+            os.rmdir(path)  # only ever removes an empty folder
+        except FileNotFoundError:
+            pass
+        except OSError:  # not empty (or in use), and so neither is anything above it
+            return
+        else:
+            logger.info(f"Removed empty directory: {path}")
+        path = os.path.dirname(path)
+
+
+def sweep_empty_folders(root: str, cursor: str = None, limit: int = 1000, pause: float = 0) -> str | None:
+    """
+    Look through the folders under root (root itself is never removed) and remove the empty ones, at most limit
+    folders per call with a pause after each, so a big tree is swept in slices without hogging the disk. Folders are
+    visited in sorted order; the return value is the cursor to pass to the next call to carry on where this one
+    stopped, None once the whole tree has been looked at.
+    """
+    after = tuple(cursor.split('/')) if cursor else ()
+    checked = 0
+    stack = [()]  # relative paths, as tuples of names, still to be visited
+    while stack:
+        relative = stack.pop()
+        if relative and relative < after and after[:len(relative)] != relative:
+            continue  # this folder and everything under it was swept by an earlier call
+
+        try:
+            with os.scandir(os.path.join(root, *relative)) as entries:
+                children = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in entries]
+        except FileNotFoundError:  # removed while the sweep was going
+            continue
+        stack += [relative + (name,) for name, is_dir in sorted(children, reverse=True) if is_dir]
+
+        if relative <= after:
+            continue  # on the way down to where the last call stopped
+        if not children:
+            remove_empty_parents(os.path.join(root, *relative), root)
+        checked += 1
+        if checked >= limit and stack:
+            return '/'.join(relative)
+        if pause:
+            time.sleep(pause)
+    return None
 
 
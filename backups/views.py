@@ -1,14 +1,32 @@
+import re
+import json
 import uuid
 import os.path
+import mimetypes
 from SoftriteAPI.settings import EMAIL_HOST_USER
+from django.conf import settings
 from .forms import *
 from .serializers import *
 from backups.utils import *
-from urllib.parse import unquote
+from backups.uploads import *
+from backups.quota import StorageLimitExceeded, release_session_storage, reserve_storage, storage_left
+from backups.chunkstore import cdc_parameters, known_chunks, parse_manifest, read_chunk
+from backups.delta import cached_delta, literal_bytes
+from backups.tasks import enqueue_backup_index, enqueue_backup_uploaded, enqueue_fill_known_chunks, enqueue_recall
+from backups.archive import archive_after_days, backup_opener
+from backups.downloads import content_disposition, serve_archived_backup, serve_chunked_backup, serve_hot_backup
+from backups.pagination import MAX_PAGE_SIZE, InvalidCursor, keyset_page
+from backups.search import name_filter, ranked_search
+from backups.zipindex import ZipMemberError, ensure_zip_index, member_response_name, read_member
+from urllib.parse import unquote, urlencode
 from django.contrib import messages
-from django.db import IntegrityError
-from django.http import HttpResponse, FileResponse
-from django.urls import reverse_lazy
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Prefetch, Q
+from django.http import HttpResponse, FileResponse, StreamingHttpResponse
+from django.urls import reverse, reverse_lazy
+from django.utils.http import http_date
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator
 from django.core.mail import send_mail
 from django.utils.html import strip_tags
 from django.template.loader import render_to_string
@@ -25,32 +43,28 @@ HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE = 415
 HTTP_STATUS_BAD_REQUEST = 400
 HTTP_STATUS_REQUEST_ENTITY_TOO_LARGE = 413
 HTTP_STATUS_SERVER_ERROR = 500
+HTTP_STATUS_NOT_FOUND = 404
+HTTP_STATUS_CONFLICT = 409
+HTTP_STATUS_GONE = 410
+HTTP_STATUS_ACCEPTED = 202
+HTTP_STATUS_CHECKSUM_MISMATCH = 460  # from the tus checksum extension
+
+TUS_VERSION = '1.0.0'
+FILE_BROWSER_PAGE_SIZE = 50
+COMMENTS_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE = 50
 
 logger = logging.getLogger(__name__)
 
 # testing new git origin change (git remote set-url)
 
-def save_chunk_to_temp_file(uploader_id, chunk_index, file_data):
-    destination = os.path.join(MEDIA_ROOT, 'uploads')
-    fs = FileSystemStorage(location=destination)
-    tmp_filename = f"{uploader_id}_chunk_{chunk_index}.part"
-    fs.save(tmp_filename, file_data)
-    return os.path.join(destination, tmp_filename)
-
-
-def delete_chunks(uploader_id: str):
-    """
-    Delete all chunks for a given uploader ID.
-    """
-    destination = os.path.join(MEDIA_ROOT, 'uploads')
-    for file in os.listdir(destination):
-        if file.startswith(uploader_id):
-            os.remove(os.path.join(destination, file))
+def abort_upload_session(session: UploadSession):
+    session.delete()  # its staging directory goes with it (see backups/signals.py)
 
 
-def process_final_file_path(user, request):
+def process_final_file_path(user, session: UploadSession):
     saveDir = os.path.join('backups', user.profile.company.name)
-    adaski_file_path = request.POST.get('save_dir')
+    adaski_file_path = session.save_dir
 
     if adaski_file_path:
         if adaski_file_path != 'Manual Uploads':
@@ -66,12 +80,9 @@ def process_final_file_path(user, request):
 
         saveDir = os.path.join(saveDir, adaski_file_path)
 
-    filename = request.POST.get('filename')
-    final_filename = f"{filename}"
-    final_file_path = os.path.join(saveDir, final_filename)
-    final_file_path = os.path.join(MEDIA_ROOT, final_file_path)
-    os.makedirs(os.path.dirname(final_file_path), exist_ok=True)  # Create the directory if it doesn't exist
-    return get_available_name(final_file_path)
+    final_filename = f"{session.filename}"
+    final_name = os.path.join(saveDir, final_filename).replace(os.sep, '/')  # a key in the hot store
+    return reserve_available_name(final_name)
 
 
 def send_backup_complete_email(users_list: list | set, backup: Backup):
@@ -81,7 +92,7 @@ def send_backup_complete_email(users_list: list | set, backup: Backup):
     formatted_date = backup_date_uploaded.strftime("%A %d %B, %Y at %H:%M")
 
     # get the first comment if it exists
-    comment = backup.comment_set.first().body if backup.comment_set.exists() else ""
+    comment = backup.comment_set.values_list('body', flat=True).first() or ""
 
     html_body = render_to_string('backups/Email Backup Complete Template.html', {'backup': backup,
                                                                                  'formatted_date': formatted_date,
@@ -110,72 +121,316 @@ def send_backup_complete_email(users_list: list | set, backup: Backup):
     logger.info(log_message)
 
 
-def handle_uploaded_file(request, uploader_id, total_chunks, user):
-    destination = os.path.join(MEDIA_ROOT, 'uploads')
-    final_file_path = process_final_file_path(user, request)
+def send_backup_digest_email(to_user, backups: list):
+    """
+    One email listing every backup since the last digest, for users that would rather not get an email per backup.
+    """
+    backups = [(backup, timezone.localtime(backup.date_uploaded).strftime("%A %d %B, %Y at %H:%M"))
+               for backup in backups]
+    html_body = render_to_string('backups/Email Backup Digest Template.html', {'backups': backups,
+                                                                               'to_user': to_user})
+    plain_text_body = strip_tags(html_body)
+
+    send_mail(
+        subject=f"Backup summary: {len(backups)} backup(s) uploaded",
+        message=plain_text_body,
+        html_message=html_body,
+        from_email=EMAIL_HOST_USER,
+        recipient_list=[to_user.email],
+    )
+    logger.info(f"Sent backup digest for {len(backups)} backup(s) to {to_user.email} ({to_user.username}).")
+
 
-    if not final_file_path.endswith('.zip'):
-        delete_chunks(uploader_id)
+def handle_uploaded_file(session: UploadSession, user):
+    if not session.filename.endswith('.zip'):
+        abort_upload_session(session)
         return HttpResponse("Invalid file type. Only .zip files are allowed.",
                             status=HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE)
 
-    with open(final_file_path, 'wb') as final_file:
-        for i in range(total_chunks):
-            chunk_filename = f"{uploader_id}_chunk_{i}.part"
-            chunk_path = os.path.join(destination, chunk_filename)
+    missing = session.missing_chunks()
+    if missing:  # never finalize a file with holes in it, tell the client what it still has to send
+        return Response({'detail': "Upload is incomplete.", 'missing_chunks': missing}, status=HTTP_STATUS_CONFLICT)
 
-            with open(chunk_path, 'rb') as chunk:
-                final_file.write(chunk.read())
+    assemble_upload(session)
 
-            # Delete the temporary chunk file
-            fs = FileSystemStorage(location=destination)
-            fs.delete(chunk_path)
+    # Verify checksum if provided. The checksum was worked out as the chunks came in, so (normally) this doesn't
+    # have to read the file again
+    calculated_checksum = final_digest(session)
 
-    storage_left = user.profile.company.max_storage - user.profile.company.used_storage
-
-    backup = Backup(user=user, company=user.profile.company, file=final_file_path)
-    backup.save()
+    if session.checksum and session.checksum.lower() != calculated_checksum:
+        abort_upload_session(session)
+        return HttpResponse("Invalid checksum", status=HTTP_STATUS_BAD_REQUEST)
 
-    # Verify checksum if provided
-    checksum = request.POST.get('checksum')
-    calculated_checksum = calculate_checksum(final_file_path)
+    final_name = process_final_file_path(user, session)
+
+    if isinstance(final_name, HttpResponse):  # the save_dir was invalid
+        abort_upload_session(session)
+        return final_name
+
+    # sessions started before storage was reserved up front have to find room for the file now
+    if not session.reserved_storage and session.filesize:
+        with transaction.atomic():
+            reserved = reserve_storage(session.company, session.filesize)
+            if reserved:
+                session.reserved_storage = session.filesize
+                UploadSession.objects.filter(id=session.id).update(reserved_storage=session.reserved_storage)
+        if not reserved:
+            backup_storage.delete(final_name)  # the empty placeholder for the name
+            response = storage_limit_response(session.company, session.filename, session.filesize)
+            abort_upload_session(session)
+            return response
 
-    if checksum and checksum != calculated_checksum:
-        backup.delete()  # Deletes the backup  AND  the backup file if the checksums don't match
-        return HttpResponse("Invalid checksum", status=HTTP_STATUS_BAD_REQUEST)
+    # the chunks were written in place, so the upload only needs to be moved over the reserved name
+    finalize_upload(session, final_name)
 
-    if backup.filesize > storage_left:
-        response_str = f"Could not upload file {backup.basename}. " \
-                       f"You cannot exceed your storage limit of " \
-                       f"{convert_size(user.profile.company.max_storage)}. " \
-                       f"Storage left: {convert_size(storage_left)}, " \
-                       f"upload size: {convert_size(backup.filesize)}"
-        backup.delete()
-        delete_chunks(uploader_id)
-        return HttpResponse(response_str, status=HTTP_STATUS_REQUEST_ENTITY_TOO_LARGE)
+    with transaction.atomic():
+        # the reservation turns into used storage
+        backup = Backup(user=user, company=session.company, file=final_name,
+                        checksum=calculated_checksum, checksum_algorithm=session.checksum_algorithm)
+        backup.save()
+        release_session_storage(session)
 
     # get comment and create a comment object
-    comment = request.POST.get('comment')
-    if comment and comment != '':
-        comment = Comment(user=user, backup=backup, body=unquote(comment.strip()))
+    if session.comment:
+        comment = Comment(user=user, backup=backup, body=unquote(session.comment.strip()))
         comment.save()
 
+    # keep the finished session around until it expires so a client that lost the final response can still find
+    # out that the upload went through
+    session.status = UploadSession.COMPLETE
+    session.backup = backup
+    session.save(update_fields=['status', 'backup'])
+
     response = HttpResponse("File uploaded successfully", status=200)
-    response.set_cookie('uploader_id', uploader_id, httponly=True)
+    response.set_cookie('uploader_id', str(session.id), httponly=True)
     logger.info(f"User '{user.username}' ({user.profile.company.name}) uploaded file '{backup.basename}' successfully.")
 
-    # send backup complete email
-    users_list = [user] if user.profile.get_backup_emails else []
-    users_list += list(User.objects.filter(profile__is_company_admin=True,  # include company admins
-                                           profile__get_backup_emails=True,  # don't include profiles that have False
-                                           profile__company=user.profile.company))
-    users_list = set(users_list)  # remove duplicates (if any)
-
-    send_backup_complete_email(users_list, backup)
+    # the file is in place and recorded, deduplicating/indexing it and the backup complete email happen in the
+    # background (see backups/tasks.py)
+    enqueue_backup_uploaded(backup, user, session)
 
     return response
 
 
+def finish_upload_if_complete(session: UploadSession, user):
+    """
+    Chunks can arrive in any order (and several at once), the upload is done when none are missing. Only the request
+    that manages to move the session on to 'assembling' finishes it. Returns None if the upload isn't done yet.
+    """
+    if not session.is_complete or not UploadSession.objects.filter(
+            id=session.id, status=UploadSession.UPLOADING).update(status=UploadSession.ASSEMBLING):
+        return None
+
+    session.status = UploadSession.ASSEMBLING
+    try:
+        return handle_uploaded_file(session, user)
+    except Exception:
+        # let the client retry the last chunk
+        UploadSession.objects.filter(id=session.id, status=UploadSession.ASSEMBLING).update(
+            status=UploadSession.UPLOADING)
+        raise
+
+
+def storage_limit_response(company: Company, filename: str, filesize: int):
+    """
+    The 413 response for an upload that doesn't fit in the company's storage.
+    """
+    company.refresh_from_db(fields=['max_storage', 'used_storage', 'reserved_storage'])
+    response_str = f"Could not upload file {filename}. " \
+                   f"You cannot exceed your storage limit of " \
+                   f"{convert_size(company.max_storage)}. " \
+                   f"Storage left: {convert_size(max(storage_left(company), 0))}, " \
+                   f"upload size: {convert_size(filesize)}"
+    return HttpResponse(response_str, status=HTTP_STATUS_REQUEST_ENTITY_TOO_LARGE)
+
+
+def upload_session_data(session: UploadSession) -> dict:
+    return {
+        'upload_id': str(session.id),
+        'status': session.status,
+        'filename': session.filename,
+        'filesize': session.filesize,
+        'total_chunks': session.total_chunks,
+        'received_chunks': session.received_chunks(),
+        'missing_chunks': session.chunks_to_send(),
+        'filling_chunks': session.filling,
+        'backup_id': session.backup_id,
+        'chunk_size': session.chunk_size,
+        'checksum_algorithm': session.checksum_algorithm,
+        'chunk_checksums': session.chunk_checksums,
+        'expires': session.expires,
+    }
+
+
+def upload_session_headers(session: UploadSession) -> dict:
+    """
+    tus style headers (https://tus.io/protocols/resumable-upload) describing the state of an upload session.
+    """
+    return {
+        'Tus-Resumable': TUS_VERSION,
+        'Upload-Length': str(session.filesize),
+        'Upload-Offset': str(session.contiguous_offset),
+        'Upload-Expires': http_date(session.expires.timestamp()),
+        'Cache-Control': 'no-store',
+    }
+
+
+def get_upload_session(request, user) -> UploadSession | None:
+    """
+    Find the upload session a chunk belongs to. Clients that created a session send its 'upload_id', older Adaski
+    clients only send the uploader_id cookie, so their session is started (or resumed) under the cookie's id.
+    Returns None if an explicit upload_id doesn't belong to the user.
+    """
+    upload_id = request.POST.get('upload_id')
+    if upload_id:
+        try:
+            return UploadSession.objects.get(id=upload_id, user=user, status=UploadSession.UPLOADING)
+        except (UploadSession.DoesNotExist, ValidationError):
+            return None
+
+    filename = request.POST.get('filename')
+    filesize = int(request.POST.get('filesize'))
+    total_chunks = int(request.POST.get('total_chunks'))
+
+    try:
+        session_id = uuid.UUID(request.COOKIES.get('uploader_id', ''))
+    except ValueError:
+        session_id = uuid.uuid4()  # Generate a unique ID for this upload using UUID4
+
+    session = UploadSession.objects.filter(id=session_id).first()
+    if session and (session.user_id != user.id or session.status != UploadSession.UPLOADING or
+                    (session.filename, session.filesize, session.total_chunks) != (filename, filesize, total_chunks)):
+        # the cookie belongs to an earlier (finished or abandoned) upload, start over
+        if session.user_id == user.id and session.status == UploadSession.UPLOADING:
+            abort_upload_session(session)
+        session = None
+        session_id = uuid.uuid4()
+
+    if session is None:
+        session = start_upload_session(id=session_id, user=user, company=user.profile.company,
+                                       filename=filename, filesize=filesize, total_chunks=total_chunks)
+    return session
+
+
+def upload_capabilities() -> dict:
+    return {
+        'tus_version': TUS_VERSION,
+        'recommended_chunk_size': settings.UPLOAD_RECOMMENDED_CHUNK_SIZE,
+        'max_parallel_chunks': settings.UPLOAD_MAX_PARALLEL_CHUNKS,
+        'checksum_algorithms': list(dict(CHECKSUM_ALGORITHM_CHOICES)),
+        'max_session_age': settings.UPLOAD_SESSION_MAX_AGE,
+        'content_defined_chunking': cdc_parameters(),
+    }
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def upload_session_create(request):
+    """
+    Start a resumable upload (the tus 'creation' step). The client gets back an upload_id to send with every chunk
+    and can ask upload_session_status for the chunks the server already has if the upload is interrupted.
+    Chunks can be sent in any order and over several connections at once; a GET returns the chunk size and
+    number of parallel connections the server recommends.
+    Clients that split the file with the advertised content-defined chunking can send its manifest instead of
+    filesize/total_chunks, and only upload the chunks listed in missing_chunks. The server fills in the rest
+    (filling_chunks) in the background, so the upload can still be 'uploading' after the client's last chunk (or
+    without it sending any): it's done once upload_session_status says 'complete'.
+    """
+    if request.method == 'GET':
+        return Response(upload_capabilities(), headers={
+            'Tus-Resumable': TUS_VERSION,
+            'Tus-Version': TUS_VERSION,
+            'Tus-Extension': 'creation,termination,checksum,expiration',
+            'Tus-Checksum-Algorithm': ','.join(dict(CHECKSUM_ALGORITHM_CHOICES)),
+        })
+
+    user = request.user
+
+    if not user.profile.company:
+        return HttpResponse(f"User '{user.username}' is not associated with a company.",
+                            status=HTTP_STATUS_UNAUTHORIZED)
+
+    data = request.data  # form fields or a JSON body (for uploads that send a manifest)
+
+    manifest = data.get('manifest')
+    if manifest:
+        # content-defined chunks: the client sends [[sha256, size], ...] and only has to upload the chunks the
+        # company doesn't already have
+        try:
+            manifest = parse_manifest(manifest)
+        except ValueError as e:
+            return HttpResponse(f"manifest {e}", status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+        filename = data['filename']
+        filesize = sum(size for digest, size in manifest) if manifest else int(data['filesize'])
+        total_chunks = len(manifest) if manifest else int(data['total_chunks'])
+    except (KeyError, ValueError, TypeError):
+        return HttpResponse("filename, filesize and total_chunks are required", status=HTTP_STATUS_BAD_REQUEST)
+
+    if not filename.endswith('.zip'):
+        return HttpResponse("Invalid file type. Only .zip files are allowed.",
+                            status=HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE)
+
+    if filesize < 0 or total_chunks < 1:
+        return HttpResponse("Invalid filesize or total_chunks", status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+        chunk_size = None if manifest else (int(data.get('chunk_size') or 0) or None)
+    except (ValueError, TypeError):
+        return HttpResponse("Invalid chunk_size", status=HTTP_STATUS_BAD_REQUEST)
+
+    checksum_algorithm = data.get('checksum_algorithm') or settings.BACKUP_CHECKSUM_ALGORITHM
+    if checksum_algorithm not in dict(CHECKSUM_ALGORITHM_CHOICES):
+        return HttpResponse(f"Unsupported checksum_algorithm, use one of: "
+                            f"{', '.join(dict(CHECKSUM_ALGORITHM_CHOICES))}", status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+        # the whole file's size is reserved out of the company's storage until the upload finishes or is abandoned
+        session = start_upload_session(user=user, company=user.profile.company, filename=filename,
+                                       filesize=filesize, total_chunks=total_chunks, chunk_size=chunk_size,
+                                       checksum_algorithm=checksum_algorithm, manifest=manifest or None,
+                                       save_dir=data.get('save_dir', ''),
+                                       checksum=data.get('checksum', ''),
+                                       comment=data.get('comment', ''))
+    except StorageLimitExceeded:
+        return storage_limit_response(user.profile.company, filename, filesize)
+
+    if manifest:
+        # the "which chunks do you already have" step: the client skips the ones the company has, they're copied into
+        # the staging file by a job (so not while this request waits)
+        known = known_chunks(session.company, [digest for digest, size in manifest])
+        session.filling = [chunk_index for chunk_index, (digest, size) in enumerate(manifest)
+                           if digest in known and known[digest].size == size]
+        if session.filling:
+            session.save(update_fields=['filling'])
+            enqueue_fill_known_chunks(session)
+
+    headers = upload_session_headers(session)
+    headers['Location'] = reverse('backups:upload_session_status', kwargs={'upload_id': session.id})
+    return Response({**upload_session_data(session), **upload_capabilities()}, status=201, headers=headers)
+
+
+@api_view(['GET', 'HEAD', 'DELETE'])
+@permission_classes([IsAuthenticated])
+def upload_session_status(request, upload_id):
+    """
+    Report which chunks of an upload the server already has (GET/HEAD), or abandon the upload (DELETE).
+    """
+    session = get_object_or_404(UploadSession, id=upload_id, user=request.user)
+
+    if request.method == 'DELETE':
+        if session.status == UploadSession.UPLOADING:
+            abort_upload_session(session)
+        return Response(status=204, headers={'Tus-Resumable': TUS_VERSION})
+
+    if session.is_expired and session.status == UploadSession.UPLOADING:
+        abort_upload_session(session)
+        return HttpResponse("Upload session has expired.", status=HTTP_STATUS_GONE)
+
+    return Response(upload_session_data(session), headers=upload_session_headers(session))
+
+
 # @csrf_exempt
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
@@ -186,45 +441,65 @@ def upload(request):
     if not request.method == 'POST':
         return HttpResponse("Only POST requests are allowed", status=HTTP_STATUS_METHOD_NOT_ALLOWED)
 
-    uploader_id = request.COOKIES.get('uploader_id')
-    if not uploader_id:
-        uploader_id = str(uuid.uuid4())  # Generate a unique ID for this upload using UUID4
-        request.COOKIES['uploader_id'] = uploader_id
-
-    total_chunks = int(request.POST.get('total_chunks'))
-    chunk_index = int(request.POST.get('chunk_index'))
-    filesize = int(request.POST.get('filesize'))
-    filename = request.POST.get('filename')
-    file_data = request.FILES.get('file')
-
     user = request.user
 
     if not user.profile.company:
-        delete_chunks(uploader_id)
         return HttpResponse(f"User '{user.username}' is not associated with a company.",
                             status=HTTP_STATUS_UNAUTHORIZED)
 
-    storage_left = user.profile.company.max_storage - user.profile.company.used_storage
-    if int(filesize) > storage_left:
-        response_str = f"Could not upload file {filename}. " \
-                       f"You cannot exceed your storage limit of " \
-                       f"{convert_size(user.profile.company.max_storage)}. " \
-                       f"Storage left: {convert_size(storage_left)}, " \
-                       f"upload size: {convert_size(int(filesize))}"
-        delete_chunks(uploader_id)
-        return HttpResponse(response_str, status=HTTP_STATUS_REQUEST_ENTITY_TOO_LARGE)
-
     try:
-        save_chunk_to_temp_file(uploader_id, chunk_index, file_data)
+        session = get_upload_session(request, user)
+    except StorageLimitExceeded:
+        return storage_limit_response(user.profile.company, request.POST.get('filename'),
+                                      int(request.POST.get('filesize')))
+    if session is None:
+        return HttpResponse("Upload session not found or already finished.", status=HTTP_STATUS_NOT_FOUND)
 
-        if chunk_index == total_chunks - 1:
-            return handle_uploaded_file(request, uploader_id, total_chunks, user)
-        else:
-            response = HttpResponse("Chunk uploaded successfully", status=200)
-            response.set_cookie('uploader_id', uploader_id, httponly=True)
+    chunk_index = int(request.POST.get('chunk_index'))
+    file_data = request.FILES.get('file')
+
+    if not 0 <= chunk_index < session.total_chunks:
+        return HttpResponse(f"chunk_index must be between 0 and {session.total_chunks - 1}",
+                            status=HTTP_STATUS_BAD_REQUEST)
+
+    try:
+        try:
+            chunk_checksum = write_chunk(session, chunk_index, file_data, request.POST.get('chunk_checksum', ''))
+        except ChunkChecksumError as e:
+            return HttpResponse(str(e), status=HTTP_STATUS_CHECKSUM_MISMATCH, reason="Checksum Mismatch")
+        except ChunkError as e:
+            return HttpResponse(str(e), status=HTTP_STATUS_BAD_REQUEST)
+
+        with transaction.atomic():
+            # Take the row's write lock before reading it, so chunks stored at the same time by other requests (or
+            # workers) queue up here instead of overwriting each other's bits. Starting with an UPDATE (the session's
+            # sliding expiry) also keeps SQLite from failing with 'database is locked' when it would have to upgrade a
+            # read lock
+            session.touch()
+            locked = UploadSession.objects.select_for_update().get(id=session.id)
+            locked.mark_chunk_received(chunk_index)
+            locked.chunk_checksums[str(chunk_index)] = chunk_checksum
+            locked.chunk_size = locked.chunk_size or session.chunk_size
+            # older clients only send these with the last chunk
+            for field in ('save_dir', 'checksum', 'comment'):
+                if request.POST.get(field):
+                    setattr(locked, field, request.POST.get(field))
+            locked.save(update_fields=['received', 'chunk_checksums', 'chunk_size', 'save_dir', 'checksum',
+                                       'comment'])
+        session = locked
+
+        # hash any chunks that were waiting on this one
+        advance_digest(session)
+
+        response = finish_upload_if_complete(session, user)
+        if response is not None:
             return response
+
+        response = HttpResponse("Chunk uploaded successfully", status=200)
+        response.set_cookie('uploader_id', str(session.id), httponly=True)
+        return response
     except Exception as e:
-        delete_chunks(uploader_id)
+        # keep the session and the chunks that did arrive, the client can resume from the status endpoint
         logger.error(f'Error uploading file. Error: {e}')
         return HttpResponse(f"Server error: {e}", status=HTTP_STATUS_SERVER_ERROR)
 
@@ -237,73 +512,67 @@ def manual_upload(request):
 def file_browser_view(request):
     """
     view that lists all the files in the user's company's backup folder. If the user is a staff member or superuser,
-    they can view the backups for all the companies (i.e. the backup root folder).
+    they can view the backups for all the companies (i.e. the backup root folder). Folders and files come from the
+    directory index (Backup.directory, BackupDirectory), the disk isn't touched.
     """
     if request.method == 'POST':
         path = request.POST.get('path', '')
     else:
         path = request.GET.get('path', '')
 
-    if request.user.is_staff or request.user.is_superuser:
-        base_path = os.path.join(MEDIA_ROOT, 'backups')
-        backups = Backup.objects.all().order_by('-date_uploaded')
-    else:
-        company = request.user.profile.company
-        base_path = os.path.join(MEDIA_ROOT, 'backups', company.name)  # media_root/backups/company_name/
-        backups = Backup.objects.filter(company=company).order_by('-date_uploaded')
+    staff = request.user.is_staff or request.user.is_superuser
+    base = '' if staff else request.user.profile.company.name  # MEDIA_ROOT/backups or MEDIA_ROOT/backups/company_name
+    path = clean_directory_path(path, base)
+
+    subdirectories = BackupDirectory.objects.filter(parent=path).values_list('name', 'path')
+    files = Backup.objects.filter(directory=path).select_related('user').order_by('-date_uploaded')
+    if not staff:
+        files = files.filter(company=request.user.profile.company)
+    page_obj = Paginator(files, FILE_BROWSER_PAGE_SIZE).get_page(request.GET.get('page'))
 
-    # if this is the root folder then go ahead and run remove_empty_folders() to remove any empty subdirectories
-    # before the user sees them
-    if path == '':
-        remove_empty_folders(base_path, removeRoot=False)  # removeRoot=False means don't delete the root 'base' folder
-
-    path = os.path.normpath(os.path.join(base_path, path))
-    subdirectories = []
-    files = []
-
-    if os.path.isdir(path):
-        items = os.listdir(path)
-        subdirectories = [item for item in items if os.path.isdir(os.path.join(path, item))]
-        # filter backup files to show only the backups in this current directory
-        files = [backup for backup in backups if backup.file.path in
-                 [os.path.join(path, item) for item in items]
-                 ]
-
-    path_segments = [segment for segment in path.split(os.sep) if segment]  # os.sep is the path separator for the OS
-
-    one_level_up = os.path.normpath(f"{os.sep}".join(path_segments[:-1])) if len(path_segments) > 1 else None
-    # ensure the new path stays within the intended base path
-    # if the length of one_level_up is less than or equal to the length of the base path then
-    # it is no longer within the limits of the intended base path
-    if one_level_up and len(one_level_up) < len(base_path):
-        one_level_up = None
-
-    clickable_path_segments = []
-    for i, segment in enumerate(path_segments):
-        segment_path = os.path.normpath(f"{os.sep}".join(path_segments[:i + 1]))
-        clickable_path_segments.append((segment, segment_path))
-
-    # Ensure that clickable_path_segments includes only paths starting directly after MEDIA_ROOT.
-    # Using 'if not MEDIA_ROOT.startswith(seg_tuple[1])' instead of 'if MEDIA_ROOT.startswith(seg_tuple[1])'
-    # ensures that the path segments are not clickable if they are outside the MEDIA_ROOT folder.
-    clickable_path_segments = [seg_tuple for seg_tuple in clickable_path_segments if
-                               not MEDIA_ROOT.startswith(seg_tuple[1])]
-
-    if not (request.user.is_staff or request.user.is_superuser):  # if the user is not a staff member or superuser
-        clickable_path_segments = clickable_path_segments[1:]  # remove the 'backups' folder from the clickable path
+    # (segment, path) for every folder from the base down to this one
+    segments = path.split('/') if path else []
+    clickable_path_segments = [(segment, '/'.join(segments[:i + 1])) for i, segment in enumerate(segments)]
+    if staff:
+        clickable_path_segments.insert(0, ('backups', ''))
 
     context = {
-        'files': files,
+        'files': page_obj.object_list,
+        'page_obj': page_obj,
+        'is_paginated': page_obj.has_other_pages(),
         'current_path': path,
         'title': 'Browse Files',
         'subdirectories': subdirectories,
-        'one_level_up': one_level_up,
+        'one_level_up': parent_directory(path) if path != base else None,
         'clickable_path_segments': clickable_path_segments,
     }
 
     return render(request, "backups/file_browser.html", context)
 
 
+def clean_directory_path(path: str, base: str) -> str:
+    """
+    Turn a folder path sent by a browser or Adaski into a Backup.directory style path ('/' separated, relative to
+    MEDIA_ROOT/backups) that stays inside base. Anything that tries to leave base ends up at base.
+    """
+    segments = [segment for segment in path.replace('\\', '/').split('/') if segment and segment != '.']
+    path = '/'.join(segments)
+    if '..' in segments or (base and path != base and not path.startswith(base + '/')):
+        return base
+    return path
+
+
+def company_code_filter(company_code: str) -> Q:
+    """
+    Backups of an Adaski company code, off the (company, company_code, date_uploaded) index. Backups whose code
+    couldn't be worked out when they were uploaded (Backup.company_code is '') still match on their file name.
+    """
+    company_code = company_code.lower()
+    # the code anywhere in the file name, but not in the folders above it
+    in_basename = rf"{re.escape(company_code)}[^/\\]*$"
+    return Q(company_code=company_code) | Q(company_code='', file__iregex=in_basename)
+
+
 @api_view(['POST'])
 @permission_classes([IsAuthenticated])
 def get_directories(request):
@@ -312,14 +581,9 @@ def get_directories(request):
     Allows Adaski to navigate the cloud backup directory tree.
     """
     company = request.user.profile.company
-    base_path = os.path.join(MEDIA_ROOT, 'backups', company.name)
-
-    backups = Backup.objects.filter(company=company).order_by('-date_uploaded')
 
     if 'company_code' in request.POST:
         company_code = request.POST.get('company_code', '')
-        base_path = os.path.join(base_path, company_code)
-        backups = [backup for backup in backups if company_code.lower() in backup.basename.lower()]
     else:  # return an empty list if the company code is not provided
         return Response({
             'directories': [],
@@ -327,40 +591,35 @@ def get_directories(request):
             'files': [],
         })
 
-    if len(backups) < 1:  # if there are no backups, return an empty response
+    latest = Backup.objects.filter(company_code_filter(company_code), company=company).order_by(
+        '-date_uploaded').first()
+    if latest is None:  # if there are no backups, return an empty response
         return Response({
             'directories': [],
             'segments': [],
             'files': [],
         })
 
-    path = request.POST.get('path', '')
-    path = os.path.normpath(os.path.join(base_path, path))
+    # the code's folder as it's spelled on disk, whatever case Adaski sent the code in
+    code_directory = BackupDirectory.objects.filter(parent=company.name, name__iexact=company_code).first()
+    base = code_directory.path if code_directory else clean_directory_path(f"{company.name}/{company_code}",
+                                                                           company.name)
+    path = clean_directory_path(f"{base}/{request.POST.get('path', '')}", base)
 
     if request.POST.get('default_latest'):
-        new_path = os.path.dirname(backups[0].file.path)  # set the path to the path of the latest backup file
-        if new_path.find(path) > -1:  # if the new path is a subdirectory of the current path
-            path = new_path
+        if latest.directory == path or latest.directory.startswith(path + '/'):  # the latest backup is under path
+            path = latest.directory
 
-    subdirectories = []
-    files = []
+    subdirectories = list(BackupDirectory.objects.filter(parent=path).values_list('name', flat=True))
+    files = Backup.objects.filter(company_code_filter(company_code), company=company, directory=path).order_by(
+        '-date_uploaded').values(*BACKUP_LIST_FIELDS)
 
-    if os.path.isdir(os.path.normpath(path)):
-        items = os.listdir(path)
-        subdirectories = [item for item in items if os.path.isdir(os.path.join(path, item))]
-        files = [backup for backup in backups if backup.file.path in
-                 [os.path.join(path, item) for item in items]
-                 ]  # backups in the current directory
-
-    path_segments = [segment for segment in
-                     path.replace(os.path.join(MEDIA_ROOT, 'backups', company.name), '').split(os.sep) if segment]
-
-    serializer = BackupSerializer(files, many=True)
+    path_segments = path.split('/')[1:]  # relative to the company's folder
 
     return Response({
         'directories': subdirectories,
         'segments': path_segments,
-        'files': serializer.data,
+        'files': backup_list_data(files),
     })
 
 
@@ -369,6 +628,8 @@ def get_directories(request):
 def get_backups_list(request, **kwargs):
     """
     API endpoint that returns a list of backups from the user or the user's company if the user is a company admin.
+    Sending ?limit=N pages through them instead, newest first: the response is {"results": [...], "next_cursor":
+    ..., "next": url}, and the next page is asked for with ?limit=N&cursor=<next_cursor>.
     """
     user = request.user
     company = user.profile.company
@@ -379,36 +640,332 @@ def get_backups_list(request, **kwargs):
         backups = Backup.objects.filter(user=user, company=company).order_by('-date_uploaded')
 
     if 'company_code' in kwargs:
-        company_code = kwargs['company_code']
-        # get the records where the basename contains the company code (in lower case)
-        backups = [backup for backup in backups if company_code.lower() in backup.basename.lower()]
+        backups = backups.filter(company_code_filter(kwargs['company_code']))
+
+    backups = backups.values(*BACKUP_LIST_FIELDS)
 
-    serializer = BackupSerializer(backups, many=True)
-    return Response(serializer.data)
+    if 'limit' not in request.GET and 'cursor' not in request.GET:
+        return Response(backup_list_data(backups))
+
+    try:
+        limit = min(max(int(request.GET.get('limit') or 100), 1), MAX_PAGE_SIZE)
+        page, next_cursor = keyset_page(backups, request.GET.get('cursor'), limit)
+    except (ValueError, InvalidCursor) as e:
+        return HttpResponse(str(e), status=HTTP_STATUS_BAD_REQUEST)
+
+    next_url = None
+    if next_cursor:
+        next_url = request.build_absolute_uri(f"{request.path}?{urlencode({'limit': limit, 'cursor': next_cursor})}")
+    return Response({
+        'results': backup_list_data(page),
+        'next_cursor': next_cursor,
+        'next': next_url,
+    })
 
 
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+def search_backups_api(request):
+    """
+    API endpoint that searches the backups the user can see (like get_backups_list) by file name, folder, company code
+    and comments: ?q=<words>&limit=N (50 by default). Returns the best matches first, in the get_backups_list format.
+    """
+    user = request.user
+    company = user.profile.company
+
+    if user.profile.is_company_admin:
+        backups = Backup.objects.filter(company=company)
+    else:
+        backups = Backup.objects.filter(user=user, company=company)
+
+    try:
+        limit = min(max(int(request.GET.get('limit') or SEARCH_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+    except ValueError as e:
+        return HttpResponse(str(e), status=HTTP_STATUS_BAD_REQUEST)
+
+    results = ranked_search(backups, request.GET.get('q', '')).values(*BACKUP_LIST_FIELDS)[:limit]
+    return Response(backup_list_data(results))
+
+
+def comment_replies(comment_ids: list[int]) -> list[dict]:
+    """
+    Every reply under the given comments, however deep, as .values(*COMMENT_FIELDS) rows. One query per level of
+    nesting (replies are only ever one level deep from the website).
+    """
+    replies = []
+    while comment_ids:
+        level = list(Comment.objects.filter(parent_id__in=comment_ids).values(*COMMENT_FIELDS))
+        replies += level
+        comment_ids = [reply['id'] for reply in level]
+    return replies
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def backup_comments(request, backup_id):
+    """
+    API endpoint that returns a backup's comments, oldest first, each top-level comment with its whole thread of
+    replies nested under it. Paged with ?limit=N (20 by default) and ?cursor=<next_cursor>, like get_backups_list.
+    """
+    backup = get_object_or_404(Backup, id=backup_id)
+
+    if not can_access_backup(request.user, backup):
+        return HttpResponse("You don't have permission to view this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    comments = Comment.objects.filter(backup=backup, parent=None).values(*COMMENT_FIELDS)
+    try:
+        limit = min(max(int(request.GET.get('limit') or COMMENTS_PAGE_SIZE), 1), MAX_PAGE_SIZE)
+        page, next_cursor = keyset_page(comments, request.GET.get('cursor'), limit, field='created', descending=False)
+    except (ValueError, InvalidCursor) as e:
+        return HttpResponse(str(e), status=HTTP_STATUS_BAD_REQUEST)
+
+    next_url = None
+    if next_cursor:
+        next_url = request.build_absolute_uri(f"{request.path}?{urlencode({'limit': limit, 'cursor': next_cursor})}")
+    return Response({
+        'results': comment_thread_data(page, comment_replies([comment['id'] for comment in page])),
+        'next_cursor': next_cursor,
+        'next': next_url,
+    })
+
+
+@api_view(['GET', 'HEAD'])
+@permission_classes([IsAuthenticated])
 def download_backup(request, backup_id):
     """
-    API endpoint that downloads the backup file based on a backup id.
+    API endpoint that downloads the backup file based on a backup id. Supports Range requests (resuming a download or
+    fetching parts of it in parallel), If-None-Match/If-Range against the backup's checksum, and handing the transfer
+    over to the front-end server (settings.BACKUP_DOWNLOAD_OFFLOAD). A backup in the chunk store is put back together
+    from its chunks as it's sent.
     """
     # return a download of the backup file
     backup = get_object_or_404(Backup, id=backup_id)
 
-    if (
-            (backup.user != request.user and request.user.profile.is_company_admin) and
-            not (request.user.is_superuser or request.user.is_staff)
-    ):
+    if not can_access_backup(request.user, backup):
         return HttpResponse("You don't have permission to download this backup.", status=HTTP_STATUS_UNAUTHORIZED)
 
-    if not os.path.isfile(backup.file.path):
+    if backup.storage_tier == HOT_TIER and not backup.file.storage.exists(backup.file.name):
+        backup.refresh_from_db()  # moved into the chunk store (or the archive) since it was read
+
+    if backup.is_archived:
+        try:
+            response = serve_archived_backup(request, backup)
+        except OSError:
+            return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
+        if request.GET.get('recall'):  # the client expects to come back for it (or parts of it)
+            enqueue_recall(backup)
+        return response
+
+    if backup.is_chunked:
+        try:
+            return serve_chunked_backup(request, backup)
+        except OSError:
+            return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
+
+    try:
+        return serve_hot_backup(request, backup)
+    except OSError:
         return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
 
-    response = FileResponse(open(backup.file.path, 'rb'), as_attachment=True)
+
+def recall_pending_response(backup: Backup) -> HttpResponse:
+    """
+    For requests that need to read parts of an archived, compressed backup: start bringing it back out of the archive
+    and tell the client when to try again.
+    """
+    enqueue_recall(backup)
+    response = HttpResponse("The backup is being recalled from the archive, try again later.",
+                            status=HTTP_STATUS_ACCEPTED)
+    response['Retry-After'] = '60'
     return response
 
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def recall_backup(request, backup_id):
+    """
+    API endpoint that brings an archived backup back out of the archive ahead of a restore. Answers 202 while the
+    recall is running and 200 once the backup is back.
+    """
+    backup = get_object_or_404(Backup, id=backup_id)
+
+    if not can_access_backup(request.user, backup):
+        return HttpResponse("You don't have permission to recall this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    if not backup.is_archived:
+        return Response({'id': backup.id, 'storage_tier': backup.storage_tier})
+    return recall_pending_response(backup)
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def backup_zip_members(request, backup_id):
+    """
+    API endpoint that lists the files inside a backup zip, from the index made when it was uploaded. ?prefix= only
+    lists the members under a folder.
+    """
+    backup = get_object_or_404(Backup, id=backup_id)
+
+    if not can_access_backup(request.user, backup):
+        return HttpResponse("You don't have permission to view this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    open_file = backup_opener(backup)
+    if backup.zip_indexed_at is None and open_file is None:
+        return recall_pending_response(backup)
+
+    try:
+        ensure_zip_index(backup, open_file)  # backups from before the index existed
+    except OSError:
+        return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
+
+    members = backup.zip_members.all()
+    prefix = request.GET.get('prefix')
+    if prefix:
+        members = members.filter(name__startswith=prefix)
+
+    return Response({
+        'backup_id': backup.id,
+        'members': [{'name': member.name, 'file_size': member.file_size, 'compress_size': member.compress_size,
+                     'crc': f"{member.crc:08x}", 'date_time': member.date_time, 'is_dir': member.is_dir}
+                    for member in members],
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def backup_zip_member(request, backup_id, member_name):
+    """
+    API endpoint that downloads a single file out of a backup zip. It seeks straight to the member's local header, so
+    only that member is read, not the whole archive.
+    """
+    backup = get_object_or_404(Backup, id=backup_id)
+
+    if not can_access_backup(request.user, backup):
+        return HttpResponse("You don't have permission to download this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    open_file = backup_opener(backup)
+    if open_file is None:
+        return recall_pending_response(backup)
+
+    try:
+        ensure_zip_index(backup, open_file)
+        member = backup.zip_members.filter(name=member_name).first()
+        if member is None or member.is_dir:
+            return HttpResponse("No such file in this backup.", status=HTTP_STATUS_NOT_FOUND)
+        stream = read_member(open_file, member)
+    except ZipMemberError as e:
+        return HttpResponse(str(e), status=HTTP_STATUS_UNSUPPORTED_MEDIA_TYPE)
+    except OSError:
+        return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
+
+    filename = member_response_name(member)
+    response = StreamingHttpResponse(stream, content_type=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    response['Content-Length'] = str(member.file_size)
+    response['Content-Disposition'] = content_disposition(filename)
+    return response
+
+
+def can_access_backup(user, backup: Backup) -> bool:
+    return user.is_staff or user.is_superuser or backup.company_id == user.profile.company_id
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def backup_manifest(request, backup_id):
+    """
+    API endpoint that returns the content-defined chunks a backup is made of. A client restoring over a copy of an
+    earlier backup only has to fetch (with get_chunk) the chunks it doesn't have; joining them in order gives back
+    the exact original file.
+    """
+    backup = get_object_or_404(Backup.objects.select_related('manifest'), id=backup_id)
+
+    if not can_access_backup(request.user, backup):
+        return HttpResponse("You don't have permission to view this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    if not hasattr(backup, 'manifest'):
+        return HttpResponse("This backup hasn't been split into chunks yet.", status=HTTP_STATUS_NOT_FOUND)
+
+    return Response({
+        'id': backup.id,
+        'filesize': backup.filesize,
+        'checksum': backup.checksum,
+        'checksum_algorithm': backup.checksum_algorithm,
+        'content_defined_chunking': cdc_parameters(),
+        'chunks': backup.manifest.chunks,
+    })
+
+
+@api_view(['GET', 'POST'])
+@permission_classes([IsAuthenticated])
+def backup_delta(request, backup_id):
+    """
+    API endpoint that returns a binary delta (see backups/delta.py) that turns a version of a backup the client already
+    has into this one. GET ?base=<backup id> for a backup the client downloaded before, or POST {"signature":
+    [[sha256, size], ...]} describing the file it has, chunked with the content_defined_chunking parameters.
+    Answers 202 if a backup hasn't been split into chunks yet; try again after Retry-After seconds.
+    """
+    target = get_object_or_404(Backup.objects.select_related('manifest'), id=backup_id)
+
+    if not can_access_backup(request.user, target):
+        return HttpResponse("You don't have permission to download this backup.", status=HTTP_STATUS_UNAUTHORIZED)
+
+    if request.method == 'POST':
+        try:
+            base_chunks = parse_manifest(request.data.get('signature'))
+        except ValueError as e:
+            return HttpResponse(f"signature {e}", status=HTTP_STATUS_BAD_REQUEST)
+        not_indexed = [target]
+    else:
+        try:
+            base = Backup.objects.select_related('manifest').filter(id=int(request.GET.get('base'))).first()
+        except (TypeError, ValueError):
+            base = None
+        if base is None or base.company_id != target.company_id:
+            return HttpResponse("base must be another backup of the same company.", status=HTTP_STATUS_BAD_REQUEST)
+        base_chunks = base.manifest.chunks if hasattr(base, 'manifest') else None
+        not_indexed = [target, base]
+
+    open_target = backup_opener(target)
+    if open_target is None:
+        return recall_pending_response(target)
+
+    not_indexed = [backup for backup in not_indexed if not hasattr(backup, 'manifest')]
+    if not_indexed:
+        for backup in not_indexed:
+            enqueue_backup_index(backup)
+        response = HttpResponse("The backup is still being indexed, try again later.", status=HTTP_STATUS_ACCEPTED)
+        response['Retry-After'] = '60'
+        return response
+
+    try:
+        delta_path, ops = cached_delta(base_chunks, target, open_target)
+    except OSError:
+        return HttpResponse("Backup file not found.", status=HTTP_STATUS_SERVER_ERROR)
+
+    response = FileResponse(open(delta_path, 'rb'), as_attachment=True, filename=f"{target.basename}.delta",
+                            content_type='application/octet-stream')
+    response['X-Delta-Target-Size'] = str(target.filesize)
+    response['X-Delta-Literal-Bytes'] = str(literal_bytes(ops))
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def get_chunk(request, digest):
+    """
+    API endpoint that returns the bytes of one of the company's chunks by its sha256 digest.
+    """
+    chunk = known_chunks(request.user.profile.company, [digest.lower()]).get(digest.lower())
+    if chunk is None:
+        return HttpResponse("Chunk not found.", status=HTTP_STATUS_NOT_FOUND)
+
+    try:
+        data = read_chunk(chunk)
+    except FileNotFoundError:  # its last backup went while this was being answered
+        return HttpResponse("Chunk not found.", status=HTTP_STATUS_NOT_FOUND)
+    return HttpResponse(data, content_type='application/octet-stream')
+
+
 class BackupDeleteView(LoginRequiredMixin, DeleteView):
     model = Backup
     success_url = reverse_lazy('profile')
@@ -452,24 +1009,11 @@ class BackupListView(LoginRequiredMixin, ListView):
         elif end_date and not start_date:
             queryset = queryset.filter(date_uploaded__lte=end_date)  # lte is less than or equal to
         if name:
-            queryset = queryset.filter(file__icontains=name)
+            queryset = name_filter(queryset, name)  # anywhere in the name, e.g. '2024'
         # only show backups uploaded by the user
         return queryset.filter(user=self.request.user)
 
 
-def tally_used_storage(company: Company):
-    """
-    Tally the total storage used by the company and update the company's used_storage field if it is not correct.
-    """
-    associated_backups = Backup.objects.filter(company=company)
-    tally = sum(backup.filesize for backup in associated_backups)
-    if tally != company.used_storage:
-        logger.info(f"Updating company '{company.name}' used storage from {convert_size(company.used_storage)} "
-                    f"to {convert_size(tally)}, after tally.")
-        company.used_storage = tally
-        company.save()
-
-
 class CompanyBackupListView(LoginRequiredMixin, ListView):
     model = Backup
     template_name = 'backups/backups_list.html'
@@ -483,6 +1027,7 @@ class CompanyBackupListView(LoginRequiredMixin, ListView):
         context['title'] = 'Company Backups'
         context['company'] = company
         context['show_manual_backups'] = (company == self.request.user.profile.company)
+        context['archive_after_days'] = archive_after_days(company)
         context['search_form'] = BackupSearch(initial={'start_date': self.request.GET.get('start_date'),
                                                        'end_date': self.request.GET.get('end_date'),
                                                        'name': self.request.GET.get('name')})
@@ -491,10 +1036,6 @@ class CompanyBackupListView(LoginRequiredMixin, ListView):
     def get_queryset(self):
         queryset = super().get_queryset().filter(company_id=int(self.kwargs['company_id']))
 
-        # while doing this, check if the total storage used by the company is correct and if not, fix it
-        company = Company.objects.get(id=int(self.kwargs['company_id']))
-        tally_used_storage(company=company)
-
         start_date = self.request.GET.get('start_date')
         end_date = self.request.GET.get('end_date')
         name = self.request.GET.get('name')
@@ -507,7 +1048,7 @@ class CompanyBackupListView(LoginRequiredMixin, ListView):
         elif end_date and not start_date:
             queryset = queryset.filter(date_uploaded__lte=end_date)  # lte is less than or equal to
         if name:
-            queryset = queryset.filter(file__icontains=name)
+            queryset = name_filter(queryset, name)  # anywhere in the name, e.g. '2024'
         # only show backups by company
         return queryset
 
@@ -556,7 +1097,10 @@ class BackupDetailView(LoginRequiredMixin, ListView):
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        return queryset.filter(backup_id=int(self.kwargs['pk']), parent=None)
+        # the replies (and everyone's user) come in two queries for the whole page instead of a few per comment
+        return queryset.filter(backup_id=int(self.kwargs['pk']), parent=None).select_related('user').annotate(
+            reply_count=Count('replies')).prefetch_related(
+            Prefetch('replies', queryset=Comment.objects.select_related('user')))
 
     def get_success_url(self):
         return reverse_lazy('backups:backup_details', kwargs={'pk': self.kwargs['pk']})
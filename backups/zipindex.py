@@ -0,0 +1,127 @@
+import os
+import zlib
+import struct
+import logging
+import zipfile
+from datetime import datetime
+from django.db import transaction
+from django.utils import timezone
+from backups.models import Backup, ZipMember
+
+logger = logging.getLogger(__name__)
+
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')  # zip local file header, 30 bytes
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+READ_SIZE = 1024 * 256
+
+
+class ZipMemberError(Exception):
+    """raised when a zip member can't be read straight out of its backup"""
+
+
+def member_datetime(date_time: tuple) -> datetime | None:
+    try:
+        return timezone.make_aware(datetime(*date_time))
+    except (ValueError, TypeError):  # zips with no (or garbage) timestamps
+        return None
+
+
+def index_zip(backup: Backup, open_file) -> int:
+    """
+    Read a backup zip's central directory (only the end of the file, which open_file() opens) and store an index of its
+    members. Returns how many members it has. A file that isn't a valid zip is marked as indexed with no members.
+    """
+    try:
+        with open_file() as file, zipfile.ZipFile(file) as zip_file:
+            infos = zip_file.infolist()
+    except zipfile.BadZipFile as e:
+        logger.warning(f"Backup '{backup.basename}' is not a valid zip, not indexing it. Error: {e}")
+        infos = []
+
+    members = [ZipMember(backup=backup, name=info.filename, file_size=info.file_size,
+                         compress_size=info.compress_size, crc=info.CRC, header_offset=info.header_offset,
+                         compress_type=info.compress_type, flag_bits=info.flag_bits,
+                         date_time=member_datetime(info.date_time)) for info in infos]
+
+    with transaction.atomic():
+        ZipMember.objects.filter(backup=backup).delete()
+        ZipMember.objects.bulk_create(members, batch_size=500)
+        backup.zip_indexed_at = timezone.now()
+        Backup.objects.filter(pk=backup.pk).update(zip_indexed_at=backup.zip_indexed_at)
+
+    logger.info(f"Indexed {len(members)} zip member(s) of backup '{backup.basename}'.")
+    return len(members)
+
+
+def ensure_zip_index(backup: Backup, open_file):
+    if backup.zip_indexed_at is None:
+        index_zip(backup, open_file)
+
+
+def member_data_offset(zip_file, member: ZipMember) -> int:
+    """
+    Seek to the member's local file header and return where its (compressed) data starts. The header's name and
+    extra field lengths can differ from the central directory's, so they have to be read from the header itself.
+    """
+    zip_file.seek(member.header_offset)
+    header = zip_file.read(LOCAL_HEADER.size)
+    if len(header) != LOCAL_HEADER.size:
+        raise ZipMemberError(f"'{member.name}' is past the end of the zip.")
+    fields = LOCAL_HEADER.unpack(header)
+    if fields[0] != LOCAL_HEADER_SIGNATURE:
+        raise ZipMemberError(f"Bad local header for '{member.name}', the index is out of date.")
+    name_length, extra_length = fields[9], fields[10]
+    return member.header_offset + LOCAL_HEADER.size + name_length + extra_length
+
+
+def read_member(open_file, member: ZipMember):
+    """
+    Stream one member's uncompressed bytes, reading only that member's part of the zip. Stored and deflated members
+    (nearly every zip) are handled here; anything else falls back to the zipfile module. The local header is checked
+    before this returns, so a stale index raises ZipMemberError instead of breaking the response half way.
+    """
+    if member.flag_bits & 0x1:
+        raise ZipMemberError(f"'{member.name}' is encrypted.")
+
+    if member.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        return read_member_with_zipfile(open_file, member)
+
+    with open_file() as zip_file:
+        data_offset = member_data_offset(zip_file, member)
+    return read_member_data(open_file, member, data_offset)
+
+
+def read_member_data(open_file, member: ZipMember, data_offset: int):
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS) if member.compress_type == zipfile.ZIP_DEFLATED else None
+    crc = 0
+    with open_file() as zip_file:
+        zip_file.seek(data_offset)
+        remaining = member.compress_size
+        while remaining > 0:
+            data = zip_file.read(min(READ_SIZE, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            if decompressor:
+                data = decompressor.decompress(data)
+            crc = zlib.crc32(data, crc)
+            yield data
+        if decompressor:
+            data = decompressor.flush()
+            crc = zlib.crc32(data, crc)
+            yield data
+
+    if crc != member.crc:
+        # the response is already on its way, all that can be done is to make it visible
+        logger.error(f"CRC mismatch reading '{member.name}' out of backup {member.backup_id}.")
+
+
+def read_member_with_zipfile(open_file, member: ZipMember):
+    with open_file() as file, zipfile.ZipFile(file) as zip_file:
+        with zip_file.open(member.name) as member_file:
+            while data := member_file.read(READ_SIZE):
+                yield data
+
+
+def member_response_name(member: ZipMember) -> str:
+    return os.path.basename(member.name.rstrip('/')) or 'file'
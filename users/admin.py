@@ -21,4 +21,23 @@ admin.site.register(User, UserAdmin)
 
 # register Profile
 admin.site.register(Profile)
-admin.site.register(Company)
+
+
+@admin.register(Company)
+class CompanyAdmin(admin.ModelAdmin):
+    readonly_fields = ('used_storage', 'reserved_storage')  # kept up to date by uploads and deletes
+
+    def save_model(self, request, obj, form, change):
+        # only what's on the form, so the storage counters loaded with the company aren't written back over updates
+        # made since
+        obj.save(update_fields=list(form.fields) if change else None)
+
+
+# the bodies of emails waiting to go out can hold passwords and password reset links, they aren't shown
+@admin.register(OutboxEmail)
+class OutboxEmailAdmin(admin.ModelAdmin):
+    list_display = ('subject', 'status', 'attempts', 'send_after', 'sent_at')
+    list_filter = ('status',)
+    exclude = ('body', 'html_body')
+    readonly_fields = ('subject', 'from_email', 'to', 'cc', 'bcc', 'reply_to', 'headers', 'attempts', 'last_error',
+                       'created', 'sent_at')
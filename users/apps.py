@@ -1,4 +1,6 @@
 from django.apps import AppConfig
+from apscheduler.schedulers.background import BackgroundScheduler
+from django.conf import settings
 
 
 class UsersConfig(AppConfig):
@@ -7,3 +9,12 @@ class UsersConfig(AppConfig):
 
     def ready(self):
         import users.signals
+        from users.mail import purge_outbox, send_outbox
+
+        scheduler = BackgroundScheduler(timezone=settings.TIME_ZONE)
+        # deliver queued emails. max_instances=1 so a slow SMTP server doesn't pile up runs
+        scheduler.add_job(send_outbox, 'interval', seconds=30, id='send_outbox', max_instances=1,
+                          misfire_grace_time=60)
+        # forget old sent and failed emails
+        scheduler.add_job(purge_outbox, 'cron', hour=3, id='purge_outbox', misfire_grace_time=60 * 60)
+        scheduler.start()
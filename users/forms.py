@@ -87,13 +87,14 @@ class UpdateProfileForm(forms.ModelForm):
     image = forms.ImageField(widget=forms.FileInput(), required=False)
     is_company_admin = forms.BooleanField(required=False, label="")
     get_backup_emails = forms.BooleanField(required=False, label="")
+    backup_email_digest = forms.BooleanField(required=False, label="")
     company = forms.ModelChoiceField(queryset=Company.objects.all(), required=False, label="")  # select a company
     phone = forms.CharField(widget=forms.TextInput(attrs={'placeholder': 'Phone Number'}), required=False,
                             label="")
 
     class Meta:
         model = Profile
-        fields = ['image', 'phone', 'is_company_admin', 'get_backup_emails']
+        fields = ['image', 'phone', 'is_company_admin', 'get_backup_emails', 'backup_email_digest']
         help_texts = {k: "" for k in fields}
         labels = {k: "" for k in fields}
 
@@ -0,0 +1,145 @@
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.db.models import F
+from django.utils import timezone
+from users.models import OutboxEmail
+
+logger = logging.getLogger(__name__)
+
+RETRY_DELAY = 60  # seconds before retrying an email that couldn't be sent, doubled after every failed attempt
+
+
+class OutboxEmailBackend(BaseEmailBackend):
+    """
+    Email backend that saves messages to the outbox instead of sending them. Everything that calls send_mail()
+    (backup emails, new user credentials, password resets) goes through here, so none of them wait on the SMTP
+    server during a request. Some of those bodies are secrets (a new user's password, a reset link), so they're only
+    kept until the email is sent or given up on.
+    """
+
+    def send_messages(self, email_messages):
+        outbox = []
+        for message in email_messages:
+            if not message.recipients():
+                continue
+            if message.attachments:
+                logger.warning(f"Email '{message.subject}' has attachments, they are not kept in the outbox.")
+
+            html_body = ''
+            for content, mimetype in getattr(message, 'alternatives', []):
+                if mimetype == 'text/html':
+                    html_body = content
+
+            outbox.append(OutboxEmail(subject=message.subject, body=message.body, html_body=html_body,
+                                      from_email=message.from_email, to=list(message.to), cc=list(message.cc),
+                                      bcc=list(message.bcc), reply_to=list(message.reply_to),
+                                      headers=dict(message.extra_headers)))
+
+        OutboxEmail.objects.bulk_create(outbox)
+        return len(outbox)
+
+
+def build_message(email: OutboxEmail, connection) -> EmailMultiAlternatives:
+    message = EmailMultiAlternatives(subject=email.subject, body=email.body, from_email=email.from_email,
+                                     to=email.to, cc=email.cc, bcc=email.bcc, reply_to=email.reply_to,
+                                     headers=email.headers, connection=connection)
+    if email.html_body:
+        message.attach_alternative(email.html_body, 'text/html')
+    return message
+
+
+def sent_in_last_minute() -> int:
+    return OutboxEmail.objects.filter(sent_at__gte=timezone.now() - timedelta(minutes=1)).count()
+
+
+def claim_outbox_email() -> OutboxEmail | None:
+    now = timezone.now()
+    due = OutboxEmail.objects.filter(status=OutboxEmail.PENDING, send_after__lte=now).values_list('id', flat=True)[:10]
+    for email_id in due:
+        if OutboxEmail.objects.filter(id=email_id, status=OutboxEmail.PENDING).update(status=OutboxEmail.SENDING,
+                                                                                        send_after=now,
+                                                                                        attempts=F('attempts') + 1):
+            return OutboxEmail.objects.get(id=email_id)
+    return None
+
+
+def send_outbox(batch_size: int = None) -> int:
+    """
+    Send up to batch_size queued emails over a single SMTP connection, staying under OUTBOX_RATE_LIMIT emails a
+    minute. Returns how many were sent. Emails that fail are retried later, with a growing delay.
+    """
+    requeue_stale_emails()
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    allowed = min(batch_size, settings.OUTBOX_RATE_LIMIT - sent_in_last_minute())
+    if allowed <= 0 or not OutboxEmail.objects.filter(status=OutboxEmail.PENDING,
+                                                      send_after__lte=timezone.now()).exists():
+        return 0
+
+    # fail_silently=False so a failed send is retried rather than marked as sent
+    connection = get_connection(settings.OUTBOX_EMAIL_BACKEND, fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        logger.warning(f"Could not connect to the mail server, emails stay in the outbox. Error: {e}")
+        return 0
+
+    sent = 0
+    with connection:
+        while sent < allowed:
+            email = claim_outbox_email()
+            if email is None:
+                break
+
+            try:
+                build_message(email, connection).send()
+            except Exception as e:
+                email.last_error = f"{type(e).__name__}: {e}"
+                if email.attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    email.status = OutboxEmail.FAILED
+                    email.body = email.html_body = ''  # never going to be sent, don't keep what it said
+                    logger.error(f"Gave up sending email {email} after {email.attempts} attempts. "
+                                 f"Error: {email.last_error}")
+                else:
+                    email.status = OutboxEmail.PENDING
+                    email.send_after = timezone.now() + timedelta(seconds=RETRY_DELAY * pow(2, email.attempts - 1))
+                    logger.warning(f"Could not send email {email}, retrying after {email.send_after}. "
+                                   f"Error: {email.last_error}")
+                email.save(update_fields=['status', 'send_after', 'last_error', 'body', 'html_body'])
+                continue
+
+            email.status = OutboxEmail.SENT
+            email.sent_at = timezone.now()
+            email.body = email.html_body = ''
+            email.save(update_fields=['status', 'sent_at', 'body', 'html_body'])
+            sent += 1
+
+    if sent:
+        logger.info(f"Sent {sent} email(s) from the outbox.")
+    return sent
+
+
+def requeue_stale_emails():
+    """
+    Emails left 'sending' (send_after is set to when they were claimed) by a process that died mid-batch go back
+    in the queue. They may have gone out already, sending a duplicate is better than dropping e.g. a password reset.
+    """
+    cutoff = timezone.now() - timedelta(minutes=30)
+    OutboxEmail.objects.filter(status=OutboxEmail.SENDING, send_after__lt=cutoff,
+                               sent_at__isnull=True).update(status=OutboxEmail.PENDING)
+
+
+def purge_outbox() -> int:
+    """
+    Delete the emails that were sent or given up on more than OUTBOX_RETENTION_DAYS ago (their bodies are already
+    gone, what's left is kept for a while to look into delivery problems). Returns how many were deleted.
+    """
+    cutoff = timezone.now() - timedelta(days=settings.OUTBOX_RETENTION_DAYS)
+    # send_after is when they were last claimed, i.e. about when they were sent or failed for the last time
+    deleted, _ = OutboxEmail.objects.filter(status__in=[OutboxEmail.SENT, OutboxEmail.FAILED],
+                                            send_after__lt=cutoff).delete()
+    if deleted:
+        logger.info(f"Deleted {deleted} old email(s) from the outbox.")
+    return deleted
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from users.mail import send_outbox
+from users.models import OutboxEmail
+
+
+class Command(BaseCommand):
+    help = "Send the emails waiting in the outbox (still within OUTBOX_RATE_LIMIT). Useful to flush the outbox by " \
+           "hand or to try the SMTP settings against a local test server."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help="Most emails to send in this run.")
+
+    def handle(self, *args, **options):
+        sent = send_outbox(options['batch_size'])
+        pending = OutboxEmail.objects.filter(status=OutboxEmail.PENDING).count()
+        self.stdout.write(self.style.SUCCESS(f"Sent {sent} email(s), {pending} still in the outbox."))
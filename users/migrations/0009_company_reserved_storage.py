@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='company',
+            name='reserved_storage',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='company',
+            name='max_storage',
+            field=models.BigIntegerField(default=104857600),
+        ),
+        migrations.AlterField(
+            model_name='company',
+            name='used_storage',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,19 @@
+from django.db import migrations
+
+
+# emails that were sent or given up on don't keep their bodies anymore (they can hold passwords and reset links),
+# clear the ones already in the outbox
+def clear_sent_email_bodies(apps, schema_editor):
+    OutboxEmail = apps.get_model('users', 'OutboxEmail')
+    OutboxEmail.objects.filter(status__in=['sent', 'failed']).update(body='', html_body='')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_company_reserved_storage'),
+    ]
+
+    operations = [
+        migrations.RunPython(clear_sent_email_bodies, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 01:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0010_clear_sent_email_bodies'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='company',
+            name='reserved_storage',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+        migrations.AlterField(
+            model_name='company',
+            name='used_storage',
+            field=models.BigIntegerField(default=0, editable=False),
+        ),
+    ]
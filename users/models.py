@@ -1,6 +1,7 @@
 import os
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.core.files.uploadedfile import InMemoryUploadedFile
 from io import BytesIO
 from PIL import Image, ImageSequence
@@ -8,7 +9,6 @@ from PIL import Image, ImageSequence
 # make the email field for the user model unique
 User._meta.get_field('email')._unique = True
 
-
 class Company(models.Model):
     name = models.CharField(max_length=100, unique=True)
     address = models.CharField(max_length=100, blank=True)
@@ -17,8 +17,11 @@ class Company(models.Model):
     website = models.URLField(max_length=200, blank=True)
     logo = models.ImageField(default='default_logo.png', upload_to='company_logos')
 
-    max_storage = models.IntegerField(default=(100 * pow(1024, 2)))  # store the max storage in bytes
-    used_storage = models.IntegerField(default=0)  # store the used storage in bytes
+    max_storage = models.BigIntegerField(default=(100 * pow(1024, 2)))  # store the max storage in bytes
+    # the storage counters are only ever changed with F() updates (backups/quota.py), so they aren't on any form, and
+    # saving a company from one only writes the form's fields (a copy of them loaded with it would undo those updates)
+    used_storage = models.BigIntegerField(default=0, editable=False)  # store the used storage in bytes
+    reserved_storage = models.BigIntegerField(default=0, editable=False)  # held for uploads that are still in progress
 
     class Meta:
         verbose_name_plural = 'companies'
@@ -42,6 +45,8 @@ class Profile(models.Model):
     phone = models.CharField(max_length=15, default='', blank=True)
     is_company_admin = models.BooleanField(default=False)  # company admin can add users to the company
     get_backup_emails = models.BooleanField(default=True)  # whether to get backup emails or not
+    backup_email_digest = models.BooleanField(default=False)  # one email a day listing the backups instead
+    last_backup_digest = models.DateTimeField(null=True, blank=True)
 
     def __str__(self):
         return f"{self.user.username} Profile"
@@ -110,3 +115,45 @@ class Profile(models.Model):
             buffer.getbuffer().nbytes,
             None
         )
+
+
+class OutboxEmail(models.Model):
+    """
+    An email waiting to be sent. send_mail() puts emails here instead of connecting to the SMTP server during the
+    request, the outbox sender (users/mail.py) delivers them in batches.
+    """
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (SENDING, 'Sending'),
+        (SENT, 'Sent'),
+        (FAILED, 'Failed'),
+    ]
+
+    subject = models.CharField(max_length=998)
+    body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    cc = models.JSONField(default=list, blank=True)
+    bcc = models.JSONField(default=list, blank=True)
+    reply_to = models.JSONField(default=list, blank=True)
+    headers = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    send_after = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    class Meta:
+        ordering = ['send_after']
+        indexes = [
+            models.Index(fields=['status', 'send_after'], name='outbox_status_send_after_idx'),
+        ]
+
+    def __str__(self):
+        return f"'{self.subject}' to {', '.join(self.to)} ({self.status})"
@@ -1,3 +1,134 @@
-from django.test import TestCase
+import os
+import tempfile
+from datetime import timedelta
+from smtplib import SMTPException
+from django.contrib import admin
+from django.core import mail
+from django.core.mail import get_connection, send_mail
+from django.core.mail.backends.locmem import EmailBackend
+from django.db.models import F
+from django.test import RequestFactory, TestCase, override_settings
+from django.utils import timezone
+from users.mail import RETRY_DELAY, purge_outbox, send_outbox
+from users.models import Company, OutboxEmail
+from PIL import Image
 
-# Create your tests here.
+
+class FailingEmailBackend(EmailBackend):
+    """locmem, except the mail server turns every email down"""
+
+    def send_messages(self, messages):
+        raise SMTPException("550 mailbox unavailable")
+
+
+def queue_email(body='Your password is hunter2', **kwargs):
+    send_mail('Adaski Account Credentials', body, 'noreply@example.com', ['bob@example.com'],
+              html_message=f"<p>{body}</p>", connection=get_connection('users.mail.OutboxEmailBackend'), **kwargs)
+    return OutboxEmail.objects.latest('id')
+
+
+@override_settings(OUTBOX_EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend', OUTBOX_MAX_ATTEMPTS=3,
+                   OUTBOX_RATE_LIMIT=30, OUTBOX_BATCH_SIZE=50, OUTBOX_RETENTION_DAYS=7)
+class OutboxTests(TestCase):
+
+    def test_queued_not_sent(self):
+        email = queue_email()
+        self.assertEqual(email.status, OutboxEmail.PENDING)
+        self.assertEqual(email.to, ['bob@example.com'])
+        self.assertEqual(mail.outbox, [])
+
+    def test_send(self):
+        email = queue_email()
+        self.assertEqual(send_outbox(), 1)
+
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].body, 'Your password is hunter2')
+        self.assertEqual(mail.outbox[0].alternatives[0][0], '<p>Your password is hunter2</p>')
+        email.refresh_from_db()
+        self.assertEqual(email.status, OutboxEmail.SENT)
+        self.assertIsNotNone(email.sent_at)
+        self.assertEqual((email.body, email.html_body), ('', ''))  # the password isn't kept once it's sent
+        self.assertEqual(send_outbox(), 0)
+
+    def test_rate_limit(self):
+        for _ in range(3):
+            queue_email()
+        with self.settings(OUTBOX_RATE_LIMIT=2):
+            self.assertEqual(send_outbox(), 2)
+            self.assertEqual(send_outbox(), 0)  # the third waits for the next minute
+        self.assertEqual(OutboxEmail.objects.filter(status=OutboxEmail.PENDING).count(), 1)
+
+    @override_settings(OUTBOX_EMAIL_BACKEND='users.tests.FailingEmailBackend')
+    def test_retry_with_backoff_then_fail(self):
+        email = queue_email()
+        for attempt in (1, 2):
+            before = timezone.now()
+            self.assertEqual(send_outbox(), 0)
+            email.refresh_from_db()
+            self.assertEqual((email.status, email.attempts), (OutboxEmail.PENDING, attempt))
+            self.assertIn('550 mailbox unavailable', email.last_error)
+            self.assertEqual(email.body, 'Your password is hunter2')  # still needed for the next attempt
+            delay = timedelta(seconds=RETRY_DELAY * pow(2, attempt - 1))
+            self.assertGreaterEqual(email.send_after, before + delay)
+            self.assertLess(email.send_after, timezone.now() + delay)
+
+            self.assertEqual(send_outbox(), 0)  # not due yet
+            self.assertEqual(OutboxEmail.objects.get(id=email.id).attempts, attempt)
+            OutboxEmail.objects.filter(id=email.id).update(send_after=timezone.now())
+
+        self.assertEqual(send_outbox(), 0)
+        email.refresh_from_db()
+        self.assertEqual((email.status, email.attempts), (OutboxEmail.FAILED, 3))
+        self.assertEqual((email.body, email.html_body), ('', ''))
+        self.assertEqual(send_outbox(), 0)
+
+    def test_stale_sending_email_is_requeued(self):
+        email = queue_email()
+        OutboxEmail.objects.filter(id=email.id).update(status=OutboxEmail.SENDING,
+                                                       send_after=timezone.now() - timedelta(hours=1))
+        self.assertEqual(send_outbox(), 1)
+        self.assertEqual(len(mail.outbox), 1)
+
+    def test_purge(self):
+        old_sent, old_failed, recent_sent, pending = (queue_email() for _ in range(4))
+        long_ago = timezone.now() - timedelta(days=8)
+        OutboxEmail.objects.filter(id=old_sent.id).update(status=OutboxEmail.SENT, send_after=long_ago)
+        OutboxEmail.objects.filter(id=old_failed.id).update(status=OutboxEmail.FAILED, send_after=long_ago)
+        OutboxEmail.objects.filter(id=recent_sent.id).update(status=OutboxEmail.SENT)
+        OutboxEmail.objects.filter(id=pending.id).update(send_after=long_ago)  # overdue, but not sent yet
+
+        self.assertEqual(purge_outbox(), 2)
+        self.assertEqual(set(OutboxEmail.objects.values_list('id', flat=True)), {recent_sent.id, pending.id})
+
+    def test_admin_hides_bodies(self):
+        email = queue_email()
+        model_admin = admin.site._registry[OutboxEmail]
+        request = RequestFactory().get('/')
+        fields = model_admin.get_form(request, email).base_fields
+        self.assertNotIn('body', fields)
+        self.assertNotIn('html_body', fields)
+
+
+class CompanyStorageTests(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+        Image.new('RGB', (10, 10)).save(os.path.join(media_root.name, 'default_logo.png'))
+
+    def test_editing_a_company_leaves_its_storage_counters_alone(self):
+        company = Company.objects.create(name='Co')
+        # an upload finishes while the company is being edited in the admin
+        Company.objects.filter(pk=company.pk).update(used_storage=F('used_storage') + 100)
+
+        request = RequestFactory().post('/')
+        model_admin = admin.site._registry[Company]
+        form = model_admin.get_form(request, company, change=True)({'name': 'Co', 'max_storage': 500},
+                                                                   instance=company)
+        self.assertNotIn('used_storage', form.fields)
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, form.save(commit=False), form, change=True)
+
+        company.refresh_from_db()
+        self.assertEqual((company.max_storage, company.used_storage), (500, 100))
@@ -275,7 +275,10 @@ class CompanyUpdateView(LoginRequiredMixin, UpdateView):
 
     def form_valid(self, form):  # add success message
         messages.success(self.request, 'Company Information Updated.')
-        return super().form_valid(form)
+        # only the form's fields, the storage counters loaded with the company may have changed since
+        self.object = form.save(commit=False)
+        self.object.save(update_fields=self.fields)
+        return redirect(self.get_success_url())
 
 
 class CompanyDeleteView(LoginRequiredMixin, DeleteView):